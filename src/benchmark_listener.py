@@ -0,0 +1,293 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - HTTP load benchmark
+
+        Starts the listener in-process with emulated pins and sensors (DEBUG emulation), hammers it
+        with a mix of status, HTML and toggle requests at the concurrency you ask for, then reports
+        requests/second and p50/p95/p99 latencies. Save the results as JSON to compare versions.
+
+        Usage:
+            python ./src/benchmark_listener.py --requests 2000 --concurrency 8 --mix status=8,html=1,toggle=1 --output bench.json
+
+        The controller is never connected to pigpiod, so this is safe to run on a Pi wired up to a real
+        programmer: toggles only flip emulated pins.
+"""
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import socket
+import subprocess
+import sys
+from time import perf_counter
+
+os.environ.setdefault("RASPITHERM_DEBUG", "1")  # Must happen before our modules read the config
+
+# Add some gymnastics so we can use imports relative to the parent dir.
+my_dir = os.path.dirname(os.path.realpath(__file__)) #The directory we're running in
+sys.path.append(os.path.dirname(my_dir))  # Parent dir
+
+from twisted.internet import reactor, defer
+from twisted.web.client import Agent, HTTPConnectionPool, readBody
+
+from src.config import CONFIG_SETTINGS, DEBUG
+from raspitherm_listener import RaspithermControlResource, RaspithermControlSite, start_background_tasks
+
+
+REQUEST_KINDS = ("status", "html", "toggle")
+DEFAULT_MIX = "status=8,html=1,toggle=1"
+
+
+def parse_mix(mix_str):
+    """
+    Turns "status=8,html=1,toggle=1" into {"status": 8, "html": 1, "toggle": 1}
+    """
+    mix = {}
+    for part in mix_str.split(","):
+        if not part.strip():
+            continue
+        kind, _equals, weight = part.partition("=")
+        kind = kind.strip()
+        if kind not in REQUEST_KINDS:
+            raise argparse.ArgumentTypeError("Unknown request kind {}. Choose from {}".format(kind, ", ".join(REQUEST_KINDS)))
+        try:
+            mix[kind] = int(weight or 1)
+        except ValueError:
+            raise argparse.ArgumentTypeError("Weight for {} must be an integer".format(kind))
+    if not sum(mix.values()):
+        raise argparse.ArgumentTypeError("The mix needs at least one request kind with a weight above 0")
+    return mix
+
+
+def get_unused_port():
+    """
+    Finds a local port nothing is listening on, so the controller's pigpio connection is refused
+    and it falls back to emulated pins.
+    """
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+def get_git_version():
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=my_dir, stderr=subprocess.DEVNULL).decode("utf-8").strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def percentile(sorted_values, fraction):
+    """
+    Nearest-rank percentile of an already-sorted list
+    """
+    if not sorted_values:
+        return None
+    rank = max(int(round(fraction * len(sorted_values) + 0.5)) - 1, 0)
+    return sorted_values[min(rank, len(sorted_values) - 1)]
+
+
+def summarise(latencies, elapsed_seconds, n_errors=0):
+    """
+    Boils a list of latencies (seconds) down to the numbers we care about, in milliseconds
+    """
+    sorted_latencies = sorted(latencies)
+    n_requests = len(sorted_latencies)
+
+    def ms(value):
+        return None if value is None else round(value * 1000.0, 3)
+
+    return {
+        "requests": n_requests,
+        "errors": n_errors,
+        "requests_per_second": round(n_requests / elapsed_seconds, 2) if elapsed_seconds else None,
+        "mean_ms": ms(sum(sorted_latencies) / n_requests) if n_requests else None,
+        "min_ms": ms(sorted_latencies[0]) if n_requests else None,
+        "p50_ms": ms(percentile(sorted_latencies, 0.50)),
+        "p95_ms": ms(percentile(sorted_latencies, 0.95)),
+        "p99_ms": ms(percentile(sorted_latencies, 0.99)),
+        "max_ms": ms(sorted_latencies[-1]) if n_requests else None,
+    }
+
+
+class ListenerBenchmark(object):
+    """
+    Drives the in-process listener with a fixed number of requests from N concurrent workers
+    """
+
+    def __init__(self, base_url, mix, n_requests=1000, concurrency=4, seed=0):
+        self.base_url = base_url
+        self.n_requests = n_requests
+        self.concurrency = concurrency
+        self.random = random.Random(seed)  # Same seed, same request sequence
+        self.kinds = [kind for kind in REQUEST_KINDS for _ in range(mix.get(kind, 0))]
+        self.n_issued = 0
+        self.latencies = {kind: [] for kind in REQUEST_KINDS}
+        self.errors = {kind: 0 for kind in REQUEST_KINDS}
+        self.toggle_states = {"hw": 0, "ch": 0}
+        self.pool = HTTPConnectionPool(reactor, persistent=True)
+        self.pool.maxPersistentPerHost = concurrency
+        self.agent = Agent(reactor, pool=self.pool)
+
+    def get_path(self, kind):
+        if kind == "status":
+            return "/?status="
+        if kind == "html":
+            return "/"
+        circuit = self.random.choice(("hw", "ch"))
+        self.toggle_states[circuit] = 1 - self.toggle_states[circuit]
+        return "/?{}={}".format(circuit, "on" if self.toggle_states[circuit] else "off")
+
+    @defer.inlineCallbacks
+    def worker(self):
+        while self.n_issued < self.n_requests:
+            self.n_issued += 1
+            kind = self.random.choice(self.kinds)
+            url = (self.base_url + self.get_path(kind)).encode("utf-8")
+            start = perf_counter()
+            try:
+                response = yield self.agent.request(b"GET", url)
+                yield readBody(response)
+            except Exception as e:
+                self.errors[kind] += 1
+                print("\t{} request failed: {}".format(kind, e))
+                continue
+            if response.code >= 400:
+                self.errors[kind] += 1
+                continue
+            self.latencies[kind].append(perf_counter() - start)
+
+    @defer.inlineCallbacks
+    def run(self):
+        start = perf_counter()
+        yield defer.DeferredList([self.worker() for _ in range(self.concurrency)])
+        elapsed_seconds = perf_counter() - start
+        yield self.pool.closeCachedConnections()
+        all_latencies = [latency for kind in REQUEST_KINDS for latency in self.latencies[kind]]
+        results = {
+            "elapsed_seconds": round(elapsed_seconds, 3),
+            "overall": summarise(all_latencies, elapsed_seconds, n_errors=sum(self.errors.values())),
+        }
+        for kind in REQUEST_KINDS:
+            if self.latencies[kind] or self.errors[kind]:
+                results[kind] = summarise(self.latencies[kind], elapsed_seconds, n_errors=self.errors[kind])
+        return results
+
+
+def build_benchmark_site(options):
+    """
+    Builds the site with a config which guarantees emulation
+    """
+    config = dict(CONFIG_SETTINGS)
+    config.update(
+        pi_host="127.0.0.1",
+        pig_port=get_unused_port(),  # Nothing listening: pigpio can't connect, so pins are emulated
+        th_sensor_pin=0,  # Emulated temperature / humidity sensor
+        hw_temp_sensor_pin=0,
+    )
+    if options.pulse_duration_ms is not None:
+        config["pulse_duration_ms"] = options.pulse_duration_ms
+    if options.relay_delay_ms is not None:
+        config["relay_delay_ms"] = options.relay_delay_ms
+    resource = RaspithermControlResource(config=config, emulated_readable_pins={}, registry={})
+    return RaspithermControlSite(resource=resource, timeout=8), config
+
+
+def print_results(report):
+    print("\nRaspitherm listener benchmark ({})".format(report.get("version") or "unknown version"))
+    print("{:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format("kind", "requests", "errors", "req/s", "p50 ms", "p95 ms", "p99 ms", "max ms"))
+    for kind in ("overall",) + REQUEST_KINDS:
+        stats = report["results"].get(kind)
+        if not stats:
+            continue
+        print("{:<10}{:>10}{:>8}{:>10}{:>10}{:>10}{:>10}{:>10}".format(
+            kind, stats["requests"], stats["errors"], stats["requests_per_second"],
+            stats["p50_ms"], stats["p95_ms"], stats["p99_ms"], stats["max_ms"]
+        ))
+
+
+@defer.inlineCallbacks
+def run_benchmark(options):
+    site, config = build_benchmark_site(options)
+    port = reactor.listenTCP(0, site, interface="127.0.0.1")
+    loops = start_background_tasks(site.resource) if options.with_pollers else []
+    base_url = "http://127.0.0.1:{}".format(port.getHost().port)
+    try:
+        if options.warmup:
+            yield ListenerBenchmark(base_url, options.mix, n_requests=options.warmup, concurrency=options.concurrency, seed=options.seed + 1).run()
+        results = yield ListenerBenchmark(base_url, options.mix, n_requests=options.requests, concurrency=options.concurrency, seed=options.seed).run()
+    finally:
+        for loop in loops:
+            if loop.running:
+                loop.stop()
+        yield port.stopListening()
+    report = {
+        "label": options.label,
+        "version": get_git_version(),
+        "timestamp": datetime.datetime.now().isoformat(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "emulated": DEBUG,
+        "options": {
+            "requests": options.requests,
+            "concurrency": options.concurrency,
+            "mix": options.mix,
+            "warmup": options.warmup,
+            "seed": options.seed,
+            "with_pollers": options.with_pollers,
+            "pulse_duration_ms": config.get("pulse_duration_ms"),
+            "relay_delay_ms": config.get("relay_delay_ms"),
+        },
+        "results": results,
+    }
+    print_results(report)
+    if options.output:
+        with open(options.output, "w") as output_file:
+            json.dump(report, output_file, indent=2, sort_keys=True)
+        print("\nResults saved to {}".format(options.output))
+    return report
+
+
+def get_arg_parser():
+    parser = argparse.ArgumentParser(description="HTTP load benchmark for the Raspitherm listener, using emulated pins and sensors.")
+    parser.add_argument("--requests", "-n", type=int, default=1000, help="How many requests to measure (default 1000)")
+    parser.add_argument("--concurrency", "-c", type=int, default=4, help="How many requests to keep in flight (default 4)")
+    parser.add_argument("--mix", type=parse_mix, default=parse_mix(DEFAULT_MIX), help="Weighted mix of request kinds (default {})".format(DEFAULT_MIX))
+    parser.add_argument("--warmup", type=int, default=50, help="Unmeasured requests to send first (default 50)")
+    parser.add_argument("--seed", type=int, default=0, help="Random seed for the request sequence")
+    parser.add_argument("--pulse-duration-ms", type=int, default=None, help="Override the config file's pulse_duration_ms")
+    parser.add_argument("--relay-delay-ms", type=int, default=None, help="Override the config file's relay_delay_ms")
+    parser.add_argument("--no-pollers", dest="with_pollers", action="store_false", help="Don't run the background status / sensor polling loops")
+    parser.add_argument("--label", default=None, help="A label saved with the results, e.g. the change being measured")
+    parser.add_argument("--output", "-o", default=None, help="Save the results as JSON to this file")
+    return parser
+
+
+def main(argv=None):
+    options = get_arg_parser().parse_args(argv)
+    if not DEBUG:
+        print("ERROR: Emulation is off. Run with RASPITHERM_DEBUG=1.")
+        return 1
+    outcome = {}
+
+    def finished(result):
+        outcome["report"] = result
+        reactor.stop()
+
+    def failed(failure):
+        outcome["failure"] = failure
+        failure.printTraceback()
+        reactor.stop()
+
+    reactor.callWhenRunning(lambda: run_benchmark(options).addCallbacks(finished, failed))
+    reactor.run()
+    return 0 if "report" in outcome else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -7,6 +7,7 @@ import logging
 
 import configparser
 import os
+from collections import OrderedDict
 
 import pytz
 
@@ -42,11 +43,35 @@ DEFAULTS = {
         'cw_status_pin': 27,
         'pulse_duration_ms': 200,  # Duration of pulse
         'relay_delay_ms': 200,  # How long it takes for the relays to be thrown
+        'relay_confirm_mode': "edge",  # "edge": wait for the status pin to change after a toggle. "delay": always wait relay_delay_ms
+        'relay_confirm_timeout_ms': 1000,  # In edge mode, how long to wait for the status pin to change
+        'status_pin_glitch_filter_us': 5000,  # Ignore status pin blips shorter than this
+        'hardware_pulses': 1,  # Have pigpiod time the toggle pulses (0 to time them in Python)
+        'pigpio_health_check_seconds': 5,  # How often we check pigpiod is still answering
+        'pigpio_reconnect_min_seconds': 1,  # First retry after losing pigpiod. Doubles on each failed attempt...
+        'pigpio_reconnect_max_seconds': 60,  # ...up to this
         'sensor_polling_period_seconds': 60,
+        'status_polling_period_seconds': 10,  # How often the status snapshot served to requests is refreshed
+        'history_size': 8640,  # How many readings /history keeps per sensor (8640 = a day of status polls every 10 seconds)
         'th_sensor_pin': 0,
         'hw_temp_sensor_pin': 0,
+        'w1_rescan_seconds': 60,  # A DS18B20 probe we can't find is looked for again no more often than this
+        'w1_read_threads': 4,  # How many DS18B20 probes are read at once
+        'w1_sample_seconds': 10,  # How often the DS18B20 probes are read, in the background
+        'w1_read_deadline_seconds': 5,  # A DS18B20 probe which hasn't answered by now keeps its last reading
         'th_sensor_type': "DHT11",
         'th_sensor_power_pin': 0,
+        'thermostat_mode': "hysteresis",  # How the central heating is driven towards target_temperature: off, hysteresis or pid
+        'thermostat_hysteresis_c': 0.5,  # Heating comes on below target - this, goes off above target + this
+        'thermostat_min_on_seconds': 300,  # Don't short-cycle the boiler
+        'thermostat_min_off_seconds': 300,
+        'thermostat_pid_kp': 0.5,  # PID mode: heating demand (0-1) per degree C below target
+        'thermostat_pid_ki': 0.0005,
+        'thermostat_pid_kd': 0.0,
+        'thermostat_cycle_seconds': 900,  # PID mode: time-proportioning cycle length
+        'rollup_path': "rollups",  # Directory for the long-term history (raw readings plus 1m / 15m / 1h rollups). Blank to turn it off
+        'rollup_flush_seconds': 300,  # Readings are gathered in memory and written to the SD card this often
+        'registry_path': "raspitherm_registry.log",  # Where settings like target_temperature and the last sensor readings are kept across restarts. Blank to keep them in memory only
         'debug': 0  # Must be lower case!
 }
 
@@ -69,6 +94,71 @@ else:
 CONFIG_SETTINGS = odict2int(parser.defaults()) #Turn the Config file into settings
 
 
+ZONE_SECTION_PREFIX = "zone:"
+ZONE_DEFAULTS = OrderedDict((
+    ('label', ""),  # Human readable name. Defaults to the zone name
+    ('toggle_pin', 0),  # Output pin which presses the zone's override button
+    ('status_pin', 0),  # Input pin reading the zone's status LED
+    ('temp_sensor_id', ""),  # Optional DS18B20 w1 device id e.g. 28-0316a27979ff
+))
+
+
+def get_zone_settings(config_parser):
+    """
+    Reads the extra heating zones out of the config file. Each zone has its own section e.g.
+        [zone:upstairs]
+        toggle_pin = 6
+        status_pin = 23
+
+    @param config_parser: <ConfigParser> The parsed config file
+    @returns: <OrderedDict> {zone_name: OrderedDict of the zone's settings}, in the order they appear in the file
+    """
+    zones = OrderedDict()
+    for section in config_parser.sections():
+        if not section.startswith(ZONE_SECTION_PREFIX):
+            continue
+        zone_name = section[len(ZONE_SECTION_PREFIX):].strip()
+        zone_settings = OrderedDict(
+            (key, config_parser.get(section, key, fallback=default)) for key, default in ZONE_DEFAULTS.items()
+        )
+        zones[zone_name] = odict2int(zone_settings)
+    return zones
+
+
+ZONE_SETTINGS = get_zone_settings(parser)
+
+
+PROBE_SECTION_PREFIX = "probe:"
+PROBE_DEFAULTS = OrderedDict((
+    ('label', ""),  # Human readable name. Defaults to the probe's role
+    ('device_id', ""),  # DS18B20 w1 device id e.g. 28-0316a27979ff
+))
+
+
+def get_probe_settings(config_parser):
+    """
+    Reads the named DS18B20 probes out of the config file. Each probe has its own section, named by
+    its role e.g.
+        [probe:tank_top]
+        device_id = 28-0316a27979ff
+
+    @param config_parser: <ConfigParser> The parsed config file
+    @returns: <OrderedDict> {role: OrderedDict of the probe's settings}, in the order they appear in the file
+    """
+    probes = OrderedDict()
+    for section in config_parser.sections():
+        if not section.startswith(PROBE_SECTION_PREFIX):
+            continue
+        role = section[len(PROBE_SECTION_PREFIX):].strip()
+        probes[role] = OrderedDict(
+            (key, config_parser.get(section, key, fallback=default)) for key, default in PROBE_DEFAULTS.items()
+        )
+    return probes
+
+
+PROBE_SETTINGS = get_probe_settings(parser)
+
+
 class NotSet(object):
     """
     Null class
@@ -111,3 +201,5 @@ get_config = get_setting
 
 
 DEBUG = bool(get_setting("debug", default=False))
+if os.environ.get("RASPITHERM_DEBUG"):  # Lets the benchmark and other dev tools force pin / sensor emulation
+    DEBUG = os.environ["RASPITHERM_DEBUG"] not in ("0", "false", "False")
@@ -12,15 +12,176 @@
     The actual Raspberry Pi controller class wrapper
 """
 
+import functools
 import logging
+import math
+from collections import OrderedDict
+
 import pigpio
+import six
 from time import sleep
 
+from twisted.internet import defer, task
+from twisted.python.failure import Failure
+
 from config import DEBUG
-from utils import BaseRaspiHomeDevice, TemperatureHumiditySensor, WaterTemperatureSensor
+from utils import BaseRaspiHomeDevice, TemperatureHumiditySensor, WaterTemperatureSensor, StatusSnapshot, PinLevelTimeout, \
+    PigpioConnectionManager, PIGPIO_CONNECTION_ERRORS, W1Bus, W1Sampler
+from src.metrics import REGISTRY
+from src.history import RingBuffer
+from thermostat import Thermostat
 
 logging.basicConfig(format='[%(asctime)s RASPITHERM] %(message)s', datefmt='%H:%M:%S',level=logging.INFO)
 
+CHECK_STATUS_SECONDS = REGISTRY.histogram("raspitherm_check_status_seconds", "Time taken by a full status check of pins and sensors")
+REFRESH_STATUS_SECONDS = REGISTRY.histogram("raspitherm_refresh_status_snapshot_seconds", "Time taken to refresh the status snapshot from the pins")
+RELAY_CONFIRM_SECONDS = REGISTRY.histogram("raspitherm_relay_confirm_seconds", "Time from the end of a toggle pulse to the status pin confirming the switch", buckets=(0.005, 0.01, 0.025, 0.05, 0.1, 0.2, 0.35, 0.5, 1.0, 2.5))
+RELAY_CONFIRM_TIMEOUTS = REGISTRY.counter("raspitherm_relay_confirm_timeouts_total", "Toggles where the status pin never confirmed the switch")
+SWITCH_SECONDS = REGISTRY.histogram("raspitherm_switch_seconds", "Time taken to switch circuits, from command to measured status", buckets=(0.01, 0.05, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0))
+
+
+class RelayConfirmationTimeout(Exception):
+    """
+    We pulsed a circuit's toggle pin, but its status pin never changed to confirm it had switched
+    """
+
+    def __init__(self, circuit_name, intended_value, timeout_ms):
+        self.circuit_name = circuit_name
+        self.intended_value = intended_value
+        self.timeout_ms = timeout_ms
+        super(RelayConfirmationTimeout, self).__init__(
+            "{} did not confirm switching {} within {}ms".format(circuit_name, "on" if intended_value else "off", timeout_ms)
+        )
+
+
+class CircuitCommandCoalescer(object):
+    """
+    Single-flight coalescing of switching commands, with one lane per circuit:
+        * A command the same as the one in flight (with nothing queued) joins it and shares its result
+        * A conflicting command is queued, to run once the one in flight has finished
+        * Only one command is ever queued per circuit. Last writer wins: a later command replaces it,
+          and everyone who was waiting on the replaced command gets the replacement's result
+    """
+
+    def __init__(self, operation):
+        """
+        @param operation: <callable> (circuit_name, intended_value) returning a Deferred
+        """
+        self.operation = operation
+        self.in_flight = {}  # circuit_name: [intended_value, [waiting Deferreds]]
+        self.queued = {}  # circuit_name: [intended_value, [waiting Deferreds]]
+
+    def submit(self, circuit_name, intended_value):
+        """
+        Asks for a circuit to be switched to the value given.
+
+        @return: <Deferred> which fires with the result of whichever operation ends up serving this command
+        """
+        waiter = defer.Deferred()
+        in_flight = self.in_flight.get(circuit_name)
+        queued = self.queued.get(circuit_name)
+        if in_flight is None:  # Nothing going on, so off we go
+            self.in_flight[circuit_name] = [intended_value, [waiter]]
+            self._run(circuit_name, intended_value)
+        elif queued is None and in_flight[0] == intended_value:  # Already on its way
+            in_flight[1].append(waiter)
+        elif queued is None:  # Conflicts with the command in flight, so wait for it to finish
+            self.queued[circuit_name] = [intended_value, [waiter]]
+        else:  # Last writer wins
+            queued[0] = intended_value
+            queued[1].append(waiter)
+        return waiter
+
+    def is_busy(self, circuit_name):
+        return circuit_name in self.in_flight
+
+    def _run(self, circuit_name, intended_value):
+        d = defer.maybeDeferred(self.operation, circuit_name, intended_value)
+        d.addBoth(self._on_finished, circuit_name)
+
+    def _on_finished(self, result, circuit_name):
+        """
+        Shares the result with everyone waiting, then starts the queued command if there is one
+        """
+        _intended_value, waiters = self.in_flight.pop(circuit_name)
+        queued = self.queued.pop(circuit_name, None)
+        if queued is not None:
+            self.in_flight[circuit_name] = queued
+            self._run(circuit_name, queued[0])
+        for waiter in waiters:
+            if isinstance(result, Failure):
+                waiter.errback(result)
+            else:
+                waiter.callback(result)
+        return None  # Any failure has been passed on to the waiters
+
+
+class HeatingZone(object):
+    """
+    An extra heating zone, switched via its own override button and status LED on the programmer.
+    Optionally has its own DS18B20 temperature probe.
+    """
+    state = 0  # Current status of the zone
+    temp = None  # Latest temperature reading
+    iface_temp = None  # WaterTemperatureSensor for the zone's probe
+
+    def __init__(self, name, toggle_pin, status_pin, label="", temp_sensor_id="", w1_bus=None):
+        self.name = name
+        self.label = label or name
+        self.toggle_pin = toggle_pin
+        self.status_pin = status_pin
+        self.temp_sensor_id = temp_sensor_id or None
+        if self.temp_sensor_id:
+            self.iface_temp = WaterTemperatureSensor(device_id=self.temp_sensor_id, bus=w1_bus)
+
+    def __repr__(self):
+        return "<HeatingZone {} toggle={} status={}>".format(self.name, self.toggle_pin, self.status_pin)
+
+    def as_dict(self):
+        """
+        The zone's state, ready for JSON
+        """
+        return {
+            "name": self.name,
+            "label": self.label,
+            "on": int(bool(self.state)),
+            "temp": {
+                key: six.text_type(self.temp[key]) for key in ("temp_c", "temp_f") if self.temp.get(key) is not None
+            } if self.temp else None,
+        }
+
+
+class TemperatureProbe(object):
+    """
+    A DS18B20 probe doing a particular job, e.g. tank_top, tank_bottom, flow or return, as named
+    by its [probe:<role>] section in the config file
+    """
+    temp = None  # Latest temperature reading
+    iface_temp = None  # WaterTemperatureSensor for the probe
+
+    def __init__(self, role, device_id, label="", w1_bus=None):
+        self.role = role
+        self.label = label or role
+        self.device_id = device_id
+        self.iface_temp = WaterTemperatureSensor(device_id=device_id, bus=w1_bus)
+
+    def __repr__(self):
+        return "<TemperatureProbe {} {}>".format(self.role, self.device_id)
+
+    def as_dict(self):
+        """
+        The probe's latest reading, ready for JSON
+        """
+        return {
+            "role": self.role,
+            "label": self.label,
+            "device_id": self.device_id,
+            "available": int(bool(self.iface_temp.device_path)),
+            "temp": {
+                key: six.text_type(self.temp[key]) for key in ("temp_c", "temp_f") if self.temp.get(key) is not None
+            } if self.temp else None,
+        }
+
 
 class HeatingController(BaseRaspiHomeDevice):
     """
@@ -34,6 +195,18 @@ class HeatingController(BaseRaspiHomeDevice):
     iface = None  # General Pigpio interface
     iface_temp_humid = None  # Humidity temperature sensor interface  (could expand this into multiples in future)
     iface_hw_temp = None  # Hot water temperature sensor interface (DS18B20)
+    status_snapshot = None  # Last published StatusSnapshot, served to requests
+    status_epoch = 0  # When this controller started publishing snapshots. Makes snapshot versions unique across restarts
+    status_listeners = None  # Callables told about every new status snapshot version
+    command_coalescer = None  # CircuitCommandCoalescer, so concurrent switching commands can't race each other
+    zones = None  # OrderedDict of extra HeatingZones, by name
+    probes = None  # OrderedDict of TemperatureProbes, by role
+    w1_bus = None  # W1Bus all our DS18B20 probes are found and read through
+    w1_sampler = None  # W1Sampler reading the DS18B20 probes in the background. The listener starts it
+    thermostat = None  # Thermostat driving the central heating towards target_temperature
+    histories = None  # {"th" / "hw_temp" / "heating" / "probes": RingBuffer} of recent readings, for /history
+    rollups = None  # RollupStore the readings also go to, for the long term
+    _pulse_lock = None  # DeferredLock making sure only one toggle pin is pulsed at a time
 
     # Pins
     _HW_TOGGLE_PIN = 5 
@@ -46,12 +219,33 @@ class HeatingController(BaseRaspiHomeDevice):
     _HW_TEMP_SENSOR_PIN = 0  # Hot water temperature sensor pin (DS18B20 - w1)
     _PULSE_DURATION_MS = 200  # How long a toggle pulse should be (milliseconds)
     _RELAY_DELAY_MS = 200  # How long to wait before rechecking the status after a toggle (enough time for relay to switch) 
+    _STATUS_PIN_GLITCH_FILTER_US = 5000  # Status pin level changes shorter than this are ignored (microseconds)
+    _RELAY_CONFIRM_MODE = "edge"  # "edge": wait for the status pin to change after a toggle. "delay": always wait _RELAY_DELAY_MS
+    _RELAY_CONFIRM_TIMEOUT_MS = 1000  # In edge mode, how long to wait for the status pin before giving up
+    _HISTORY_SIZE = 8640  # How many readings to keep in each history
+    VOLATILE_STATUS_KEYS = ("query_timestamp",)  # Change with every sensor read, even when the reading doesn't. Ignored when deciding if the status has changed
     
-    def __init__(self, config, interface=None, emulated_readable_pins=None, registry=None):
+    RESERVED_CIRCUIT_NAMES = ("hw", "ch", "status", "batch")  # Can't be used as zone names
+
+    def __init__(self, config, interface=None, emulated_readable_pins=None, registry=None, zones=None, rollups=None, probes=None):
         """
         Sets this up
+
+        @keyword zones: <dict> of extra heating zones {zone_name: {"toggle_pin": 6, "status_pin": 23, ...}}
+                        as read by config.get_zone_settings()
+        @keyword probes: <dict> of named DS18B20 probes {role: {"device_id": "28-0316a27979ff", ...}}
+                         as read by config.get_probe_settings()
+        @keyword rollups: <RollupStore> to keep the readings in for the long term
         """
         super(HeatingController, self).__init__(registry=registry, emulated_readable_pins=emulated_readable_pins)
+        self.status_epoch = int(self.get_clock().seconds())
+        self.status_listeners = []
+        self.command_coalescer = CircuitCommandCoalescer(self._switch_circuit)
+        self._pulse_lock = defer.DeferredLock()
+        self.zones = OrderedDict()
+        self.probes = OrderedDict()
+        self.rollups = rollups
+        self.w1_bus = W1Bus(rescan_seconds=config.get("w1_rescan_seconds"), max_read_threads=config.get("w1_read_threads"))
 
         self.iface = self.get_or_build_interface(config=config, interface=interface)
         
@@ -59,6 +253,7 @@ class HeatingController(BaseRaspiHomeDevice):
         self._HW_TOGGLE_PIN = config.get("hw_toggle_pin", self._HW_TOGGLE_PIN)
         self._CH_TOGGLE_PIN = config.get("ch_toggle_pin", self._CH_TOGGLE_PIN)
         self._PULSE_DURATION_MS = config.get("pulse_duration_ms", self._PULSE_DURATION_MS)
+        self._RELAY_DELAY_MS = config.get("relay_delay_ms", self._RELAY_DELAY_MS)
         
         # Inputs
         self._HW_STATUS_PIN = config.get("hw_status_pin", self._HW_STATUS_PIN)
@@ -67,45 +262,52 @@ class HeatingController(BaseRaspiHomeDevice):
         self._TH_SENSOR_TYPE = config.get("th_sensor_type", self._TH_SENSOR_TYPE)
         self._TH_SENSOR_POWER_PIN = config.get("th_sensor_power_pin", self._TH_SENSOR_POWER_PIN)
         self._HW_TEMP_SENSOR_PIN = config.get("hw_temp_sensor_pin", self._HW_TEMP_SENSOR_PIN)
+        self._STATUS_PIN_GLITCH_FILTER_US = config.get("status_pin_glitch_filter_us", self._STATUS_PIN_GLITCH_FILTER_US)
+        self._RELAY_CONFIRM_MODE = config.get("relay_confirm_mode", self._RELAY_CONFIRM_MODE)
+        self._RELAY_CONFIRM_TIMEOUT_MS = config.get("relay_confirm_timeout_ms", self._RELAY_CONFIRM_TIMEOUT_MS)
+        self.use_hardware_pulses = bool(config.get("hardware_pulses", self.use_hardware_pulses))
+        self._HISTORY_SIZE = config.get("history_size", self._HISTORY_SIZE)
         
-        # Configure pins (we are using hardware pull-down resistors, so turn the internals off):
         if self.iface.connected:
-            try:
-                self.iface.set_mode(self._HW_TOGGLE_PIN, pigpio.OUTPUT)
-                self.iface.set_mode(self._CH_TOGGLE_PIN, pigpio.OUTPUT)
-                self.iface.set_mode(self._HW_STATUS_PIN, pigpio.INPUT)
-                self.iface.set_mode(self._CH_STATUS_PIN, pigpio.INPUT)
-                self.iface.set_pull_up_down(self._HW_TOGGLE_PIN, pigpio.PUD_OFF)
-                self.iface.set_pull_up_down(self._CH_TOGGLE_PIN, pigpio.PUD_OFF)
-                self.iface.set_pull_up_down(self._HW_STATUS_PIN, pigpio.PUD_OFF)
-                self.iface.set_pull_up_down(self._CH_STATUS_PIN, pigpio.PUD_OFF)
-                if (self._TH_SENSOR_PIN or DEBUG) and self._TH_SENSOR_TYPE:  # The sensor will emulate in development mode
-                    self.iface.set_mode(self._TH_SENSOR_PIN, pigpio.INPUT)
-                    self.add_temp_humidity_interface(pin_id=self._TH_SENSOR_PIN, sensor_type=self._TH_SENSOR_TYPE, sensor_power_pin=self._TH_SENSOR_POWER_PIN)
-                    if self._TH_SENSOR_POWER_PIN:
-                        self.iface.set_mode(self._TH_SENSOR_POWER_PIN, pigpio.OUTPUT)
-                        self.iface.set_pull_up_down(self._TH_SENSOR_POWER_PIN, pigpio.PUD_OFF)  # We use a hardware pull-up
-                        self.iface.write(self._TH_SENSOR_POWER_PIN, pigpio.ON)  # Power up that sensor!!
-
-            except (AttributeError, IOError, pigpio.error) as e:
-                print(
-                    (
-                        "ERROR: Cannot configure pins hw={},{} ch={},{} th={} hw_pwr={}: {}".format(
-                            self._HW_TOGGLE_PIN, self._HW_STATUS_PIN,
-                            self._CH_TOGGLE_PIN, self._CH_STATUS_PIN,
-                            self._TH_SENSOR_PIN, self._TH_SENSOR_POWER_PIN,
-                            e
-                        )
-                    )
-                )
+            self.configure_pins()
+            if self.get_has_temp_humidity_sensor_configured():  # The sensor will emulate in development mode
+                self.add_temp_humidity_interface(pin_id=self._TH_SENSOR_PIN, sensor_type=self._TH_SENSOR_TYPE, sensor_power_pin=self._TH_SENSOR_POWER_PIN)
         else:
             print("ERROR: Interface not connected. Cannot configure pins.")
             if DEBUG:  # We will still emulate the temperature sensor
                 self.add_temp_humidity_interface(pin_id=self._TH_SENSOR_PIN, sensor_type=self._TH_SENSOR_TYPE)
+        # Reconnect if pigpiod goes away. The listener starts it with its other background tasks
+        self.connection = PigpioConnectionManager(self, self.pigpio_params, clock=self.get_clock())
 
         # Configure the DS18B20 interface if requested
         if self._HW_TEMP_SENSOR_PIN:
             self.add_hw_temp_interface(pin_id=self._HW_TEMP_SENSOR_PIN)
+
+        self.thermostat = Thermostat(self, config)
+
+        # Pick up where we left off, until the sensors have been read again
+        self.th = self.get_data("last_th", default=None) or None
+        self.hw_temp = self.get_data("last_hw_temp", default=None) or None
+
+        # Any extra zones share our pigpio interface
+        for zone_name, zone_settings in (zones or {}).items():
+            self.add_zone(zone_name, **zone_settings)
+
+        for role, probe_settings in (probes or {}).items():
+            self.add_probe(role, **probe_settings)
+
+        self.histories = OrderedDict((
+            ("th", RingBuffer(("temp_c", "humidity"), capacity=self._HISTORY_SIZE)),
+            ("hw_temp", RingBuffer(("temp_c",), capacity=self._HISTORY_SIZE)),
+            ("heating", RingBuffer(("hw", "ch") + tuple(self.zones), capacity=self._HISTORY_SIZE)),
+        ))
+        if self.probes:
+            self.histories["probes"] = RingBuffer(tuple(self.probes), capacity=self._HISTORY_SIZE)
+
+        self.w1_sampler = W1Sampler(
+            self.w1_bus, self.get_w1_sensors, self.on_w1_sampled,
+            sample_seconds=config.get("w1_sample_seconds"), deadline_seconds=config.get("w1_read_deadline_seconds"), clock=self.get_clock()
+        )
             
         # Now set internal vars to initial state:
         self.check_status()
@@ -134,6 +336,8 @@ class HeatingController(BaseRaspiHomeDevice):
             out["th_available"] = 1
         else:
             out["th_available"] = 0
+        if self.iface_temp_humid is not None:
+            out["th_sensor"] = self.iface_temp_humid.get_status()
         if self.get_has_hw_temp_sensor() and self.hw_temp:
             out["hw_temp"] = self.hw_temp
             out["hw_temp_c"] = self.hw_temp.get("temp_c")
@@ -141,8 +345,108 @@ class HeatingController(BaseRaspiHomeDevice):
             out["hw_temp_available"] = 1
         else:
             out["hw_temp_available"] = 0
+        out["target_temperature"] = self.get_data("target_temperature", default=None)
+        if self.thermostat is not None:
+            out["thermostat"] = self.thermostat.as_dict()
+        if self.zones:
+            out["zones"] = {zone_name: zone.as_dict() for zone_name, zone in self.zones.items()}
+        if self.probes:
+            out["probes"] = {role: probe.as_dict() for role, probe in self.probes.items()}
+        if self.w1_sampler is not None and self.get_w1_sensors():
+            out["w1"] = self.w1_sampler.as_dict()
+        if self.connection is not None:
+            out["pigpio"] = self.connection.as_dict()
         return out
 
+    @classmethod
+    def compact_status(cls, status):
+        """
+        Boils a status dict down to just the heating state, for pushing to clients as small deltas:
+            {"hw": 1, "ch": 0, "th": {"temp_c": "21.0", "temp_f": "69.8", "humidity": "45"}, "hw_temp": None}
+        """
+        out = {
+            "hw": int(bool(status.get("hw"))),
+            "ch": int(bool(status.get("ch"))),
+        }
+        for status_key, reading_keys in (("th", ("temp_c", "temp_f", "humidity")), ("hw_temp", ("temp_c", "temp_f"))):
+            reading = status.get(status_key)
+            if reading:
+                out[status_key] = {
+                    reading_key: six.text_type(reading[reading_key])
+                    for reading_key in reading_keys if reading.get(reading_key) is not None
+                }
+            else:
+                out[status_key] = None
+        if status.get("zones"):
+            out["zones"] = {zone_name: zone["on"] for zone_name, zone in status["zones"].items()}
+        return out
+
+    def configure_pins(self):
+        """
+        Sets our pins up on pigpiod (we are using hardware pull-down resistors, so turn the internals off).
+        Called on start up, and again whenever we reconnect, as pigpiod forgets everything when it restarts.
+
+        @return: <bool> True if the pins are all set up
+        """
+        if not self.iface.connected:
+            print("ERROR: Interface not connected. Cannot configure pins.")
+            return False
+        try:
+            self.iface.set_mode(self._HW_TOGGLE_PIN, pigpio.OUTPUT)
+            self.iface.set_mode(self._CH_TOGGLE_PIN, pigpio.OUTPUT)
+            self.iface.set_mode(self._HW_STATUS_PIN, pigpio.INPUT)
+            self.iface.set_mode(self._CH_STATUS_PIN, pigpio.INPUT)
+            self.iface.set_pull_up_down(self._HW_TOGGLE_PIN, pigpio.PUD_OFF)
+            self.iface.set_pull_up_down(self._CH_TOGGLE_PIN, pigpio.PUD_OFF)
+            self.iface.set_pull_up_down(self._HW_STATUS_PIN, pigpio.PUD_OFF)
+            self.iface.set_pull_up_down(self._CH_STATUS_PIN, pigpio.PUD_OFF)
+            # Have pigpiod time the toggle pulses. Stored now so the scripts are ready when needed
+            self.store_pulse_script(self._HW_TOGGLE_PIN)
+            self.store_pulse_script(self._CH_TOGGLE_PIN)
+            # Track the status pins by edge callback, so we know their state without asking pigpiod
+            self.watch_pin(self._HW_STATUS_PIN, glitch_filter_us=self._STATUS_PIN_GLITCH_FILTER_US)
+            self.watch_pin(self._CH_STATUS_PIN, glitch_filter_us=self._STATUS_PIN_GLITCH_FILTER_US)
+            if self._TH_SENSOR_PIN and self._TH_SENSOR_TYPE:
+                self.iface.set_mode(self._TH_SENSOR_PIN, pigpio.INPUT)
+                if self._TH_SENSOR_POWER_PIN:
+                    self.iface.set_mode(self._TH_SENSOR_POWER_PIN, pigpio.OUTPUT)
+                    self.iface.set_pull_up_down(self._TH_SENSOR_POWER_PIN, pigpio.PUD_OFF)  # We use a hardware pull-up
+                    self.iface.write(self._TH_SENSOR_POWER_PIN, pigpio.ON)  # Power up that sensor!!
+        except PIGPIO_CONNECTION_ERRORS as e:
+            print(
+                (
+                    "ERROR: Cannot configure pins hw={},{} ch={},{} th={} hw_pwr={}: {}".format(
+                        self._HW_TOGGLE_PIN, self._HW_STATUS_PIN,
+                        self._CH_TOGGLE_PIN, self._CH_STATUS_PIN,
+                        self._TH_SENSOR_PIN, self._TH_SENSOR_POWER_PIN,
+                        e
+                    )
+                )
+            )
+            return False
+        zones_configured = [self.configure_zone_pins(zone) for zone in self.zones.values()]
+        return all(zones_configured)
+
+    def on_interface_lost(self):
+        """
+        Lets everyone know pigpiod has gone away
+        """
+        super(HeatingController, self).on_interface_lost()
+        self.publish_status_snapshot()
+
+    def on_interface_reconnected(self):
+        """
+        pigpiod is back: set the pins up again, point the sensor at the new interface (or add it, if
+        pigpiod was down when we started), and catch up on anything that changed while we were away
+        """
+        self.configure_pins()
+        if self.iface_temp_humid is not None:  # Not truthy until its DHT interface has been built
+            self.iface_temp_humid.use_pigpio_interface(self.iface)
+        elif self.get_has_temp_humidity_sensor_configured():  # pigpiod wasn't up yet when we started
+            self.add_temp_humidity_interface(pin_id=self._TH_SENSOR_PIN, sensor_type=self._TH_SENSOR_TYPE, sensor_power_pin=self._TH_SENSOR_POWER_PIN)
+        self.check_status_pins()
+        self.publish_status_snapshot()
+
     def add_temp_humidity_interface(self, pin_id=None, sensor_type=None, sensor_power_pin=None):
         """
         Add in the pigpio_dht powered interface
@@ -150,15 +454,155 @@ class HeatingController(BaseRaspiHomeDevice):
         if pin_id is None:
             print("Error: Cannot add a temperature/humidity sensor, no pin number supplied.")
         self.iface_temp_humid = TemperatureHumiditySensor(gpio=pin_id, mode=sensor_type, pigpio_interface=self.iface, sensor_power_pin=sensor_power_pin)
+        REGISTRY.gauge(
+            "raspitherm_dht_timeouts_since_last_successful_read",
+            "Consecutive temperature/humidity sensor failures",
+            callback=lambda: self.iface_temp_humid.n_timeouts_since_last_successful_read
+        )
         self.iface_temp_humid.read_non_blocking(delay=5.0)  # Perform first read after enough time has passed for sensor to initialise
         return self.iface_temp_humid
 
+    def add_zone(self, name, toggle_pin=0, status_pin=0, label="", temp_sensor_id=""):
+        """
+        Adds an extra heating zone, configuring its pins on our shared pigpio interface
+
+        @return: <HeatingZone> or None if the zone is misconfigured
+        """
+        if name in self.RESERVED_CIRCUIT_NAMES or name in self.zones:
+            logging.error("ERROR: Cannot add zone {}: that name is already taken.".format(name))
+            return None
+        if not toggle_pin or not status_pin:
+            logging.error("ERROR: Cannot add zone {}: it needs both a toggle_pin and a status_pin.".format(name))
+            return None
+        zone = HeatingZone(name, toggle_pin, status_pin, label=label, temp_sensor_id=temp_sensor_id, w1_bus=self.w1_bus)
+        if self.iface.connected:
+            self.configure_zone_pins(zone)
+        self.zones[name] = zone
+        return zone
+
+    def configure_zone_pins(self, zone):
+        """
+        Sets a zone's pins up on pigpiod
+
+        @return: <bool> True if all went well
+        """
+        try:
+            self.iface.set_mode(zone.toggle_pin, pigpio.OUTPUT)
+            self.iface.set_mode(zone.status_pin, pigpio.INPUT)
+            self.iface.set_pull_up_down(zone.toggle_pin, pigpio.PUD_OFF)
+            self.iface.set_pull_up_down(zone.status_pin, pigpio.PUD_OFF)
+        except PIGPIO_CONNECTION_ERRORS as e:
+            print("ERROR: Cannot configure pins for zone {} toggle={} status={}: {}".format(zone.name, zone.toggle_pin, zone.status_pin, e))
+            return False
+        self.watch_pin(zone.status_pin, glitch_filter_us=self._STATUS_PIN_GLITCH_FILTER_US)
+        self.store_pulse_script(zone.toggle_pin)
+        return True
+
+    def get_zone(self, name):
+        """
+        @return: <HeatingZone> or None if there's no such zone
+        """
+        return self.zones.get(name)
+
+    def check_zone(self, name):
+        """
+        Interrogates a zone's status pin. Returns the zone's current status
+        """
+        zone = self.zones[name]
+        if not self.is_interface_lost():
+            zone.state = self.read_watched(zone.status_pin)
+        return zone.state
+
+    def add_probe(self, role, device_id="", label=""):
+        """
+        Adds a named DS18B20 probe, e.g. the top of the hot water tank
+
+        @return: <TemperatureProbe> or None if the probe is misconfigured
+        """
+        if role in self.probes:
+            logging.error("ERROR: Cannot add probe {}: that role is already taken.".format(role))
+            return None
+        if not device_id:
+            logging.error("ERROR: Cannot add probe {}: it needs a device_id.".format(role))
+            return None
+        probe = TemperatureProbe(role, device_id, label=label, w1_bus=self.w1_bus)
+        self.probes[role] = probe
+        return probe
+
+    def get_w1_sensors(self):
+        """
+        @return: <OrderedDict> {name: WaterTemperatureSensor} of every DS18B20 probe we read: "hw_temp",
+                 "zone:<name>" and "probe:<role>"
+        """
+        sensors = OrderedDict()
+        if self.iface_hw_temp:
+            sensors["hw_temp"] = self.iface_hw_temp
+        for zone_name, zone in self.zones.items():
+            if zone.iface_temp:
+                sensors["zone:" + zone_name] = zone.iface_temp
+        for role, probe in self.probes.items():
+            sensors["probe:" + role] = probe.iface_temp
+        return sensors
+
+    def check_w1_temps(self, use_cache=False):
+        """
+        Reads all the DS18B20 probes at once, so one probe's 750ms conversion doesn't hold up the others.
+        Blocks unless use_cache is set, so on the reactor thread leave the reading to the w1_sampler.
+
+        :param use_cache: <bool> If True, only pick up the last known readings
+        """
+        sensors = self.get_w1_sensors()
+        if use_cache:
+            readings = OrderedDict((name, sensor.read_last_result()) for name, sensor in sensors.items())
+        else:
+            readings = self.w1_bus.read_sensors(sensors)
+        return self.apply_w1_readings(readings)
+
+    def apply_w1_readings(self, readings):
+        """
+        Takes on the DS18B20 readings given, keeping the last known value of any probe missing from them
+
+        @param readings: <dict> {name: reading} keyed as get_w1_sensors()
+        """
+        self.hw_temp = readings.get("hw_temp") or self.hw_temp
+        for zone_name, zone in self.zones.items():
+            zone.temp = readings.get("zone:" + zone_name) or zone.temp
+        for role, probe in self.probes.items():
+            probe.temp = readings.get("probe:" + role) or probe.temp
+        return readings
+
+    def get_w1_temps(self):
+        """
+        @return: <dict> {name: temp_c} of the latest DS18B20 readings, keyed as get_w1_sensors()
+        """
+        temps = {"hw_temp": (self.hw_temp or {}).get("temp_c")}
+        temps.update(("zone:" + zone_name, (zone.temp or {}).get("temp_c")) for zone_name, zone in self.zones.items())
+        temps.update(("probe:" + role, (probe.temp or {}).get("temp_c")) for role, probe in self.probes.items())
+        return temps
+
+    def on_w1_sampled(self, readings):
+        """
+        Called on the reactor thread by the w1_sampler with fresh DS18B20 readings. They always go in the
+        history, but we only republish the status if a temperature has actually changed.
+        """
+        previous_temps = self.get_w1_temps()
+        self.apply_w1_readings(readings)
+        self.record_history()
+        if self.get_w1_temps() != previous_temps:
+            self.publish_status_snapshot()
+
     def get_has_temp_humidity_sensor(self):
         """
         Return True if sensor exists
         """
         return bool(self.iface_temp_humid)
 
+    def get_has_temp_humidity_sensor_configured(self):
+        """
+        Return True if a temperature/humidity sensor is configured, even if pigpiod hasn't been up to add it yet
+        """
+        return bool((self._TH_SENSOR_PIN or DEBUG) and self._TH_SENSOR_TYPE)
+
     def read_temp_humidity(self, use_cache=True):
         """
         Read the relevant interface:
@@ -178,23 +622,57 @@ class HeatingController(BaseRaspiHomeDevice):
             self.iface_temp_humid.read_non_blocking(delay=delay)  # Now update the cache
         else:
             latest_temp_humidity = self.iface_temp_humid.read()
-        self.th = latest_temp_humidity
+        self.th = latest_temp_humidity or self.th  # Keep any reading restored from the registry until we have a new one
         return latest_temp_humidity
     
     def check_hw(self):
         """
         Interrogates the HW pin. Returns the current status of the Hot Water
         """
-        self.hw = self.read(self._HW_STATUS_PIN)
+        self.hw = self.read_watched(self._HW_STATUS_PIN)
         return self.hw
     
     def check_ch(self):
         """
         Interrogates the CH pin. Returns the current status of the Central Heating
         """
-        self.ch = self.read(self._CH_STATUS_PIN)
+        self.ch = self.read_watched(self._CH_STATUS_PIN)
         return self.ch
 
+    def check_status_pins(self):
+        """
+        Interrogates the HW, CH and zone status pins all in one go (a single bank read if they aren't
+        edge-tracked, however many zones there are). While pigpiod is away we stick with the last known
+        states rather than reading made-up zeros, which would tell everyone (and the thermostat) that
+        everything had gone off.
+        """
+        if self.is_interface_lost():
+            return self.hw, self.ch
+        zone_status_pins = [zone.status_pin for zone in self.zones.values()]
+        levels = self.read_watched_many([self._HW_STATUS_PIN, self._CH_STATUS_PIN] + zone_status_pins)
+        self.hw = levels[self._HW_STATUS_PIN]
+        self.ch = levels[self._CH_STATUS_PIN]
+        for zone in self.zones.values():
+            zone.state = levels[zone.status_pin]
+        return self.hw, self.ch
+
+    def on_watched_pin_changed(self, pin, level):
+        """
+        A status pin has changed, either because we toggled it or someone pressed a button on the
+        programmer. Publish the new status straight away.
+        """
+        if pin == self._HW_STATUS_PIN:
+            self.hw = level
+        elif pin == self._CH_STATUS_PIN:
+            self.ch = level
+        else:
+            zones = [zone for zone in self.zones.values() if zone.status_pin == pin]
+            if not zones:
+                return
+            for zone in zones:
+                zone.state = level
+        self.publish_status_snapshot()
+
     def check_th(self):
         """
         Reads temp and humidity with caching
@@ -218,7 +696,7 @@ class HeatingController(BaseRaspiHomeDevice):
         if pin_id is None:
             logging.warning("Cannot add a hot water temperature sensor; no pin number supplied.")
             return None
-        self.iface_hw_temp = WaterTemperatureSensor(gpio_pin=pin_id)
+        self.iface_hw_temp = WaterTemperatureSensor(gpio_pin=pin_id, bus=self.w1_bus)
         return self.iface_hw_temp
 
     def get_has_hw_temp_sensor(self):
@@ -237,23 +715,159 @@ class HeatingController(BaseRaspiHomeDevice):
 
     def check_hw_temp(self):
         """
-        Reads water temperature with caching of last known good value.
+        Reads water temperature with caching of last known good value. Blocks while the probe converts.
         """
         if self.iface_hw_temp:
             self.hw_temp = self.read_hw_temp() or self.hw_temp
             return self.hw_temp or {}
         return {}
     
+    @CHECK_STATUS_SECONDS.timed
     def check_status(self):
         """
         Interrogates both CH and HW pins, returning the statuses of the pins and 
         setting the internal pointers to those values
         """
-        self.check_ch()
-        self.check_hw()
+        self.check_status_pins()
         self.check_th()
-        self.check_hw_temp()
-        return self.status    
+        self.check_w1_temps(use_cache=True)  # The w1_sampler reads the probes in the background
+        self.record_history()
+        return self.publish_status_snapshot()
+
+    @REFRESH_STATUS_SECONDS.timed
+    def refresh_status_snapshot(self, resync_pins=False, record_states=False):
+        """
+        Interrogates both CH and HW pins, but only picks up the last known sensor values rather
+        than querying the sensors themselves. Cheap enough to run often.
+
+        @keyword resync_pins: <bool> Re-read the edge-tracked status pins from pigpiod, in case an edge was missed
+        @keyword record_states: <bool> Sample the heating's on/off states into the "heating" history too
+        """
+        if resync_pins:
+            self.resync_watched_pins()
+        self.check_status_pins()
+        if self.iface_temp_humid:
+            self.th = self.iface_temp_humid.read_last_result() or self.th
+        self.check_w1_temps(use_cache=True)
+        self.record_history(record_states=record_states)
+        return self.publish_status_snapshot()
+
+    def record_history(self, record_states=False):
+        """
+        Adds the latest readings to the histories: sensor readings once each (by when they were read),
+        and the heating's on/off states if asked. The states are only sampled by the periodic status poll,
+        so their history is evenly spaced however many requests refresh the status in between.
+
+        @keyword record_states: <bool> Sample the heating's on/off states into the "heating" history
+        """
+        if self.histories is None:
+            return
+        for history_name, reading in (("th", self.th), ("hw_temp", self.hw_temp)):
+            read_at = (reading or {}).get("query_timestamp")
+            if read_at is None:
+                continue
+            timestamp = read_at.timestamp()
+            history = self.histories[history_name]
+            if history.last_timestamp is None or timestamp > history.last_timestamp:
+                self._record_reading(history_name, timestamp, reading)
+        if self.probes:  # Read together, so recorded together
+            read_ats = [probe.temp["query_timestamp"] for probe in self.probes.values() if probe.temp and probe.temp.get("query_timestamp")]
+            if read_ats:
+                timestamp = max(read_ats).timestamp()
+                history = self.histories["probes"]
+                if history.last_timestamp is None or timestamp > history.last_timestamp:
+                    self._record_reading("probes", timestamp, {role: (probe.temp or {}).get("temp_c") for role, probe in self.probes.items()})
+        if record_states:
+            states = {"hw": self.hw, "ch": self.ch}
+            states.update((zone_name, zone.state) for zone_name, zone in self.zones.items())
+            self._record_reading("heating", self.get_clock().seconds(), states)
+
+    def _record_reading(self, history_name, timestamp, values):
+        history = self.histories[history_name]
+        if history.append(timestamp, values) and self.rollups is not None:
+            try:
+                self.rollups.add(history_name, history.fields, timestamp, values)
+            except (IOError, ValueError) as e:
+                logging.error("ERROR: Cannot save {} reading to the rollup store: {}".format(history_name, e))
+
+    def publish_status_snapshot(self):
+        """
+        Stores the current runtime vars as the status snapshot served to requests. The snapshot's
+        version only goes up if the status has actually changed.
+        """
+        status = self.status
+        previous_snapshot = self.status_snapshot
+        if previous_snapshot is None:
+            version = 1
+        elif self.get_comparable_status(previous_snapshot.data) != self.get_comparable_status(status):
+            version = previous_snapshot.version + 1
+        else:
+            version = previous_snapshot.version
+        self.status_snapshot = StatusSnapshot(status, timestamp=self.get_clock().seconds(), version=version, registry_version=self.get_data_version())
+        if previous_snapshot is None or version != previous_snapshot.version:
+            self.remember_readings()
+            self.notify_status_listeners(self.status_snapshot, previous_snapshot)
+        return status
+
+    @classmethod
+    def get_comparable_status(cls, status):
+        """
+        The status without the VOLATILE_STATUS_KEYS (e.g. when each reading was taken), so a sensor read
+        which found the same values as last time doesn't count as a change
+        """
+        if isinstance(status, dict):
+            return {key: cls.get_comparable_status(value) for key, value in status.items() if key not in cls.VOLATILE_STATUS_KEYS}
+        return status
+
+    def remember_readings(self):
+        """
+        Saves the latest sensor readings to the registry, so they survive a restart
+        """
+        for key, reading in (("last_th", self.th), ("last_hw_temp", self.hw_temp)):
+            if reading and reading != self.registry.get(key):
+                self.set_data(key, reading)
+
+    def add_status_listener(self, listener):
+        """
+        Registers a callable to be told whenever the status changes. It is called with
+        (new_snapshot, previous_snapshot) on the reactor thread. previous_snapshot may be None.
+        """
+        if listener not in self.status_listeners:
+            self.status_listeners.append(listener)
+        return listener
+
+    def remove_status_listener(self, listener):
+        """
+        Unregisters a status listener
+        """
+        try:
+            self.status_listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def notify_status_listeners(self, snapshot, previous_snapshot=None):
+        """
+        Tells the status listeners about a new snapshot. A misbehaving listener won't stop the others.
+        """
+        for listener in list(self.status_listeners):
+            try:
+                listener(snapshot, previous_snapshot)
+            except Exception as e:
+                logging.exception("Status listener {} failed: {}".format(listener, e))
+
+    def get_status_snapshot(self, max_age=None):
+        """
+        Returns the latest status snapshot without touching the hardware, unless it is older than
+        max_age.
+
+        @keyword max_age: <float> Maximum acceptable age of the snapshot in seconds. None means any age.
+        @return: <StatusSnapshot>
+        """
+        if self.status_snapshot is None:
+            self.refresh_status_snapshot()
+        elif max_age is not None and self.status_snapshot.is_older_than(max_age, now=self.get_clock().seconds()):
+            self.refresh_status_snapshot()
+        return self.status_snapshot
     
     def set_hw(self, value):
         """
@@ -265,7 +879,7 @@ class HeatingController(BaseRaspiHomeDevice):
         self.pulse_if_different(current=current_value, intended=intended_value, output_pin=self._HW_TOGGLE_PIN, duration_ms=self._PULSE_DURATION_MS)
         if DEBUG:
             self.emulated_readable_pins[self._HW_STATUS_PIN] = intended_value
-        sleep(self._RELAY_DELAY_MS/1000.0)
+        self._wait_for_relay_blocking("hw", self._HW_STATUS_PIN, intended_value)
         return self.check_status()  # Actually measure the result!
 
     def set_ch(self, value):
@@ -277,14 +891,209 @@ class HeatingController(BaseRaspiHomeDevice):
         self.pulse_if_different(current=current_value, intended=intended_value, output_pin=self._CH_TOGGLE_PIN, duration_ms=self._PULSE_DURATION_MS)
         if DEBUG:
             self.emulated_readable_pins[self._CH_STATUS_PIN] = intended_value
-        sleep(self._RELAY_DELAY_MS/1000.0)
+        self._wait_for_relay_blocking("ch", self._CH_STATUS_PIN, intended_value)
         return self.check_status()  # Actually measure the result!
 
+    def get_confirms_by_edge(self, status_pin):
+        """
+        Returns True if we should confirm switches on this status pin by waiting for its edge, rather
+        than a fixed delay. Needs the pin to be edge-tracked.
+        """
+        return self._RELAY_CONFIRM_MODE == "edge" and status_pin in self.pin_callbacks
+
+    def _wait_for_relay_blocking(self, circuit_name, status_pin, intended_value):
+        """
+        Blocking wait for a relay to be thrown: until the status pin changes in edge mode, or for
+        _RELAY_DELAY_MS otherwise. A timeout is logged rather than raised, as the measured status
+        tells the caller what happened.
+        """
+        if not self.get_confirms_by_edge(status_pin):
+            sleep(self._RELAY_DELAY_MS/1000.0)
+            return True
+        if self.wait_for_pin_level_blocking(status_pin, intended_value, timeout_ms=self._RELAY_CONFIRM_TIMEOUT_MS):
+            return True
+        RELAY_CONFIRM_TIMEOUTS.labels(circuit=circuit_name).inc()
+        logging.warning(str(RelayConfirmationTimeout(circuit_name, intended_value, self._RELAY_CONFIRM_TIMEOUT_MS)))
+        return False
+
+    def set_target_temperature(self, value):
+        """
+        Sets (or with None / "" / "off", clears) the temperature the thermostat should hold the house at,
+        and lets the thermostat respond straight away.
+
+        @return: <float> The new target temperature, or None if cleared
+        @raise ValueError: if value isn't a finite number
+        """
+        if value in (None, "", "off", "none", "None", "null"):
+            target = None
+        else:
+            target = float(value)
+            if not math.isfinite(target):  # NaN would sail through min() / max()
+                raise ValueError("Target temperature must be a finite number, not {}".format(value))
+            target = min(max(target, Thermostat.MIN_TARGET_C), Thermostat.MAX_TARGET_C)
+        self.set_data("target_temperature", target)
+        self.thermostat.update()
+        self.publish_status_snapshot()
+        return target
+
+    def get_circuits(self):
+        """
+        The circuits we can switch, in the order we switch them: hot water, central heating, then
+        any extra zones.
+
+        @return: <OrderedDict> {name: (check_func, status_pin, toggle_pin)}
+        """
+        circuits = OrderedDict((
+            ("hw", (self.check_hw, self._HW_STATUS_PIN, self._HW_TOGGLE_PIN)),
+            ("ch", (self.check_ch, self._CH_STATUS_PIN, self._CH_TOGGLE_PIN)),
+        ))
+        for zone_name, zone in self.zones.items():
+            circuits[zone_name] = (functools.partial(self.check_zone, zone_name), zone.status_pin, zone.toggle_pin)
+        return circuits
+
+    def set_many_non_blocking(self, intended_values):
+        """
+        Switches one or more circuits without blocking the reactor. Any pulses needed are issued back
+        to back (never together, so the programmer never sees two buttons held at once), the relays
+        settle in parallel, then we read the status once.
+
+        Commands go through the command coalescer, so identical commands from several clients at once
+        share one pulse, and conflicting ones take turns.
+
+        @param intended_values: <dict> of circuit name to intended status, e.g. {"hw": "on", "ch": "on"}
+        @return: <Deferred> which fires with the measured status dict
+        """
+        circuits = self.get_circuits()
+        unknown_circuits = [name for name in intended_values if name not in circuits]
+        if unknown_circuits:
+            return defer.fail(KeyError("Unknown circuit(s): {}".format(", ".join(sorted(unknown_circuits)))))
+        switchings = [
+            self.command_coalescer.submit(name, int(bool(self.human_bool(intended_values[name]))))
+            for name in circuits if name in intended_values
+        ]
+        d = defer.gatherResults(switchings, consumeErrors=True)
+        d.addCallbacks(lambda _pulsed_list: self.check_status(), self._switching_failed)
+        start = self.get_clock().seconds()
+        d.addBoth(self._observe_switch_time, start)
+        return d
+
+    def _observe_switch_time(self, result, start):
+        SWITCH_SECONDS.observe(self.get_clock().seconds() - start)
+        return result
+
+    @staticmethod
+    def _unwrap_first_error(failure):
+        """
+        Passes on the original failure from inside a gatherResults() FirstError
+        """
+        failure.trap(defer.FirstError)
+        return failure.value.subFailure
+
+    def _switching_failed(self, failure):
+        """
+        Measures the status anyway, so clients see what really happened, then passes the original failure on
+        """
+        self.check_status()
+        return self._unwrap_first_error(failure)
+
+    def _switch_circuit(self, name, intended_value):
+        """
+        Coalescer operation: pulses a circuit if need be, then waits for its relay to settle.
+
+        @return: <Deferred> which fires with True if we pulsed
+        """
+        circuit = self.get_circuits()[name]
+        d = self._pulse_lock.run(self._pulse_circuit_if_different, circuit, intended_value)
+        if self.get_confirms_by_edge(circuit[1]):
+            d.addCallback(self._confirm_relay_by_edge, name, circuit[1], intended_value)
+        else:
+            d.addCallback(self._wait_for_relay)
+        return d
+
+    def _pulse_circuit_if_different(self, circuit, value):
+        """
+        Pulses a circuit's toggle pin if it isn't already in the intended state.
+
+        @param circuit: <tuple> (check_func, status_pin, toggle_pin)
+        @param value: The intended status (anything human_bool() understands)
+        @return: <Deferred> which fires with True once pulsed, or False if no pulse was needed
+        """
+        check_func, status_pin, toggle_pin = circuit
+        current_value = check_func()
+        intended_value = self.human_bool(value)
+        d = self.pulse_if_different_non_blocking(current=current_value, intended=intended_value, output_pin=toggle_pin, duration_ms=self._PULSE_DURATION_MS)
+        if DEBUG:
+            self.emulated_readable_pins[status_pin] = intended_value
+        return d
+
+    def _confirm_relay_by_edge(self, pulsed, name, status_pin, intended_value):
+        """
+        Waits for the status pin to show the relay has been thrown, however long that takes up to
+        _RELAY_CONFIRM_TIMEOUT_MS. Fails with RelayConfirmationTimeout if it never does.
+        """
+        if not pulsed:
+            return pulsed
+        start = self.get_clock().seconds()
+        d = self.wait_for_pin_level(status_pin, intended_value, timeout_ms=self._RELAY_CONFIRM_TIMEOUT_MS)
+        d.addCallbacks(self._relay_confirmed, self._relay_confirmation_timed_out, callbackArgs=(pulsed, start), errbackArgs=(name, intended_value))
+        return d
+
+    def _relay_confirmed(self, _level, pulsed, start):
+        RELAY_CONFIRM_SECONDS.observe(self.get_clock().seconds() - start)
+        return pulsed
+
+    def _relay_confirmation_timed_out(self, failure, name, intended_value):
+        failure.trap(PinLevelTimeout)
+        RELAY_CONFIRM_TIMEOUTS.labels(circuit=name).inc()
+        error = RelayConfirmationTimeout(name, intended_value, self._RELAY_CONFIRM_TIMEOUT_MS)
+        logging.warning(str(error))
+        raise error
+
+    def _wait_for_relay(self, pulsed):
+        """
+        Gives the relays time to be thrown. No wait if nothing was pulsed.
+        """
+        if not pulsed:
+            return pulsed
+        return task.deferLater(self.get_clock(), self._RELAY_DELAY_MS/1000.0, lambda: pulsed)
+
+    def set_hw_non_blocking(self, value):
+        """
+        Turns the hot water to the value given without blocking.
+
+        @return: <Deferred> which fires with the measured status dict
+        """
+        return self.set_many_non_blocking({"hw": value})
+
+    def set_ch_non_blocking(self, value):
+        """
+        Turns the central heating to the value given without blocking.
+
+        @return: <Deferred> which fires with the measured status dict
+        """
+        return self.set_many_non_blocking({"ch": value})
+
+    def set_zone_non_blocking(self, name, value):
+        """
+        Turns a zone to the value given without blocking.
+
+        @return: <Deferred> which fires with the measured status dict
+        """
+        return self.set_many_non_blocking({name: value})
+
     def teardown(self):
         """
         Called when exiting the listener. Tear down any async threads here
         """
         logging.info("\tHeatingController {}: exiting...".format(self.__class__.__name__))
+        if self.connection is not None:
+            self.connection.stop()
+        if self.w1_sampler is not None:
+            self.w1_sampler.stop()
+        if self.w1_bus is not None:
+            self.w1_bus.teardown()
+        self.unwatch_pins()
+        self.delete_pulse_scripts()
         if self.iface_temp_humid:
             try:
                 self.iface_temp_humid.teardown()
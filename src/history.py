@@ -0,0 +1,158 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - History
+
+        RingBuffer: a fixed-capacity, in-memory history of readings. Each field (and the timestamps) is one
+        array of doubles, so memory is bounded (8 bytes x (fields + 1) x capacity) however long we run, and
+        appending is O(1): once full, the oldest reading is overwritten.
+
+        Queries binary search for the time range asked for, and walk only that range. Ask for a step and
+        readings are averaged into buckets of that many seconds, so a graph of a week needn't fetch every
+        reading. Missing values are stored as NaN and come back as None.
+"""
+import math
+from array import array
+
+
+NAN = float("nan")
+
+
+class RingBuffer(object):
+    """
+    Timestamped readings of a fixed set of fields, keeping the latest capacity of them
+    """
+
+    def __init__(self, fields, capacity=8640):
+        """
+        @param fields: <iterable> of <str> The field names, e.g. ("temp_c", "humidity")
+        @keyword capacity: <int> How many readings to keep
+        """
+        self.fields = tuple(fields)
+        self.capacity = int(capacity)
+        if self.capacity < 1:
+            raise ValueError("A RingBuffer needs a capacity of at least 1")
+        self.timestamps = array("d", [NAN]) * self.capacity
+        self.columns = {field: array("d", [NAN]) * self.capacity for field in self.fields}
+        self.start = 0  # Where the oldest reading is
+        self.count = 0  # How many readings we have
+
+    def __repr__(self):
+        return "<RingBuffer {} {}/{}>".format(",".join(self.fields), self.count, self.capacity)
+
+    def __len__(self):
+        return self.count
+
+    @property
+    def nbytes(self):
+        return self.timestamps.itemsize * self.capacity * (len(self.fields) + 1)
+
+    @property
+    def last_timestamp(self):
+        if not self.count:
+            return None
+        return self.timestamps[self._index(self.count - 1)]
+
+    def _index(self, position):
+        """
+        @param position: <int> 0 is the oldest reading, count - 1 the newest
+        @return: <int> Where that reading is in the arrays
+        """
+        return (self.start + position) % self.capacity
+
+    def append(self, timestamp, values):
+        """
+        Adds a reading, overwriting the oldest if we're full. Readings must come in time order.
+
+        @param timestamp: <float> Unix time of the reading
+        @param values: <dict> {field: number}. Missing fields or values which aren't numbers are stored as missing.
+        @return: <bool> False if the reading was older than the newest we have, so was ignored
+        """
+        last_timestamp = self.last_timestamp
+        if last_timestamp is not None and timestamp < last_timestamp:
+            return False
+        if self.count < self.capacity:
+            index = self._index(self.count)
+            self.count += 1
+        else:
+            index = self.start
+            self.start = (self.start + 1) % self.capacity
+        self.timestamps[index] = timestamp
+        for field in self.fields:
+            try:
+                self.columns[field][index] = float(values.get(field))
+            except (TypeError, ValueError):
+                self.columns[field][index] = NAN
+        return True
+
+    def bisect(self, timestamp, after=False):
+        """
+        @return: <int> The position of the first reading at or after timestamp (strictly after if after=True)
+        """
+        low, high = 0, self.count
+        while low < high:
+            middle = (low + high) // 2
+            middle_timestamp = self.timestamps[self._index(middle)]
+            if middle_timestamp < timestamp or (after and middle_timestamp == timestamp):
+                low = middle + 1
+            else:
+                high = middle
+        return low
+
+    def query(self, since=None, until=None, step=None, fields=None):
+        """
+        Gets the readings between since and until
+
+        @keyword since: <float> Unix time. Defaults to the oldest reading
+        @keyword until: <float> Unix time. Defaults to the newest reading
+        @keyword step: <float> Average readings into buckets this many seconds wide, each timestamped by
+                       its start. 0 or None for the raw readings
+        @keyword fields: <iterable> of the fields wanted. Defaults to all of them
+        @return: <dict> {"t": [timestamps], field: [values], ...}
+        """
+        fields = [field for field in (fields or self.fields) if field in self.columns]
+        first = self.bisect(since) if since is not None else 0
+        end = self.bisect(until, after=True) if until is not None else self.count
+        if step:
+            return self._query_downsampled(first, end, float(step), fields)
+        out = {"t": [self.timestamps[self._index(position)] for position in range(first, end)]}
+        for field in fields:
+            column = self.columns[field]
+            out[field] = [self._or_none(column[self._index(position)]) for position in range(first, end)]
+        return out
+
+    def _query_downsampled(self, first, end, step, fields):
+        out = {"t": []}
+        for field in fields:
+            out[field] = []
+        bucket = None
+        sums = counts = None
+        for position in range(first, end):
+            index = self._index(position)
+            reading_bucket = math.floor(self.timestamps[index] / step) * step
+            if reading_bucket != bucket:
+                if bucket is not None:
+                    self._emit_bucket(out, bucket, sums, counts, fields)
+                bucket = reading_bucket
+                sums = [0.0] * len(fields)
+                counts = [0] * len(fields)
+            for field_number, field in enumerate(fields):
+                value = self.columns[field][index]
+                if not math.isnan(value):
+                    sums[field_number] += value
+                    counts[field_number] += 1
+        if bucket is not None:
+            self._emit_bucket(out, bucket, sums, counts, fields)
+        return out
+
+    @staticmethod
+    def _emit_bucket(out, bucket, sums, counts, fields):
+        out["t"].append(bucket)
+        for field_number, field in enumerate(fields):
+            count = counts[field_number]
+            out[field].append(round(sums[field_number] / count, 3) if count else None)
+
+    @staticmethod
+    def _or_none(value):
+        return None if math.isnan(value) else value
@@ -0,0 +1,283 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+"""
+    Raspitherm - Metrics
+
+    Low overhead counters, gauges and histograms, rendered in the Prometheus text exposition format
+    for the /metrics endpoint.
+
+        Usage:
+            from src.metrics import REGISTRY
+
+            READ_SECONDS = REGISTRY.histogram("raspitherm_thing_read_seconds", "How long reading the thing takes")
+            with READ_SECONDS.time():
+                read_the_thing()
+
+            @READ_SECONDS.timed
+            def read_the_thing():
+                ...
+
+    Metrics are fetched by name, so asking for the same one twice (e.g. from a module imported under two
+    names) gets you the same object.
+"""
+import functools
+import threading
+from bisect import bisect_left
+from time import perf_counter
+
+
+DEFAULT_LATENCY_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+
+
+def format_value(value):
+    """
+    Formats a number the way Prometheus likes it
+    """
+    if value == float("inf"):
+        return "+Inf"
+    if value == float("-inf"):
+        return "-Inf"
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+def format_labels(labels):
+    """
+    Turns a dict of labels into {name="value",...}
+    """
+    if not labels:
+        return ""
+    return "{" + ",".join(
+        '{}="{}"'.format(name, str(value).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+        for name, value in sorted(labels.items())
+    ) + "}"
+
+
+class Timer(object):
+    """
+    Context manager which observes how long its block took into a histogram
+    """
+
+    def __init__(self, histogram):
+        self.histogram = histogram
+        self.start = None
+
+    def __enter__(self):
+        self.start = perf_counter()
+        return self
+
+    def __exit__(self, exc_type, exc_val, exc_tb):
+        self.histogram.observe(perf_counter() - self.start)
+        return False
+
+
+class Metric(object):
+    """
+    Base for all metrics. Metrics with labels hand out a child per label combination via labels().
+    """
+    metric_type = "untyped"
+
+    def __init__(self, name, documentation="", labels=None):
+        self.name = name
+        self.documentation = documentation
+        self.label_values = labels or {}
+        self._lock = threading.Lock()  # Sensors are read in threads
+        self._children = {}
+
+    def labels(self, **labels):
+        """
+        Returns the child metric for the label values given
+        """
+        key = tuple(sorted(labels.items()))
+        try:
+            return self._children[key]
+        except KeyError:
+            with self._lock:
+                child = self._children.get(key)
+                if child is None:
+                    child = self.__class__(self.name, self.documentation, labels=labels, **self._child_kwargs())
+                    self._children[key] = child
+            return child
+
+    def _child_kwargs(self):
+        return {}
+
+    def get_children(self):
+        """
+        Metrics with labels only expose their children. Those without expose themselves.
+        """
+        if self._children:
+            return list(self._children.values())
+        return [self]
+
+    def render_samples(self):
+        raise NotImplementedError
+
+    def render(self):
+        lines = [
+            "# HELP {} {}".format(self.name, self.documentation.replace("\\", "\\\\").replace("\n", "\\n")),
+            "# TYPE {} {}".format(self.name, self.metric_type),
+        ]
+        for child in self.get_children():
+            lines.extend(child.render_samples())
+        return lines
+
+
+class Counter(Metric):
+    """
+    A number which only ever goes up. By convention, name it with a _total suffix.
+    """
+    metric_type = "counter"
+
+    def __init__(self, *args, **kwargs):
+        super(Counter, self).__init__(*args, **kwargs)
+        self.value = 0
+
+    def inc(self, amount=1):
+        with self._lock:
+            self.value += amount
+
+    def render_samples(self):
+        return ["{}{} {}".format(self.name, format_labels(self.label_values), format_value(self.value))]
+
+
+class Gauge(Metric):
+    """
+    A number which can go up and down. Give it a callback to have it read its value at scrape time.
+    """
+    metric_type = "gauge"
+
+    def __init__(self, *args, **kwargs):
+        self.callback = kwargs.pop("callback", None)
+        super(Gauge, self).__init__(*args, **kwargs)
+        self.value = 0
+
+    def _child_kwargs(self):
+        return {"callback": None}
+
+    def set(self, value):
+        self.value = value
+
+    def set_callback(self, callback):
+        """
+        @param callback: <callable> returning the gauge's current value
+        """
+        self.callback = callback
+
+    def get_value(self):
+        if self.callback is not None:
+            try:
+                return self.callback()
+            except Exception:
+                return float("nan")
+        return self.value
+
+    def render_samples(self):
+        value = self.get_value()
+        if value is None:
+            return []
+        return ["{}{} {}".format(self.name, format_labels(self.label_values), format_value(value))]
+
+
+class Histogram(Metric):
+    """
+    Counts observations into cumulative buckets, e.g. latencies
+    """
+    metric_type = "histogram"
+
+    def __init__(self, *args, **kwargs):
+        self.buckets = tuple(sorted(kwargs.pop("buckets", None) or DEFAULT_LATENCY_BUCKETS))
+        super(Histogram, self).__init__(*args, **kwargs)
+        self.bucket_counts = [0] * (len(self.buckets) + 1)  # Last one is +Inf
+        self.sum = 0.0
+        self.count = 0
+
+    def _child_kwargs(self):
+        return {"buckets": self.buckets}
+
+    def observe(self, value):
+        index = bisect_left(self.buckets, value)
+        with self._lock:
+            self.bucket_counts[index] += 1
+            self.sum += value
+            self.count += 1
+
+    def time(self):
+        """
+        Returns a context manager which times its block into this histogram
+        """
+        return Timer(self)
+
+    def timed(self, func):
+        """
+        Decorator which times every call of func into this histogram
+        """
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            start = perf_counter()
+            try:
+                return func(*args, **kwargs)
+            finally:
+                self.observe(perf_counter() - start)
+        return wrapper
+
+    def render_samples(self):
+        with self._lock:
+            bucket_counts = list(self.bucket_counts)
+            total = self.sum
+            count = self.count
+        lines = []
+        cumulative_count = 0
+        for upper_bound, bucket_count in zip(self.buckets + (float("inf"),), bucket_counts):
+            cumulative_count += bucket_count
+            labels = dict(self.label_values, le=format_value(float(upper_bound)))
+            lines.append("{}_bucket{} {}".format(self.name, format_labels(labels), cumulative_count))
+        lines.append("{}_sum{} {}".format(self.name, format_labels(self.label_values), format_value(total)))
+        lines.append("{}_count{} {}".format(self.name, format_labels(self.label_values), count))
+        return lines
+
+
+class MetricsRegistry(object):
+    """
+    Holds all our metrics, and renders them for /metrics
+    """
+
+    def __init__(self):
+        self.metrics = {}
+        self._lock = threading.Lock()
+
+    def _get_or_create(self, metric_class, name, documentation, **kwargs):
+        with self._lock:
+            metric = self.metrics.get(name)
+            if metric is None:
+                metric = metric_class(name, documentation, **kwargs)
+                self.metrics[name] = metric
+            elif not isinstance(metric, metric_class):
+                raise ValueError("Metric {} is already registered as a {}".format(name, metric.metric_type))
+        return metric
+
+    def counter(self, name, documentation=""):
+        return self._get_or_create(Counter, name, documentation)
+
+    def gauge(self, name, documentation="", callback=None):
+        gauge = self._get_or_create(Gauge, name, documentation)
+        if callback is not None:
+            gauge.set_callback(callback)
+        return gauge
+
+    def histogram(self, name, documentation="", buckets=None):
+        return self._get_or_create(Histogram, name, documentation, buckets=buckets)
+
+    def render(self):
+        """
+        Renders every metric in the text exposition format
+        """
+        lines = []
+        for name in sorted(self.metrics):
+            lines.extend(self.metrics[name].render())
+        lines.append("")
+        return "\n".join(lines)
+
+
+REGISTRY = MetricsRegistry()  # The one everything reports to
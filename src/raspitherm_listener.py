@@ -15,9 +15,12 @@
     
         @requires: twisted
 """
+import math
 import sys
 import os
+from collections import deque
 from decimal import Decimal
+from time import perf_counter
 
 import simplejson as simplejson
 import six
@@ -26,8 +29,11 @@ import six
 my_dir = os.path.dirname(os.path.realpath(__file__)) #The directory we're running in
 sys.path.append(os.path.dirname(my_dir))  # Parent dir
 
-from src.config import RASPILED_DIR, get_setting, CONFIG_SETTINGS, DEBUG
-from src.utils import SmartRequest, get_matching_pids, D
+from src.config import RASPILED_DIR, get_setting, CONFIG_SETTINGS, ZONE_SETTINGS, PROBE_SETTINGS, DEBUG
+from src.metrics import REGISTRY
+from src.registry import PersistentRegistry, VersionedRegistry
+from src.rollups import RollupStore
+from src.utils import SmartRequest, TemplateCache, get_matching_pids, D
 
 try:
     #python2
@@ -37,12 +43,18 @@ except ImportError:
     from urllib.parse import urlencode
 import logging
 
-from twisted.internet import reactor, endpoints, protocol, task
+from twisted.internet import reactor, endpoints, protocol, task, defer
 from twisted.web.resource import Resource
-from twisted.web.server import Site, Request
+from twisted.web.http import CACHED
+from twisted.web.server import Site, Request, NOT_DONE_YET
 from twisted.web.static import File
 
-from heating_controller import HeatingController
+from heating_controller import HeatingController, RelayConfirmationTimeout
+
+try:
+    from status_websocket import build_status_websocket_resource
+except ImportError:  # autobahn not installed. No WebSocket push channel, but everything else works.
+    build_status_websocket_resource = None
 
 
 if DEBUG:
@@ -51,6 +63,348 @@ if DEBUG:
 APP_NAME = "python ./raspitherm_listener.py"
 
 SENSOR_POLLING_PERIOD_SECONDS = get_setting("sensor_polling_period_seconds", 60)
+STATUS_POLLING_PERIOD_SECONDS = get_setting("status_polling_period_seconds", 10)
+
+HTTP_REQUEST_SECONDS = REGISTRY.histogram("raspitherm_http_request_seconds", "Time taken to answer requests to the control page / API, by action")
+REACTOR_LAG_SECONDS = REGISTRY.histogram("raspitherm_reactor_lag_seconds", "How late a 1 second reactor timer fires. High values mean something is blocking the reactor")
+
+
+def render_json(payload):
+    """
+    Encodes payload as the body of a JSON response
+    """
+    return simplejson.dumps(payload).encode("utf-8")
+
+
+def get_finite_param(request, name, default=None):
+    """
+    Gets a querystring param which has to be a single, finite number
+
+    @return: <float> The value, or default if the param wasn't given
+    @raise ValueError: if it was given, but isn't a single finite number (NaN and infinity are refused)
+    """
+    if not request.has_param(name):
+        return default
+    value = request.get_param(name, force=float)
+    if not isinstance(value, float) or not math.isfinite(value):
+        raise ValueError("{} must be a single finite number".format(name))
+    return value
+
+
+class MetricsResource(Resource):
+    """
+    /metrics - all our counters and histograms in the Prometheus text exposition format
+    """
+    isLeaf = True
+
+    def __init__(self, registry=REGISTRY, *args, **kwargs):
+        Resource.__init__(self, *args, **kwargs)
+        self.metrics_registry = registry
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        return self.metrics_registry.render().encode("utf-8")
+
+
+class ReactorLagMonitor(object):
+    """
+    Measures how late a regular timer fires. If anything blocks the reactor thread, this is where it shows up.
+    """
+    PERIOD_SECONDS = 1.0
+
+    def __init__(self, clock=None):
+        self.clock = clock or reactor
+        self._loop = None
+        self._expected_at = None
+
+    def tick(self):
+        now = self.clock.seconds()
+        if self._expected_at is not None:
+            REACTOR_LAG_SECONDS.observe(max(now - self._expected_at, 0.0))
+        self._expected_at = now + self.PERIOD_SECONDS
+
+    def start(self):
+        self._loop = task.LoopingCall(self.tick)
+        self._loop.clock = self.clock
+        self._loop.start(self.PERIOD_SECONDS)
+        return self._loop
+
+
+class StatusEventBroadcaster(object):
+    """
+    Fans heating state changes out to any number of Server-Sent Events subscribers. Each change is
+    encoded once, as a compact delta of hw, ch, th and hw_temp, and the same bytes are written to
+    every subscriber.
+    """
+    KEEPALIVE_SECONDS = 15  # Comment lines sent to stop proxies and browsers from dropping idle streams
+    HISTORY_LENGTH = 64  # How many events we keep for Last-Event-ID resume
+    RETRY_MS = 5000  # How long browsers should wait before reconnecting
+
+    def __init__(self, heating_controller, clock=None):
+        self.heating_controller = heating_controller
+        self.clock = clock or reactor
+        self.subscribers = set()
+        self.delta_listeners = []  # Callables told about every delta, e.g. the WebSocket push channel
+        self.history = deque()  # (version, encoded event bytes)
+        snapshot = heating_controller.get_status_snapshot()
+        self.history_start_version = snapshot.version  # We can resume anyone who has seen this version or later
+        self.last_compact_status = heating_controller.compact_status(snapshot.data)
+        self._keepalive_loop = None
+        heating_controller.add_status_listener(self.on_status_change)
+
+    def get_event_id(self, version):
+        """
+        Event IDs carry the controller's epoch, so IDs from before a restart are never mistaken for current ones
+        """
+        return "{:x}-{}".format(self.heating_controller.status_epoch, version)
+
+    def parse_event_id(self, event_id):
+        """
+        Returns the snapshot version from an event ID, or None if it is garbled or from a previous run
+        """
+        if isinstance(event_id, bytes):
+            event_id = event_id.decode("utf-8", "ignore")
+        try:
+            epoch_str, version_str = event_id.strip().split("-", 1)
+            if int(epoch_str, 16) != self.heating_controller.status_epoch:
+                return None
+            return int(version_str)
+        except (AttributeError, ValueError):
+            return None
+
+    def encode_event(self, version, event_name, payload):
+        """
+        Encodes an event in the text/event-stream format
+        """
+        return "id: {}\nevent: {}\ndata: {}\n\n".format(
+            self.get_event_id(version), event_name, simplejson.dumps(payload, separators=(",", ":"))
+        ).encode("utf-8")
+
+    def on_status_change(self, snapshot, previous_snapshot=None):
+        """
+        Status listener: broadcasts whichever of hw, ch, th and hw_temp have changed
+        """
+        compact_status = self.heating_controller.compact_status(snapshot.data)
+        delta = {
+            key: value for key, value in compact_status.items()
+            if self.last_compact_status.get(key) != value
+        }
+        self.last_compact_status = compact_status
+        if not delta:
+            return None
+        event = self.encode_event(snapshot.version, "delta", delta)
+        self.history.append((snapshot.version, event))
+        if len(self.history) > self.HISTORY_LENGTH:
+            self.history_start_version = self.history.popleft()[0]
+        self.broadcast(event)
+        for listener in list(self.delta_listeners):
+            try:
+                listener(snapshot.version, delta)
+            except Exception as e:
+                logging.exception("Delta listener {} failed: {}".format(listener, e))
+        return event
+
+    def add_delta_listener(self, listener):
+        """
+        Registers a callable to be told about every delta, called with (version, delta_dict)
+        """
+        if listener not in self.delta_listeners:
+            self.delta_listeners.append(listener)
+        return listener
+
+    def remove_delta_listener(self, listener):
+        try:
+            self.delta_listeners.remove(listener)
+        except ValueError:
+            pass
+
+    def get_replay_events(self, last_event_id=None):
+        """
+        Works out what a (re)connecting subscriber needs to catch up: the deltas they missed if we still
+        have them all, otherwise the full current state.
+        """
+        snapshot = self.heating_controller.get_status_snapshot()
+        last_version = self.parse_event_id(last_event_id) if last_event_id else None
+        if last_version is not None and self.history_start_version <= last_version <= snapshot.version:
+            return [event for version, event in self.history if version > last_version]
+        return [self.encode_event(snapshot.version, "state", self.last_compact_status)]
+
+    def subscribe(self, request, last_event_id=None):
+        """
+        Adds a streaming request to the fan-out, catching it up first
+        """
+        request.write("retry: {}\n\n".format(self.RETRY_MS).encode("utf-8"))
+        for event in self.get_replay_events(last_event_id):
+            request.write(event)
+        self.subscribers.add(request)
+        request.notifyFinish().addBoth(self._on_subscriber_finished, request)
+        self.start_keepalive()
+
+    def unsubscribe(self, request):
+        """
+        Removes a request from the fan-out
+        """
+        self.subscribers.discard(request)
+        if not self.subscribers:
+            self.stop_keepalive()
+
+    def _on_subscriber_finished(self, _result, request):
+        self.unsubscribe(request)
+
+    def broadcast(self, data):
+        """
+        Writes the same bytes to every subscriber
+        """
+        for request in list(self.subscribers):
+            if request.finished or request._disconnected:
+                self.unsubscribe(request)
+                continue
+            request.write(data)
+
+    def send_keepalive(self):
+        self.broadcast(b": keepalive\n\n")
+
+    def start_keepalive(self):
+        if self._keepalive_loop is None or not self._keepalive_loop.running:
+            self._keepalive_loop = task.LoopingCall(self.send_keepalive)
+            self._keepalive_loop.clock = self.clock
+            self._keepalive_loop.start(self.KEEPALIVE_SECONDS, now=False)
+
+    def stop_keepalive(self):
+        if self._keepalive_loop is not None and self._keepalive_loop.running:
+            self._keepalive_loop.stop()
+        self._keepalive_loop = None
+
+    def teardown(self):
+        """
+        Closes all the streams
+        """
+        self.stop_keepalive()
+        self.heating_controller.remove_status_listener(self.on_status_change)
+        for request in list(self.subscribers):
+            self.subscribers.discard(request)
+            if not (request.finished or request._disconnected):
+                request.finish()
+
+
+class StatusEventsResource(Resource):
+    """
+    /events - a Server-Sent Events stream of heating state changes.
+    Resume after a dropped connection with the Last-Event-ID header (or ?last_event_id=).
+    """
+    isLeaf = True
+
+    def __init__(self, broadcaster, *args, **kwargs):
+        Resource.__init__(self, *args, **kwargs)
+        self.broadcaster = broadcaster
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "text/event-stream; charset=utf-8")
+        request.setHeader("Cache-Control", "no-cache")
+        request.setHeader("X-Accel-Buffering", "no")  # Stop nginx from buffering the stream
+        last_event_id = request.getHeader("Last-Event-ID") or request.get_param("last_event_id", force=str)
+        self.broadcaster.subscribe(request, last_event_id=last_event_id)
+        return NOT_DONE_YET
+
+
+class ZoneResource(Resource):
+    """
+    /zone/<name> - one heating zone's status as JSON. Switch it with ?set=on or ?set=off.
+    /zone/ - all the zones' statuses.
+    """
+    isLeaf = True
+
+    def __init__(self, heating_controller, *args, **kwargs):
+        Resource.__init__(self, *args, **kwargs)
+        self.heating_controller = heating_controller
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        zone_name = request.postpath[0].decode("utf-8") if request.postpath and request.postpath[0] else None
+        if zone_name is None:
+            return render_json({name: zone.as_dict() for name, zone in self.heating_controller.zones.items()})
+        zone = self.heating_controller.get_zone(zone_name)
+        if zone is None:
+            request.setResponseCode(404)
+            return render_json({"error": "No such zone: {}".format(zone_name)})
+        if not request.has_param("set"):
+            return render_json(zone.as_dict())
+        intended_status = request.get_param("set", force=str)
+        d = self.heating_controller.set_zone_non_blocking(zone_name, intended_status)
+        d.addCallback(RaspithermControlResource._log_outcome, "Turn zone " + zone_name + " {}, status now: {}", intended_status)
+        d.addCallbacks(self._render_switched_zone, self._render_error, callbackArgs=(request, zone), errbackArgs=(request,))
+        return NOT_DONE_YET
+
+    def _render_switched_zone(self, _status, request, zone):
+        request.write_and_finish(render_json(zone.as_dict()))
+
+    def _render_error(self, failure, request):
+        logging.error("Zone switch failed: {}".format(failure.getErrorMessage()))
+        if not (request.finished or request._disconnected):
+            request.setResponseCode(504 if failure.check(RelayConfirmationTimeout) else 500)  # 504: the hardware didn't respond
+        request.write_and_finish(render_json({"error": "{} - {}".format(failure.type.__name__, failure.getErrorMessage())}))
+
+
+class HistoryResource(Resource):
+    """
+    /history - recent readings as JSON time series:
+        {"th": {"t": [unix times], "temp_c": [...], "humidity": [...]}, "hw_temp": {...}, "heating": {"t": [...], "hw": [...], "ch": [...]}}
+
+    ?since= and ?until= limit the time range (unix times, or negative for seconds ago). ?step=300 averages
+    the readings into 5 minute buckets. ?series=th,heating picks which histories you get.
+
+    ?resolution=raw|1m|15m|1h gets the long-term history from the rollup store instead. Rollups have
+    <field>_min and <field>_max series as well as the mean. Each resolution is its own step, so it can't
+    be combined with ?step=.
+
+    Params which aren't single finite numbers get a 400, as does a step shorter than MIN_STEP_SECONDS.
+    """
+    isLeaf = True
+    MIN_STEP_SECONDS = 1.0  # Finer steps than this are no use, and tiny ones overflow the bucketing
+
+    def __init__(self, heating_controller, clock=None, *args, **kwargs):
+        Resource.__init__(self, *args, **kwargs)
+        self.heating_controller = heating_controller
+        self.clock = clock or reactor
+
+    def render_GET(self, request):
+        request.setHeader("Content-Type", "application/json")
+        now = self.clock.seconds()
+        try:
+            since = get_finite_param(request, "since")
+            until = get_finite_param(request, "until")
+            step = get_finite_param(request, "step", default=0.0)
+            if step < 0:
+                raise ValueError("step must be a number of seconds")
+            if 0 < step < self.MIN_STEP_SECONDS:
+                raise ValueError("step must be 0 (no averaging) or at least {:g}s".format(self.MIN_STEP_SECONDS))
+        except ValueError as e:
+            request.setResponseCode(400)
+            return render_json({"error": str(e)})
+        if since is not None and since < 0:
+            since += now
+        if until is not None and until < 0:
+            until += now
+        histories = self.heating_controller.histories or {}
+        series = request.get_param("series", force=str)
+        names = [name for name in series.split(",") if name in histories] if series else list(histories)
+        resolution = request.get_param("resolution", force=str)
+        if resolution:
+            rollups = self.heating_controller.rollups
+            if rollups is None or resolution not in rollups.RESOLUTIONS:
+                request.setResponseCode(400 if rollups is not None else 404)
+                return render_json({"error": "No {} rollups. Choose from {}".format(resolution, ", ".join(rollups.RESOLUTIONS) if rollups is not None else "nothing: rollup_path is not set")})
+            if step:
+                request.setResponseCode(400)
+                return render_json({"error": "step can't be used with resolution: each resolution has its own step"})
+            try:
+                out = {name: rollups.query(name, resolution, since=since, until=until) for name in names}
+            except ValueError as e:
+                request.setResponseCode(400)
+                return render_json({"error": str(e)})
+            return render_json({name: data for name, data in out.items() if data is not None})
+        out = {name: histories[name].query(since=since, until=until, step=step) for name in names}
+        return render_json(out)
 
 
 class RaspithermControlResource(Resource):
@@ -59,26 +413,62 @@ class RaspithermControlResource(Resource):
     """
     isLeaf = False #Allows us to go into dirs
     heating_controller = None #Populated at init
+    html_template = None  # TemplateCache of templates/index.html, populated at init
+    status_events = None  # StatusEventBroadcaster feeding /events, populated at init
+    status_websocket = None  # StatusWebSocketFactory behind /ws, populated at init if autobahn is installed
+    _status_json_cache = (None, None)  # (ETag, encoded JSON) for the latest status snapshot
     PARAM_TO_ACTION_MAPPING = (
         ("ch", "ch"),
         ("hw", "hw"),
+        ("target_temperature", "target_temperature"),
         ("status", "status"),
     )
+    CACHEABLE_ACTIONS = ("status",)  # Actions which don't change anything, so can be answered with a 304
+    BATCHABLE_PARAMS = ("hw", "ch")  # Circuits which can be switched together in one request
     
     def __init__(self, registry=None, *args, **kwargs):
         """
+        @keyword config: <dict> Settings to build the HeatingController with. Defaults to the config file's.
+        @keyword zones: <dict> Extra heating zones to control. Defaults to the config file's [zone:<name>] sections.
+        @keyword probes: <dict> Named DS18B20 probes to read. Defaults to the config file's [probe:<role>] sections.
+        @keyword rollups: <RollupStore> Where to keep the long-term history, if anywhere
+
         @TODO: perform LAN discovery, interrogate the resources, generate controls for all of them
         """
+        config = kwargs.pop("config", None) or CONFIG_SETTINGS
+        zones = kwargs.pop("zones", ZONE_SETTINGS)
+        probes = kwargs.pop("probes", PROBE_SETTINGS)
+        rollups = kwargs.pop("rollups", None)
         if registry is None:
-            self.__class__.registry = {}   # Class-wide storage if not already init'd
+            self.__class__.registry = VersionedRegistry()   # Class-wide storage if not already init'd
             registry = self.__class__.registry
+        elif not isinstance(registry, VersionedRegistry):
+            registry = VersionedRegistry(store=registry)
         self.registry = registry
         self.emulated_readable_pins = kwargs.pop("emulated_readable_pins", None) or {}  # You can pass in a shared dict so vars can be shared across states
-        self.heating_controller = HeatingController(CONFIG_SETTINGS, emulated_readable_pins=self.emulated_readable_pins, registry=registry)
+        self.heating_controller = HeatingController(config, emulated_readable_pins=self.emulated_readable_pins, registry=registry, zones=zones, rollups=rollups, probes=probes)
+        self.html_template = TemplateCache(os.path.join(RASPILED_DIR, "templates", "index.html"))
         Resource.__init__(self, *args, **kwargs) #Super
         #Add in the static folder
         static_folder = os.path.join(RASPILED_DIR, "static")
         self.putChild(b"static", File(static_folder))  # Path must be a bytestring!
+        #Add in the Server-Sent Events stream
+        self.status_events = StatusEventBroadcaster(self.heating_controller)
+        self.putChild(b"events", StatusEventsResource(self.status_events))
+        #Add in the per-zone API
+        self.putChild(b"zone", ZoneResource(self.heating_controller))
+        self.putChild(b"history", HistoryResource(self.heating_controller))
+        #Add in the metrics
+        self.putChild(b"metrics", MetricsResource())
+        REGISTRY.gauge("raspitherm_status_snapshot_age_seconds", "Age of the status snapshot served to requests", callback=self.get_status_snapshot_age)
+        REGISTRY.gauge("raspitherm_sse_subscribers", "Clients connected to /events", callback=lambda: len(self.status_events.subscribers))
+        #Add in the WebSocket push channel
+        if build_status_websocket_resource is not None:
+            websocket_resource, self.status_websocket = build_status_websocket_resource(self.heating_controller, self.status_events)
+            self.putChild(b"ws", websocket_resource)
+            REGISTRY.gauge("raspitherm_websocket_clients", "Clients connected to /ws", callback=lambda: len(self.status_websocket.clients))
+        else:
+            logging.warning("autobahn is not installed: WebSocket push channel (/ws) disabled.")
     
     def getChild(self, path, request, *args, **kwargs):
         """
@@ -108,20 +498,128 @@ class RaspithermControlResource(Resource):
         """
         Responds to GET requests
         """
+        start = perf_counter()
         _action_result = None
         
         #Look through the actions if the request key exists, perform that action
         return_json = False
-        for key_name, action_name in self.PARAM_TO_ACTION_MAPPING:
-            if request.has_param(key_name):
-                action_func_name = "action__%s" % action_name
-                _action_result = getattr(self, action_func_name)(request) #Execute that function
-                return_json = True
-                break
+        cacheable = True
+        action_label = "html"  # For metrics
+        batch_key_names = [key_name for key_name in self.BATCHABLE_PARAMS if request.has_param(key_name)]
+        if len(batch_key_names) > 1:  # e.g. /?hw=on&ch=on - switch them all in one go
+            _action_result = self.action__batch(request, batch_key_names)
+            return_json = True
+            cacheable = False
+            action_label = "batch"
+        else:
+            for key_name, action_name in self.PARAM_TO_ACTION_MAPPING:
+                if request.has_param(key_name):
+                    action_func_name = "action__%s" % action_name
+                    _action_result = getattr(self, action_func_name)(request) #Execute that function
+                    return_json = True
+                    cacheable = action_name in self.CACHEABLE_ACTIONS
+                    action_label = action_name
+                    break
+
+        # Slow actions (e.g. throwing relays) hand back a Deferred. Respond once it fires:
+        if isinstance(_action_result, defer.Deferred):
+            _action_result.addCallback(self._render_deferred_result, request, return_json)
+            _action_result.addErrback(self._render_deferred_error, request)
+            request.notifyFinish().addBoth(self._observe_request_time, action_label, start)
+            return NOT_DONE_YET
+        response = self.render_status(request, _action_result, return_json, cacheable=cacheable)
+        self._observe_request_time(None, action_label, start)
+        return response
+
+    @staticmethod
+    def _observe_request_time(_result, action_label, start):
+        HTTP_REQUEST_SECONDS.labels(action=action_label).observe(perf_counter() - start)
+
+    def _render_deferred_result(self, action_result, request, return_json):
+        """
+        Writes out the response once a deferred action has completed
+        """
+        request.write_and_finish(self.render_status(request, action_result, return_json))
+
+    def _render_deferred_error(self, failure, request):
+        """
+        Writes out an error response if a deferred action fails
+        """
+        logging.error("Deferred action failed: {}".format(failure.getErrorMessage()))
+        err_msg = "Error: {} - {}".format(failure.type.__name__, failure.getErrorMessage())
+        if not (request.finished or request._disconnected):
+            if failure.check(RelayConfirmationTimeout):
+                request.setResponseCode(504)  # The hardware didn't respond
+            elif failure.check(ValueError):
+                request.setResponseCode(400)  # A parameter we can't make sense of
+            else:
+                request.setResponseCode(500)
+        request.write_and_finish(err_msg.encode("utf-8"))
+
+    def render_status(self, request, _action_result=None, return_json=False, cacheable=False):
+        """
+        Renders the current status as JSON or as the HTML page
+
+        @keyword cacheable: <bool> If True, a JSON client sending a matching If-None-Match gets an empty 304
+        """
+        #Read our statuses from the latest snapshot (refreshed in the background):
+        snapshot = self.get_status_snapshot(request)
+        self.set_w1_age_header(request)
+
+        # JSON action - Return a JSON object if a result:
+        if _action_result is not None or return_json:
+            return self.render_status_json(request, snapshot, cacheable=cacheable)
         
-        #Read our statuses:
-        self.heating_controller.check_status()  # Actually reads from the pins and updates internal vars
-        if self.heating_controller.hw:
+        # HTML output - Return normal page
+        request.setHeader("Content-Type", "text/html; charset=utf-8")
+        context_dict = self.build_context_dict(snapshot.data, html=True)
+        return self.html_template.render(context_dict).encode('utf-8')
+
+    def set_w1_age_header(self, request):
+        """
+        Says how old the DS18B20 readings are, in seconds. It's worked out per response rather than kept in
+        the status, which would otherwise change (and bump the ETag) with every sample.
+        """
+        w1_sampler = self.heating_controller.w1_sampler
+        age_seconds = w1_sampler.get_age_seconds() if w1_sampler is not None else None
+        if age_seconds is not None:
+            request.setHeader("X-W1-Age", "{:.1f}".format(age_seconds))
+
+    def get_status_etag(self, snapshot):
+        """
+        Returns a strong ETag for the given status snapshot. Unique across restarts thanks to the controller's epoch.
+        """
+        return '"{:x}-{}"'.format(self.heating_controller.status_epoch, snapshot.version)
+
+    def render_status_json(self, request, snapshot, cacheable=False):
+        """
+        Renders the status snapshot as JSON. The encoded bytes are cached against the snapshot's version,
+        and clients already holding the current version get an empty 304.
+        """
+        etag = self.get_status_etag(snapshot)
+        if cacheable:
+            if request.setETag(etag.encode("utf-8")) is CACHED:
+                return b""
+        else:
+            request.setHeader("ETag", etag)
+        cached_etag, cached_json = self._status_json_cache
+        if cached_etag == etag:
+            return cached_json
+        try:
+            status_json = bytes(simplejson.dumps(self.build_context_dict(snapshot.data)), encoding="utf-8", errors="ignore")
+        except Exception as e:
+            err_msg = "Error: {} - {}".format(e.__class__.__name__, e)
+            return err_msg.encode("utf-8")
+        self._status_json_cache = (etag, status_json)
+        return status_json
+
+    def build_context_dict(self, status, html=False):
+        """
+        Turns a status dict into the context dict which is common to both JS and html
+
+        @keyword html: <bool> If True, includes the extra items only the HTML template needs
+        """
+        if status.get("hw"):
             hw_status = "on"
             hw_status_js = 1
             hw_checked_attr = ' checked="checked"'
@@ -129,7 +627,7 @@ class RaspithermControlResource(Resource):
             hw_status = "off"
             hw_status_js = 0
             hw_checked_attr = ""
-        if self.heating_controller.ch:
+        if status.get("ch"):
             ch_status = "on"
             ch_status_js = 1
             ch_checked_attr = ' checked="checked"'
@@ -139,7 +637,7 @@ class RaspithermControlResource(Resource):
             ch_checked_attr = ""
 
         # Temperature and humidity...
-        th = self.heating_controller.check_th()
+        th = status.get("th")
         try:
             th_temp_c = th["temp_c"]
             th_temp_f = th["temp_f"]
@@ -171,7 +669,7 @@ class RaspithermControlResource(Resource):
                 th_humidity_readable = "??"
 
         # Hot water temperature
-        hw_temp = self.heating_controller.check_hw_temp()
+        hw_temp = status.get("hw_temp")
         try:
             hw_temp_c = hw_temp["temp_c"]
         except (KeyError, AttributeError, TypeError):
@@ -187,8 +685,8 @@ class RaspithermControlResource(Resource):
             except (TypeError, ValueError):
                 hw_temp_c_readable = "??"
 
-        # Read our latest temperature target:
-        target_temperature = self.heating_controller.get_data("target_temperature", default=None)
+        # Our latest temperature target:
+        target_temperature = status.get("target_temperature")
         try:
             target_temperature_readable = "{:.0f}".format(Decimal(target_temperature))
         except (ValueError, TypeError):
@@ -212,77 +710,98 @@ class RaspithermControlResource(Resource):
             "hw_temp_available": hw_temp_available,
             "hw_temp_c_readable": six.text_type(hw_temp_c_readable),
             "hw_temp_c": six.text_type(hw_temp_c),
+            "w1": status.get("w1"),
             "target_temperature": target_temperature,
+            "zones": status.get("zones") or {},
+            "probes": status.get("probes") or {},
+            "thermostat": status.get("thermostat"),
+            "pigpio": status.get("pigpio"),
+            "th_sensor": status.get("th_sensor"),
             "target_temperature_readable": target_temperature_readable,
             "debug": int(DEBUG)
         }
-
-        # JSON action - Return a JSON object if a result:
-        if _action_result is not None or return_json:
-            try:
-                return bytes(simplejson.dumps(context_dict), encoding="utf-8", errors="ignore")
-            except Exception as e:
-                err_msg = "Error: {} - {}".format(e.__class__.__name__, e)
-                return err_msg.encode("utf-8")
-        
-        # HTML output - Return normal page
-        request.setHeader("Content-Type", "text/html; charset=utf-8")
-        with open(RASPILED_DIR+'/templates/index.html', "r") as web_template:
-            htmlstr = web_template.read()  # Reads en bloc. More preferable to line by line concatenation
-        context_dict.update(
-            hw_checked_attr=hw_checked_attr,
-            ch_checked_attr=ch_checked_attr,
-            th_style=th_style,
-            hw_temp_style=hw_temp_style
-        )
-        return htmlstr.format(
-                hw_status=hw_status,
-                hw_status_js=hw_status_js,
-                ch_status=ch_status,
-                ch_status_js=ch_status_js,
+        if html:
+            context_dict.update(
                 hw_checked_attr=hw_checked_attr,
                 ch_checked_attr=ch_checked_attr,
-                th_available=th_available,
                 th_style=th_style,
-                th_temp_c=th_temp_c,
-                th_humidity=th_humidity,
-                th_temp_c_readable=th_temp_c_readable,
-                th_humidity_readable=th_humidity_readable,
-                hw_temp_available=hw_temp_available,
-                hw_temp_style=hw_temp_style,
-                hw_temp_c=hw_temp_c,
-                hw_temp_c_readable=hw_temp_c_readable,
-                target_temperature=target_temperature,
-                target_temperature_readable=target_temperature_readable,
-            ).encode('utf-8')
+                hw_temp_style=hw_temp_style
+            )
+        return context_dict
     
     def action__hw(self, request):
         """
         Run when user wants to set the heating on or off
         """
         intended_status = request.get_param("hw", force=str)
-        outcome = self.heating_controller.set_hw(intended_status)
-        logging.info("Turn hot water {}, status now: {}".format(intended_status, outcome))
-        return outcome
+        d = self.heating_controller.set_hw_non_blocking(intended_status)
+        d.addCallback(self._log_outcome, "Turn hot water {}, status now: {}", intended_status)
+        return d
     
     def action__ch(self, request):
         """
         Run when user wants to set the central heating on or off
         """
         intended_status = request.get_param("ch", force=str)
-        outcome = self.heating_controller.set_ch(intended_status)
-        logging.info("Turn central heating {}, status now: {}".format(intended_status, outcome))
+        d = self.heating_controller.set_ch_non_blocking(intended_status)
+        d.addCallback(self._log_outcome, "Turn central heating {}, status now: {}", intended_status)
+        return d
+
+    def action__batch(self, request, key_names):
+        """
+        Run when user wants to switch several circuits in one request, e.g. /?hw=on&ch=on
+        """
+        intended_values = {key_name: request.get_param(key_name, force=str) for key_name in key_names}
+        d = self.heating_controller.set_many_non_blocking(intended_values)
+        d.addCallback(self._log_outcome, "Switch {}, status now: {}", intended_values)
+        return d
+
+    @staticmethod
+    def _log_outcome(outcome, message, intended_status):
+        """
+        Logs the outcome of a deferred action, passing the outcome on down the callback chain
+        """
+        logging.info(message.format(intended_status, outcome))
         return outcome
 
+    def action__target_temperature(self, request):
+        """
+        Run when user sets the temperature the thermostat should hold, e.g. /?target_temperature=20.
+        /?target_temperature=off hands the central heating back to manual control.
+        """
+        intended_target = request.get_param("target_temperature", force=str)
+        try:
+            target = self.heating_controller.set_target_temperature(intended_target)
+        except ValueError:
+            return defer.fail(ValueError("target_temperature must be a number or off, not {}".format(intended_target)))
+        logging.info("Target temperature now: {}".format(target))
+        return self.heating_controller.get_status_snapshot().data
+
     def action__status(self, request):
         """
-        Run when user wants to set the central heating on or off
+        Run when user wants to know the status. Served from the snapshot.
         """
-        return self.heating_controller.check_status()
+        return self.get_status_snapshot(request).data
+
+    def get_status_snapshot_age(self):
+        """
+        How old the status snapshot is, in seconds
+        """
+        snapshot = self.heating_controller.status_snapshot
+        if snapshot is None:
+            return None
+        return snapshot.get_age_seconds(self.heating_controller.get_clock().seconds())
+
+    def get_status_snapshot(self, request):
+        """
+        Returns the status snapshot, refreshed first if it is older than the request's max_age param (seconds)
+        """
+        max_age = request.get_param("max_age", default=None, force=float)
+        return self.heating_controller.get_status_snapshot(max_age=max_age)
 
     def has_sensors_to_poll(self):
         return bool(
-            self.heating_controller.get_has_temp_humidity_sensor()
+            self.heating_controller.get_has_temp_humidity_sensor_configured()  # It may only be added once pigpiod is up
             or self.heating_controller.get_has_hw_temp_sensor()
         )
 
@@ -292,14 +811,24 @@ class RaspithermControlResource(Resource):
         """
         if self.heating_controller.get_has_temp_humidity_sensor():
             self.heating_controller.read_temp_humidity(use_cache=True)
-        if self.heating_controller.get_has_hw_temp_sensor():
-            self.heating_controller.read_hw_temp()
-            # TODO: implement target-temperature central heating control response.
+        self.heating_controller.thermostat.update()  # Respond to the new temperature
+        self.heating_controller.refresh_status_snapshot()
+
+    def poll_status(self):
+        """
+        Refreshes the status snapshot served to requests. The status pins are tracked by edge
+        callbacks, but we re-read them here as a safety net in case an edge went missing. This is
+        also what samples the heating's on/off states into the history.
+        """
+        self.heating_controller.refresh_status_snapshot(resync_pins=True, record_states=True)
 
     def teardown(self):
         """
         Called automatically when exiting the parent reactor
         """
+        if self.status_websocket is not None:
+            self.status_websocket.teardown()
+        self.status_events.teardown()
         self.heating_controller.teardown()
 
 
@@ -308,12 +837,13 @@ class RaspithermControlSite(Site, object):
     Site thread which initialises the RaspithermControlResource properly
     """
     emulated_readable_pins = {}  # Class-wide, shared. For debugging
-    registry = {}  # Class-wide, shared. For storing data
+    registry = None  # Class-wide, shared. For storing data. Populated by get_registry()
+    rollups = None  # Class-wide, shared. Long-term history. Populated by get_rollup_store()
 
     def __init__(self, *args, **kwargs):
         resource = kwargs.pop("resource", None)
         if resource is None:
-            resource = RaspithermControlResource(emulated_readable_pins=self.__class__.emulated_readable_pins, registry=self.__class__.registry)
+            resource = RaspithermControlResource(emulated_readable_pins=self.__class__.emulated_readable_pins, registry=self.get_registry(), rollups=self.get_rollup_store())
         super(RaspithermControlSite, self).__init__(resource=resource, requestFactory=SmartRequest, *args, **kwargs)
     
     def stopFactory(self):
@@ -321,8 +851,63 @@ class RaspithermControlSite(Site, object):
         Called automatically when exiting the reactor. Here we tell the HeatingController class to tear down its resources
         """
         self.resource.teardown()
+        if self.__class__.registry is not None:
+            self.__class__.registry.close()
+        if self.__class__.rollups is not None:
+            self.__class__.rollups.close()
+
+    @classmethod
+    def get_registry(cls):
+        """
+        Returns the class-wide registry. It's persisted to disk if the config file has a registry_path.
+        """
+        if cls.registry is None:
+            registry_path = get_setting("registry_path", "")
+            if registry_path:
+                cls.registry = VersionedRegistry(store=PersistentRegistry(os.path.join(RASPILED_DIR, registry_path)))
+            else:
+                cls.registry = VersionedRegistry()
+        return cls.registry
+
+    @classmethod
+    def get_rollup_store(cls):
+        """
+        Returns the class-wide long-term history store, or None if the config file's rollup_path is blank
+        """
+        if cls.rollups is None:
+            rollup_path = get_setting("rollup_path", "")
+            if rollup_path:
+                cls.rollups = RollupStore(os.path.join(RASPILED_DIR, rollup_path), flush_interval_seconds=get_setting("rollup_flush_seconds", None))
+        return cls.rollups
 
     
+def start_background_tasks(resource):
+    """
+    Starts the timed loops which keep the given RaspithermControlResource up to date
+
+    @return: <list> of the LoopingCalls started
+    """
+    loops = []
+    # Keep an eye on how responsive the reactor is
+    loops.append(ReactorLagMonitor().start())
+    # Reconnect to pigpiod if it goes away
+    loops.append(resource.heating_controller.connection.start())
+    # Read the DS18B20 probes in the background, as they can take most of a second each
+    if resource.heating_controller.get_w1_sensors():
+        loops.append(resource.heating_controller.w1_sampler.start())
+    # Keep the status snapshot fresh, so requests don't have to touch the hardware
+    status_task_loop = task.LoopingCall(resource.poll_status)
+    status_task_loop.start(STATUS_POLLING_PERIOD_SECONDS)
+    loops.append(status_task_loop)
+    # Add a timed loop if there are heating sensors to respond to
+    if resource.has_sensors_to_poll():
+        print("\tPolling sensors every {} seconds".format(SENSOR_POLLING_PERIOD_SECONDS))
+        sensor_task_loop = task.LoopingCall(resource.poll_sensors)
+        sensor_task_loop.start(SENSOR_POLLING_PERIOD_SECONDS)
+        loops.append(sensor_task_loop)
+    return loops
+
+
 def start_if_not_running():
     """
     Checks if the process is running, if not, starts it!
@@ -335,11 +920,7 @@ def start_if_not_running():
         factory = RaspithermControlSite(timeout=8) #8s timeout
         endpoint = endpoints.TCP4ServerEndpoint(reactor, CONFIG_SETTINGS['pi_port'])
         endpoint.listen(factory)
-        # Add a timed loop if there are heating sensors to respond to
-        if factory.resource.has_sensors_to_poll():
-            print("\tPolling sensors every {} seconds".format(SENSOR_POLLING_PERIOD_SECONDS))
-            sensor_task_loop = task.LoopingCall(factory.resource.poll_sensors)
-            sensor_task_loop.start(SENSOR_POLLING_PERIOD_SECONDS)
+        start_background_tasks(factory.resource)
         reactor.run()
     else:
         logging.info("Raspitherm Listener already running with PID %s" % ", ".join(pids))
@@ -0,0 +1,391 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Registry
+
+        VersionedRegistry: the registry devices keep their data in. Every write publishes a new frozen
+        snapshot of the whole registry with a higher version number, by swapping one reference. Readers
+        get the values themselves (frozen, so they can't be changed under anyone's feet) without copying
+        or locking, and can use the version to tell whether anything has changed.
+
+        PersistentRegistry: a dict which survives restarts, for BaseRaspiHomeDevice.registry. Every change is appended to a
+        log file as one JSON line:
+
+            {"k": "target_temperature", "v": 20.0}
+            {"k": "target_temperature", "d": 1}    (deleted)
+
+        Writes are cheap: lines go into a buffer, which is flushed and fsynced in batches at most every
+        sync_interval_seconds. On start up the log is replayed to get back to the last known state. A
+        torn last line (we crashed mid-write) is ignored. Once the log has many more lines than there are
+        keys, it is compacted: the current state is written to a new file which atomically replaces the old one.
+
+        Values must be JSON-able. Decimals and datetimes are supported too.
+"""
+import datetime
+import logging
+import os
+import threading
+from collections.abc import MutableMapping
+from decimal import Decimal
+
+import simplejson as simplejson
+from twisted.internet import reactor
+from twisted.python import threadable
+
+from src.metrics import REGISTRY
+
+
+REGISTRY_WRITES = REGISTRY.counter("raspitherm_registry_writes_total", "Changes appended to the persistent registry log")
+REGISTRY_SYNCS = REGISTRY.counter("raspitherm_registry_syncs_total", "Batched flush + fsyncs of the persistent registry log")
+REGISTRY_COMPACTIONS = REGISTRY.counter("raspitherm_registry_compactions_total", "Times the persistent registry log has been compacted")
+
+
+class FrozenDict(dict):
+    """
+    A dict which can't be changed after it's made. Still a dict, so JSON encoders etc. are happy with it.
+    """
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("{} is immutable. Set a new value in the registry instead.".format(self.__class__.__name__))
+
+    __setitem__ = __delitem__ = clear = pop = popitem = setdefault = update = _immutable
+    __ior__ = _immutable
+
+    def __copy__(self):
+        return self  # No need to copy something which can't change
+
+    def __deepcopy__(self, memo):
+        return self
+
+    def __reduce__(self):
+        return (self.__class__, (dict(self),))
+
+
+def freeze(value):
+    """
+    Returns an immutable version of value: dicts become FrozenDicts, lists become tuples, sets become
+    frozensets, all the way down. Anything else is assumed to be immutable already.
+    """
+    if isinstance(value, FrozenDict):
+        return value
+    if isinstance(value, dict):
+        return FrozenDict((key, freeze(item)) for key, item in value.items())
+    if isinstance(value, (list, tuple)):
+        return tuple(freeze(item) for item in value)
+    if isinstance(value, set):
+        return frozenset(value)
+    return value
+
+
+class RegistrySnapshot(object):
+    """
+    One version of the registry's contents. Never changes once made.
+    """
+    __slots__ = ("data", "version")
+
+    def __init__(self, data, version):
+        self.data = data
+        self.version = version
+
+    def __repr__(self):
+        return "RegistrySnapshot v{}: {}".format(self.version, self.data)
+
+
+class VersionedRegistry(MutableMapping):
+    """
+    A dict-like registry of frozen values, published as versioned snapshots. Writes can go through
+    to a backing store (e.g. a PersistentRegistry).
+    """
+
+    def __init__(self, store=None):
+        """
+        @keyword store: <MutableMapping> Where writes also go, and where we get our starting data from.
+        """
+        self.store = store if store is not None else {}
+        self._lock = threading.Lock()  # One writer at a time. Readers never need it
+        self._snapshot = RegistrySnapshot(FrozenDict((key, freeze(value)) for key, value in self.store.items()), 0)
+
+    def __repr__(self):
+        return "<VersionedRegistry v{} keys={}>".format(self._snapshot.version, len(self._snapshot.data))
+
+    @property
+    def snapshot(self):
+        """
+        @return: <RegistrySnapshot> The latest version of everything
+        """
+        return self._snapshot
+
+    @property
+    def version(self):
+        return self._snapshot.version
+
+    def __getitem__(self, key):
+        return self._snapshot.data[key]
+
+    def get(self, key, default=None):
+        return self._snapshot.data.get(key, default)
+
+    def __contains__(self, key):
+        return key in self._snapshot.data
+
+    def __iter__(self):
+        return iter(self._snapshot.data)
+
+    def __len__(self):
+        return len(self._snapshot.data)
+
+    def __setitem__(self, key, value):
+        frozen_value = freeze(value)
+        with self._lock:
+            current = self._snapshot
+            if key in current.data and current.data[key] == frozen_value:
+                return  # No change, no new version
+            data = dict(current.data)
+            data[key] = frozen_value
+            self.store[key] = frozen_value
+            self._snapshot = RegistrySnapshot(FrozenDict(data), current.version + 1)
+
+    def __delitem__(self, key):
+        with self._lock:
+            current = self._snapshot
+            data = dict(current.data)
+            del data[key]
+            self.store.pop(key, None)
+            self._snapshot = RegistrySnapshot(FrozenDict(data), current.version + 1)
+
+    def close(self):
+        """
+        Closes the backing store, if it needs closing
+        """
+        close = getattr(self.store, "close", None)
+        if close is not None:
+            close()
+
+
+def encode_value(obj):
+    """
+    simplejson default= hook for the types JSON doesn't do natively
+    """
+    if isinstance(obj, datetime.datetime):
+        return {"__datetime__": obj.isoformat()}
+    if isinstance(obj, datetime.date):
+        return {"__date__": obj.isoformat()}
+    if isinstance(obj, Decimal):
+        return {"__decimal__": str(obj)}
+    if isinstance(obj, (set, frozenset, tuple)):
+        return list(obj)
+    raise TypeError("{} is not JSON serializable".format(obj.__class__.__name__))
+
+
+def decode_value(obj):
+    """
+    simplejson object_hook= reversing encode_value()
+    """
+    if len(obj) == 1:
+        if "__datetime__" in obj:
+            return datetime.datetime.fromisoformat(obj["__datetime__"])
+        if "__date__" in obj:
+            return datetime.date.fromisoformat(obj["__date__"])
+        if "__decimal__" in obj:
+            return Decimal(obj["__decimal__"])
+    return obj
+
+
+class PersistentRegistry(MutableMapping):
+    """
+    A dict backed by an append-only log file
+    """
+    SYNC_INTERVAL_SECONDS = 1.0  # Longest a change sits in the buffer before being fsynced
+    COMPACT_MIN_LINES = 1000  # Never compact smaller logs than this
+    COMPACT_RATIO = 4  # Compact once the log has this many lines per key
+
+    def __init__(self, path, sync_interval_seconds=None, clock=None):
+        """
+        @param path: <str> The log file. Created if it doesn't exist
+        @keyword sync_interval_seconds: <float> How long to batch up writes before fsyncing. 0 fsyncs every write.
+        @keyword clock: Twisted IReactorTime to schedule the batched syncs. Defaults to the global reactor
+        """
+        self.path = path
+        self.sync_interval_seconds = self.SYNC_INTERVAL_SECONDS if sync_interval_seconds is None else sync_interval_seconds
+        self.clock = clock or reactor
+        self.data = {}
+        self.n_log_lines = 0
+        self._lock = threading.RLock()  # Sensor threads may write too
+        self._sync_call = None
+        self._file = None
+        self.replay()
+        self._file = open(self.path, "a", encoding="utf-8")
+
+    def __repr__(self):
+        return "<PersistentRegistry {} keys={}>".format(self.path, len(self.data))
+
+    # Dict interface
+    def __getitem__(self, key):
+        return self.data[key]
+
+    def __setitem__(self, key, value):
+        with self._lock:
+            try:
+                line = self.encode_line({"k": key, "v": value})
+            except TypeError as e:
+                logging.error("PersistentRegistry: cannot save {}, keeping it in memory only: {}".format(key, e))
+                line = None
+            self.data[key] = value  # Before appending, as appending can compact the log from self.data
+            if line is not None:
+                self.append_line(line)
+
+    def __delitem__(self, key):
+        with self._lock:
+            del self.data[key]
+            self.append_line(self.encode_line({"k": key, "d": 1}))
+
+    def __iter__(self):
+        return iter(list(self.data))
+
+    def __len__(self):
+        return len(self.data)
+
+    def __contains__(self, key):
+        return key in self.data
+
+    # Log handling
+    @staticmethod
+    def encode_line(record):
+        return simplejson.dumps(record, default=encode_value, use_decimal=False, separators=(",", ":")) + "\n"
+
+    @staticmethod
+    def decode_line(line):
+        return simplejson.loads(line, object_hook=decode_value)
+
+    def replay(self):
+        """
+        Rebuilds the data from the log
+        """
+        self.data = {}
+        self.n_log_lines = 0
+        if not os.path.exists(self.path):
+            return self.data
+        good_length = 0
+        with open(self.path, "r", encoding="utf-8") as log_file:
+            for line in log_file:
+                if not line.endswith("\n"):  # Torn write at the very end. We crashed before it was synced
+                    logging.warning("PersistentRegistry: ignoring incomplete last line of {}".format(self.path))
+                    break
+                good_length += len(line.encode("utf-8"))
+                try:
+                    record = self.decode_line(line)
+                    key = record["k"]
+                except (ValueError, KeyError, TypeError) as e:
+                    logging.warning("PersistentRegistry: skipping corrupt line in {}: {}".format(self.path, e))
+                    continue
+                if record.get("d"):
+                    self.data.pop(key, None)
+                else:
+                    self.data[key] = record.get("v")
+                self.n_log_lines += 1
+        if good_length != os.path.getsize(self.path):  # Chop off the torn line so new lines start cleanly
+            with open(self.path, "r+b") as log_file:
+                log_file.truncate(good_length)
+        logging.info("PersistentRegistry: restored {} keys from {}".format(len(self.data), self.path))
+        return self.data
+
+    def append_line(self, line):
+        """
+        Writes a line to the log, and makes sure a sync is on its way. Safe to call from any thread: the
+        file is written under the lock, but scheduling the sync has to happen on the reactor thread.
+        """
+        if self._file is None:  # Closed. In memory only from now on
+            return
+        self._file.write(line)
+        self.n_log_lines += 1
+        REGISTRY_WRITES.inc()
+        if self.sync_interval_seconds <= 0:
+            self.sync()
+        elif self._sync_call is None:
+            if self.is_reactor_thread():
+                self._schedule_sync()
+            else:  # callLater isn't thread-safe
+                reactor.callFromThread(self._schedule_sync)
+
+    @staticmethod
+    def is_reactor_thread():
+        """
+        @return: <bool> True if we're on the reactor's thread (or the main thread, before the reactor has started)
+        """
+        if threadable.ioThread is not None:
+            return threadable.isInIOThread()
+        return threading.current_thread() is threading.main_thread()
+
+    def _schedule_sync(self):
+        if self._sync_call is None and self._file is not None:
+            self._sync_call = self.clock.callLater(self.sync_interval_seconds, self._scheduled_sync)
+
+    def _scheduled_sync(self):
+        self._sync_call = None
+        self.sync()
+
+    def sync(self):
+        """
+        Flushes buffered changes to disk, compacting the log if it has got long
+        """
+        with self._lock:
+            if self._file is None:
+                return
+            self._file.flush()
+            os.fsync(self._file.fileno())
+            REGISTRY_SYNCS.inc()
+            if self.n_log_lines >= max(self.COMPACT_MIN_LINES, self.COMPACT_RATIO * len(self.data)):
+                self.compact()
+
+    def compact(self):
+        """
+        Rewrites the log as one line per key. Written to a temporary file first, then swapped in
+        atomically, so a crash at any point leaves either the old or the new log intact.
+        """
+        with self._lock:
+            tmp_path = self.path + ".tmp"
+            n_lines = 0
+            with open(tmp_path, "w", encoding="utf-8") as tmp_file:
+                for key, value in self.data.items():
+                    try:
+                        tmp_file.write(self.encode_line({"k": key, "v": value}))
+                    except TypeError:  # In memory only, see __setitem__
+                        continue
+                    n_lines += 1
+                tmp_file.flush()
+                os.fsync(tmp_file.fileno())
+            self._file.close()
+            os.replace(tmp_path, self.path)
+            self._fsync_directory()
+            self._file = open(self.path, "a", encoding="utf-8")
+            self.n_log_lines = n_lines
+            REGISTRY_COMPACTIONS.inc()
+
+    def _fsync_directory(self):
+        """
+        Makes the rename durable
+        """
+        try:
+            dir_fd = os.open(os.path.dirname(os.path.abspath(self.path)), os.O_RDONLY)
+        except OSError:
+            return
+        try:
+            os.fsync(dir_fd)
+        except OSError:
+            pass
+        finally:
+            os.close(dir_fd)
+
+    def close(self):
+        """
+        Syncs anything outstanding and closes the log
+        """
+        with self._lock:
+            if self._sync_call is not None and self._sync_call.active():
+                self._sync_call.cancel()
+            self._sync_call = None
+            if self._file is not None:
+                self.sync()
+                self._file.close()
+                self._file = None
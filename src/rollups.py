@@ -0,0 +1,367 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Rollups
+
+        RollupStore: long-term history on disk, small enough to keep a year of it on the SD card. Each
+        group of readings (e.g. "th": temp_c and humidity) gets one memory-mapped file per resolution:
+
+            raw     The readings themselves, the latest 10080 of them
+            1m      Count / sum / min / max per minute, for a week
+            15m     ... per 15 minutes, for three months
+            1h      ... per hour, for a year
+
+        Every file is a fixed number of fixed-size slots used round robin, so it never grows. Rollup slots
+        are found by arithmetic from the bucket's time, so a query only touches the slots in its range.
+
+        To spare the SD card, readings are gathered in memory and only written to the files (and msynced)
+        every flush_interval_seconds. A crash loses at most that much.
+"""
+import logging
+import math
+import mmap
+import os
+import struct
+from collections import OrderedDict
+
+from twisted.internet import reactor
+
+from src.metrics import REGISTRY
+
+
+ROLLUP_FLUSHES = REGISTRY.counter("raspitherm_rollup_flushes_total", "Batched writes of readings to the rollup files")
+ROLLUP_FLUSH_SECONDS = REGISTRY.histogram("raspitherm_rollup_flush_seconds", "Time taken to write a batch of readings to the rollup files")
+
+NAN = float("nan")
+
+
+class RollupFile(object):
+    """
+    One group's readings at one resolution, in a memory-mapped file:
+        header: magic, version, number of fields, step (0 for raw), number of slots, readings written (raw only), field names
+        slots:  raw:    timestamp (double), then a float per field
+                rollup: bucket start (uint32, 0 if unused), then count (uint32), sum, min, max (floats) per field
+    """
+    MAGIC = b"RTRU"
+    VERSION = 1
+    HEADER = struct.Struct("<4sHHIIQ")
+    HEADER_SIZE = 256  # The header, then the comma separated field names padded out to this
+
+    def __init__(self, path, fields, step, n_slots):
+        """
+        @param path: <str> The file. Created if it doesn't exist, or started afresh if it was made with different settings
+        @param fields: <iterable> of <str> The field names
+        @param step: <int> Bucket width in seconds. 0 to keep the raw readings
+        @param n_slots: <int> How many readings / buckets to keep
+        """
+        self.path = path
+        self.fields = tuple(fields)
+        self.step = int(step)
+        self.n_slots = int(n_slots)
+        if self.step:
+            self.slot_struct = struct.Struct("<I" + "Ifff" * len(self.fields))
+        else:
+            self.slot_struct = struct.Struct("<d" + "f" * len(self.fields))
+        self.n_written = 0  # Raw only: how many readings have ever been written
+        self.pending = OrderedDict()  # Rollup: {slot: [bucket start, count, sum, min, max, count, sum, ...]}. Raw: {position: [timestamp, value, ...]}
+        self._file = None
+        self._map = None
+        self.open()
+
+    def __repr__(self):
+        return "<RollupFile {} step={} slots={}>".format(self.path, self.step, self.n_slots)
+
+    def encode_field_names(self):
+        names = ",".join(self.fields).encode("utf-8")
+        if len(names) > self.HEADER_SIZE - self.HEADER.size:
+            raise ValueError("Too many fields for a rollup file: {}".format(self.fields))
+        return names
+
+    def open(self):
+        size = self.HEADER_SIZE + self.slot_struct.size * self.n_slots
+        if os.path.exists(self.path) and not self._header_matches(size):
+            logging.warning("RollupFile: {} was made with different settings, starting afresh. The old one is {}.old".format(self.path, self.path))
+            os.replace(self.path, self.path + ".old")
+        if not os.path.exists(self.path):
+            with open(self.path, "wb") as new_file:
+                new_file.write(self.HEADER.pack(self.MAGIC, self.VERSION, len(self.fields), self.step, self.n_slots, 0))
+                new_file.write(self.encode_field_names())
+                new_file.truncate(size)  # Sparse: unused slots are all zeros
+        self._file = open(self.path, "r+b")
+        self._map = mmap.mmap(self._file.fileno(), size)
+        self.n_written = self.HEADER.unpack_from(self._map, 0)[5]
+
+    @classmethod
+    def read_field_names(cls, path):
+        """
+        @return: <tuple> The field names in an existing file's header, or None if it isn't a rollup file
+        """
+        try:
+            with open(path, "rb") as rollup_file:
+                header = rollup_file.read(cls.HEADER_SIZE)
+            if cls.HEADER.unpack_from(header, 0)[0] != cls.MAGIC:
+                return None
+        except (IOError, struct.error):
+            return None
+        names = header[cls.HEADER.size:].rstrip(b"\0").decode("utf-8")
+        return tuple(names.split(",")) if names else ()
+
+    def _header_matches(self, size):
+        try:
+            with open(self.path, "rb") as old_file:
+                header = old_file.read(self.HEADER_SIZE)
+            magic, version, n_fields, step, n_slots, _n_written = self.HEADER.unpack_from(header, 0)
+        except (IOError, struct.error):
+            return False
+        names = header[self.HEADER.size:].rstrip(b"\0")
+        return (
+            (magic, version, n_fields, step, n_slots) == (self.MAGIC, self.VERSION, len(self.fields), self.step, self.n_slots)
+            and names == self.encode_field_names()
+            and os.path.getsize(self.path) == size
+        )
+
+    def _read_slot(self, slot):
+        return list(self.slot_struct.unpack_from(self._map, self.HEADER_SIZE + slot * self.slot_struct.size))
+
+    def get_slot(self, slot):
+        """
+        @return: <list> The slot's contents, including anything not yet flushed
+        """
+        pending = self.pending.get(slot)
+        if pending is not None:
+            return pending
+        return self._read_slot(slot)
+
+    # Writing
+    def add(self, timestamp, values):
+        """
+        Adds a reading. Kept in memory until flush().
+
+        @param timestamp: <float> Unix time of the reading
+        @param values: <dict> {field: number}. Anything missing or not a number is skipped
+        """
+        numbers = []
+        for field in self.fields:
+            try:
+                number = float(values.get(field))
+            except (TypeError, ValueError):
+                number = NAN
+            numbers.append(number)
+        if not self.step:
+            self.pending[self.n_written + len(self.pending)] = [timestamp] + numbers
+            return
+        bucket_number = int(timestamp // self.step)
+        slot = bucket_number % self.n_slots
+        bucket_start = bucket_number * self.step
+        record = self.get_slot(slot)
+        if record[0] != bucket_start:  # Last time round, or never used. Start again
+            record = [bucket_start] + [0, 0.0, 0.0, 0.0] * len(self.fields)
+        for field_number, number in enumerate(numbers):
+            if math.isnan(number):
+                continue
+            offset = 1 + field_number * 4
+            count, total, minimum, maximum = record[offset:offset + 4]
+            if count:
+                minimum = min(minimum, number)
+                maximum = max(maximum, number)
+            else:
+                minimum = maximum = number
+            record[offset:offset + 4] = [count + 1, total + number, minimum, maximum]
+        self.pending[slot] = record
+
+    def flush(self):
+        """
+        Writes the pending readings into the file, and msyncs it
+        """
+        if not self.pending or self._map is None:
+            return 0
+        n_pending = len(self.pending)
+        for key, record in self.pending.items():
+            slot = key % self.n_slots if not self.step else key
+            self.slot_struct.pack_into(self._map, self.HEADER_SIZE + slot * self.slot_struct.size, *record)
+        if not self.step:
+            self.n_written += n_pending
+            self.HEADER.pack_into(self._map, 0, self.MAGIC, self.VERSION, len(self.fields), self.step, self.n_slots, self.n_written)
+        self.pending.clear()
+        self._map.flush()
+        return n_pending
+
+    def close(self):
+        if self._map is None:
+            return
+        self.flush()
+        self._map.close()
+        self._file.close()
+        self._map = self._file = None
+
+    # Reading
+    def query(self, since, until):
+        """
+        @param since: <float> Unix time
+        @param until: <float> Unix time
+        @return: <dict> {"t": [...], field: [...], ...}. Rollups also have field_min and field_max lists, and
+                 field is the mean. Missing values are None.
+        """
+        if self.step:
+            return self._query_rollup(since, until)
+        return self._query_raw(since, until)
+
+    def _query_raw(self, since, until):
+        out = OrderedDict([("t", [])] + [(field, []) for field in self.fields])
+        n_total = self.n_written + len(self.pending)
+        low, high = max(n_total - self.n_slots, 0), n_total
+        # Readings are in time order, so find the first one we want by binary search
+        while low < high:
+            middle = (low + high) // 2
+            if self._get_raw(middle)[0] < since:
+                low = middle + 1
+            else:
+                high = middle
+        for position in range(low, n_total):
+            record = self._get_raw(position)
+            if record[0] > until:
+                break
+            out["t"].append(record[0])
+            for field_number, field in enumerate(self.fields):
+                value = record[1 + field_number]
+                out[field].append(None if math.isnan(value) else round(value, 3))
+        return out
+
+    def _get_raw(self, position):
+        pending = self.pending.get(position)
+        if pending is not None:
+            return pending
+        return self._read_slot(position % self.n_slots)
+
+    def _query_rollup(self, since, until):
+        out = OrderedDict([("t", [])])
+        for field in self.fields:
+            out[field] = []
+            out[field + "_min"] = []
+            out[field + "_max"] = []
+        first_bucket = max(int(since // self.step), int(until // self.step) - self.n_slots + 1)
+        for bucket_number in range(first_bucket, int(until // self.step) + 1):
+            record = self.get_slot(bucket_number % self.n_slots)
+            if record[0] != bucket_number * self.step:  # Nothing recorded in this bucket
+                continue
+            out["t"].append(record[0])
+            for field_number, field in enumerate(self.fields):
+                count, total, minimum, maximum = record[1 + field_number * 4:5 + field_number * 4]
+                out[field].append(round(total / count, 3) if count else None)
+                out[field + "_min"].append(round(minimum, 3) if count else None)
+                out[field + "_max"].append(round(maximum, 3) if count else None)
+        return out
+
+
+class RollupStore(object):
+    """
+    Raw readings plus 1 minute, 15 minute and 1 hour rollups of each group of readings, on disk
+    """
+    RESOLUTIONS = OrderedDict((  # name: (step seconds, slots kept)
+        ("raw", (0, 10080)),
+        ("1m", (60, 7 * 24 * 60)),  # A week
+        ("15m", (900, 93 * 24 * 4)),  # Three months
+        ("1h", (3600, 366 * 24)),  # A year
+    ))
+    FLUSH_INTERVAL_SECONDS = 300.0
+
+    def __init__(self, directory, flush_interval_seconds=None, clock=None):
+        """
+        @param directory: <str> Where the files go. Created if it doesn't exist
+        @keyword flush_interval_seconds: <float> How long readings are gathered in memory before being written
+        @keyword clock: Twisted IReactorTime to schedule the flushes. Defaults to the global reactor
+        """
+        self.directory = directory
+        self.flush_interval_seconds = self.FLUSH_INTERVAL_SECONDS if flush_interval_seconds is None else flush_interval_seconds
+        self.clock = clock or reactor
+        self.files = {}  # {(group, resolution): RollupFile}
+        self._flush_call = None
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+
+    def __repr__(self):
+        return "<RollupStore {}>".format(self.directory)
+
+    def get_files(self, group, fields=None):
+        """
+        @return: <OrderedDict> {resolution: RollupFile} for the group, opening them if need be (which needs the fields)
+        """
+        out = OrderedDict()
+        for resolution, (step, n_slots) in self.RESOLUTIONS.items():
+            rollup_file = self.files.get((group, resolution))
+            if rollup_file is None:
+                path = self.get_path(group, resolution)
+                file_fields = fields
+                if file_fields is None and os.path.exists(path):  # Saved in an earlier run
+                    file_fields = RollupFile.read_field_names(path)
+                if file_fields is None:
+                    continue
+                rollup_file = self.files[(group, resolution)] = RollupFile(path, file_fields, step, n_slots)
+            out[resolution] = rollup_file
+        return out
+
+    def get_path(self, group, resolution):
+        return os.path.join(self.directory, "{}.{}.rollup".format(group, resolution))
+
+    def add(self, group, fields, timestamp, values):
+        """
+        Adds a reading to the group's raw readings and rollups
+
+        @param group: <str> e.g. "th"
+        @param fields: <tuple> The group's field names
+        @param timestamp: <float> Unix time of the reading
+        @param values: <dict> {field: number}
+        """
+        for resolution, rollup_file in self.get_files(group, fields).items():
+            if rollup_file.fields != tuple(fields):  # e.g. a zone has been added since it was opened. Start afresh
+                rollup_file.close()
+                del self.files[(group, resolution)]
+        for rollup_file in self.get_files(group, fields).values():
+            rollup_file.add(timestamp, values)
+        if self.flush_interval_seconds <= 0:
+            self.flush()
+        elif self._flush_call is None:
+            self._flush_call = self.clock.callLater(self.flush_interval_seconds, self._scheduled_flush)
+
+    def _scheduled_flush(self):
+        self._flush_call = None
+        self.flush()
+
+    def flush(self):
+        """
+        Writes everything gathered so far to disk
+        """
+        with ROLLUP_FLUSH_SECONDS.time():
+            n_written = sum(rollup_file.flush() for rollup_file in self.files.values())
+        if n_written:
+            ROLLUP_FLUSHES.inc()
+        return n_written
+
+    def query(self, group, resolution, since=None, until=None):
+        """
+        @param group: <str> e.g. "th"
+        @param resolution: <str> One of RESOLUTIONS
+        @keyword since: <float> Unix time. Defaults to as far back as the resolution goes
+        @keyword until: <float> Unix time. Defaults to now
+        @return: <dict> as RollupFile.query(), or None if we have nothing for the group
+        @raise ValueError: if since or until isn't a finite number
+        """
+        for value in (since, until):
+            if value is not None and not math.isfinite(value):
+                raise ValueError("since and until must be finite unix times")
+        rollup_file = self.get_files(group).get(resolution)
+        if rollup_file is None:
+            return None
+        if until is None:
+            until = self.clock.seconds()
+        if since is None:
+            since = until - rollup_file.step * rollup_file.n_slots if rollup_file.step else 0
+        return rollup_file.query(since, until)
+
+    def close(self):
+        if self._flush_call is not None and self._flush_call.active():
+            self._flush_call.cancel()
+        self._flush_call = None
+        for rollup_file in self.files.values():
+            rollup_file.close()
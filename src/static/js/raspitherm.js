@@ -133,9 +133,84 @@ $.fn.extend({
 raspitherm.update_heating_ui_controls = update_heating_ui_controls;
 
 
+// Live updates, pushed down a WebSocket
+raspitherm.live_state = {};  // The latest compact state {"hw":1, "ch":0, "th":{...}, "hw_temp":{...}}
+raspitherm.socket = null;
+raspitherm.socket_retry_ms = 1000;
+
+function compact_state_to_hardware_settings(state){
+    // Converts the compact pushed state into the dict update_heating_ui_controls() understands
+    let th = state["th"] || null;
+    let hw_temp = state["hw_temp"] || null;
+    return {
+        "ch": state["ch"] ? "on" : "off",
+        "hw": state["hw"] ? "on" : "off",
+        "th_available": th ? 1 : 0,
+        "th_temp_c": th ? th["temp_c"] : "",
+        "th_humidity": th ? th["humidity"] : "",
+        "hw_temp_available": hw_temp ? 1 : 0,
+        "hw_temp_c": hw_temp ? hw_temp["temp_c"] : ""
+    };
+}
+raspitherm.compact_state_to_hardware_settings = compact_state_to_hardware_settings;
+
+function refresh_from_live_state(){
+    // Redraws the controls from the latest pushed state
+    $.fn.update_heating_ui_controls(compact_state_to_hardware_settings(raspitherm.live_state));
+}
+raspitherm.refresh_from_live_state = refresh_from_live_state;
+
+function connect_live_updates(){
+    // Opens the WebSocket. Reconnects with backoff if it drops.
+    if(typeof(WebSocket) === "undefined"){
+        return null;  // Old browser: stick with AJAX
+    }
+    let protocol = (window.location.protocol === "https:") ? "wss://" : "ws://";
+    let socket = new WebSocket(protocol + window.location.host + "/ws");
+    socket.onopen = function(){
+        raspitherm.socket_retry_ms = 1000;
+    };
+    socket.onmessage = function(e){
+        let message = JSON.parse(e.data);
+        if(message["error"]){
+            console.log("Raspitherm: "+message["error"]);
+            refresh_from_live_state();  // Undo whatever the user clicked
+            return;
+        }
+        $.extend(raspitherm.live_state, message);  // Messages after the first only contain what has changed
+        refresh_from_live_state();
+    };
+    socket.onclose = function(){
+        raspitherm.socket = null;
+        setTimeout(connect_live_updates, raspitherm.socket_retry_ms);
+        raspitherm.socket_retry_ms = Math.min(raspitherm.socket_retry_ms * 2, 30000);
+    };
+    raspitherm.socket = socket;
+    return socket;
+}
+raspitherm.connect_live_updates = connect_live_updates;
+
+function send_live_command(keyname, intended_state){
+    // Sends a toggle command down the WebSocket. Returns false if there is no open socket.
+    let socket = raspitherm.socket;
+    if(!socket || socket.readyState !== WebSocket.OPEN){
+        return false;
+    }
+    let command = {};
+    command[keyname] = intended_state;
+    socket.send(JSON.stringify(command));
+    // The outcome arrives as a pushed delta. If nothing changes, put the switch back how it really is.
+    setTimeout(refresh_from_live_state, 3000);
+    return true;
+}
+raspitherm.send_live_command = send_live_command;
+
+
 // Respond to user interactions:
 $(document).ready(function(){
 
+    connect_live_updates();
+
     // Switching a switch
     $(".toggle_checkbox").on("click", function(e){
 		// Detects clicking a checkbox
@@ -151,6 +226,10 @@ $(document).ready(function(){
 		    intended_post_click_hardware_state = "off";
 		}
 
+		if(send_live_command(keyname, intended_post_click_hardware_state)){
+		    return;  // Sent down the WebSocket
+		}
+
 		$.fn.debounce( //Debounced to prevent excessive AJAX calls
             $.ajax({ // Fire off ajax to actually change that state!!
                 url: "/?"+ keyname + '=' + intended_post_click_hardware_state,
@@ -0,0 +1,143 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - WebSocket push channel
+
+        One long-lived connection per browser. The server pushes compact state deltas as they
+        happen, and the browser can send toggle commands back down the same connection:
+
+            server -> browser:  {"hw": 1, "ch": 0, "th": {...}, "hw_temp": null}  (full state on connect)
+                                {"ch": 1}  (then only what has changed)
+            browser -> server:  {"hw": "on"}
+
+    @requires: autobahn
+"""
+import logging
+
+import simplejson as simplejson
+from autobahn.twisted.resource import WebSocketResource
+from autobahn.twisted.websocket import WebSocketServerFactory, WebSocketServerProtocol
+
+
+class StatusWebSocketProtocol(WebSocketServerProtocol):
+    """
+    One browser's connection
+    """
+
+    def onOpen(self):
+        self.factory.register(self)
+
+    def onMessage(self, payload, isBinary):
+        """
+        Commands come in as JSON objects e.g. {"ch": "on"}
+        """
+        if isBinary:
+            self.send_json({"error": "Commands must be JSON text"})
+            return
+        try:
+            command = simplejson.loads(payload.decode("utf-8"))
+        except (ValueError, UnicodeError):
+            self.send_json({"error": "Commands must be JSON text"})
+            return
+        if not isinstance(command, dict):
+            self.send_json({"error": "Commands must be JSON objects e.g. {\"hw\": \"on\"}"})
+            return
+        self.factory.apply_command(self, command)
+
+    def onClose(self, wasClean, code, reason):
+        self.factory.unregister(self)
+
+    def send_json(self, payload):
+        self.sendMessage(self.factory.encode(payload), isBinary=False)
+
+
+class StatusWebSocketFactory(WebSocketServerFactory):
+    """
+    Pushes heating state deltas out to every connected browser. Each delta is framed once and the
+    same prepared message is sent to every client.
+    """
+    protocol = StatusWebSocketProtocol
+    AUTO_PING_INTERVAL_SECONDS = 30  # Keeps idle connections alive through NAT / proxies
+    AUTO_PING_TIMEOUT_SECONDS = 10
+
+    def __init__(self, heating_controller, status_events, *args, **kwargs):
+        """
+        @param heating_controller: <HeatingController> The thing we are controlling
+        @param status_events: <StatusEventBroadcaster> Where we get our deltas from
+        """
+        super(StatusWebSocketFactory, self).__init__(*args, **kwargs)
+        self.heating_controller = heating_controller
+        self.status_events = status_events
+        self.clients = set()
+        self.setProtocolOptions(autoPingInterval=self.AUTO_PING_INTERVAL_SECONDS, autoPingTimeout=self.AUTO_PING_TIMEOUT_SECONDS)
+        status_events.add_delta_listener(self.on_status_delta)
+
+    @classmethod
+    def encode(cls, payload):
+        return simplejson.dumps(payload, separators=(",", ":")).encode("utf-8")
+
+    def get_command_keys(self):
+        """
+        The command keys we accept: one per circuit the controller can switch
+        """
+        return self.heating_controller.get_circuits().keys()
+
+    def register(self, client):
+        """
+        Adds a client, bringing it up to date with the full current state
+        """
+        self.clients.add(client)
+        client.send_json(self.status_events.last_compact_status)
+
+    def unregister(self, client):
+        self.clients.discard(client)
+
+    def on_status_delta(self, version, delta):
+        """
+        Delta listener: sends the delta to every connected client
+        """
+        if not self.clients:
+            return
+        prepared_message = self.prepareMessage(self.encode(delta), isBinary=False)
+        for client in list(self.clients):
+            client.sendPreparedMessage(prepared_message)
+
+    def apply_command(self, client, command):
+        """
+        Carries out the toggle commands given, all in one batch. The outcome reaches every client as a
+        delta, so we only report back to the sender if something goes wrong.
+        """
+        command_keys = self.get_command_keys()
+        unknown_keys = [key for key in command if key not in command_keys]
+        if unknown_keys:
+            client.send_json({"error": "Unknown command(s): {}".format(", ".join(sorted(unknown_keys)))})
+        intended_values = {key: str(value) for key, value in command.items() if key in command_keys}
+        if not intended_values:
+            return None
+        logging.info("WebSocket: switch {}".format(intended_values))
+        d = self.heating_controller.set_many_non_blocking(intended_values)
+        d.addErrback(self._report_command_error, client, intended_values)
+        return d
+
+    @staticmethod
+    def _report_command_error(failure, client, intended_values):
+        logging.error("WebSocket command {} failed: {}".format(intended_values, failure.getErrorMessage()))
+        client.send_json({"error": "{} failed: {}".format(", ".join(sorted(intended_values)), failure.getErrorMessage())})
+
+    def teardown(self):
+        """
+        Say goodbye to all the clients
+        """
+        self.status_events.remove_delta_listener(self.on_status_delta)
+        for client in list(self.clients):
+            client.sendClose()
+        self.clients.clear()
+
+
+def build_status_websocket_resource(heating_controller, status_events):
+    """
+    Returns a twisted.web resource serving the WebSocket push channel, plus its factory
+    """
+    factory = StatusWebSocketFactory(heating_controller, status_events)
+    return WebSocketResource(factory), factory
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Thermostat
+
+        Closed loop control of the central heating from the room temperature sensor, run on the Pi
+        itself each time the sensors are polled. Two modes:
+
+            hysteresis: Heating on below (target - hysteresis), off above (target + hysteresis)
+            pid:        A PID controller works out a heating demand (0-100%), which is turned into on/off
+                        by time-proportioning: on for demand x cycle length at the start of each cycle
+
+        Both respect minimum on and off times, so the boiler isn't short-cycled. Nothing happens until a
+        target temperature is set (registry key "target_temperature"). Clear it to hand back manual control.
+"""
+import datetime
+import logging
+from decimal import Decimal, InvalidOperation
+
+from src.metrics import REGISTRY
+
+
+THERMOSTAT_SWITCHES = REGISTRY.counter("raspitherm_thermostat_switches_total", "Times the thermostat has switched the central heating")
+THERMOSTAT_DEMAND = REGISTRY.gauge("raspitherm_thermostat_demand_ratio", "The thermostat's current heating demand (0-1)")
+
+
+class Thermostat(object):
+    """
+    Drives a HeatingController's central heating towards the target temperature
+    """
+    MODES = ("off", "hysteresis", "pid")
+    MIN_TARGET_C = 5.0
+    MAX_TARGET_C = 30.0
+
+    # Settings (overridden by the config file)
+    mode = "hysteresis"
+    hysteresis_c = 0.5  # Dead band either side of the target
+    min_on_seconds = 300  # Once on, stay on at least this long
+    min_off_seconds = 300  # Once off, stay off at least this long
+    max_reading_age_seconds = 300  # Don't act on temperatures older than this
+    pid_kp = 0.5  # Demand per degree C below target
+    pid_ki = 0.0005  # Demand per degree C second of accumulated error
+    pid_kd = 0.0  # Demand per degree C per second of temperature change
+    cycle_seconds = 900  # Time-proportioning cycle length
+
+    # Runtime vars
+    calling_for_heat = None  # What we last asked for. None until we have asked
+    demand = None  # Latest PID output (0-1), or 1/0 in hysteresis mode
+    reason = "No target temperature set"  # Why we're doing what we're doing
+    ch_state = None  # Last central heating state we saw
+    ch_state_since = None  # When the central heating last changed state (clock seconds)
+    cycle_started_at = None  # When the current time-proportioning cycle started
+    _integral = 0.0
+    _last_temp_c = None
+    _last_update_at = None
+
+    def __init__(self, heating_controller, config=None):
+        """
+        @param heating_controller: <HeatingController> Whose central heating we drive
+        @keyword config: <dict> Settings, see thermostat_* in config.DEFAULTS
+        """
+        self.heating_controller = heating_controller
+        config = config or {}
+        self.mode = config.get("thermostat_mode", self.mode)
+        if self.mode not in self.MODES:
+            logging.error("ERROR: Unknown thermostat_mode {}, choose from {}. Thermostat disabled.".format(self.mode, ", ".join(self.MODES)))
+            self.mode = "off"
+        self.hysteresis_c = float(config.get("thermostat_hysteresis_c", self.hysteresis_c))
+        self.min_on_seconds = float(config.get("thermostat_min_on_seconds", self.min_on_seconds))
+        self.min_off_seconds = float(config.get("thermostat_min_off_seconds", self.min_off_seconds))
+        self.max_reading_age_seconds = float(config.get("thermostat_max_reading_age_seconds", self.max_reading_age_seconds))
+        self.pid_kp = float(config.get("thermostat_pid_kp", self.pid_kp))
+        self.pid_ki = float(config.get("thermostat_pid_ki", self.pid_ki))
+        self.pid_kd = float(config.get("thermostat_pid_kd", self.pid_kd))
+        self.cycle_seconds = float(config.get("thermostat_cycle_seconds", self.cycle_seconds))
+        THERMOSTAT_DEMAND.set_callback(lambda: self.demand)
+
+    def __repr__(self):
+        return "<Thermostat mode={} target={}>".format(self.mode, self.get_target_temperature())
+
+    def get_target_temperature(self):
+        """
+        @return: <float> The target temperature in C, or None if there isn't one
+        """
+        target = self.heating_controller.get_data("target_temperature", default=None)
+        try:
+            return float(target)
+        except (TypeError, ValueError):
+            return None
+
+    def get_temperature(self):
+        """
+        @return: <float> The latest believable room temperature in C, or None if we don't have a fresh one
+        """
+        th = self.heating_controller.th or {}
+        try:
+            temp_c = float(Decimal(th["temp_c"]))
+        except (KeyError, TypeError, ValueError, InvalidOperation):
+            return None
+        read_at = th.get("query_timestamp")
+        if read_at is not None and (datetime.datetime.now() - read_at).total_seconds() > self.max_reading_age_seconds:
+            return None
+        return temp_c
+
+    def is_active(self):
+        return self.mode != "off" and self.get_target_temperature() is not None
+
+    def update(self):
+        """
+        Runs one step of the control loop. Call this each time the sensors are polled.
+
+        @return: <Deferred> if we switched the central heating, otherwise None
+        """
+        now = self.heating_controller.get_clock().seconds()
+        self.observe_ch_state(now)
+        target = self.get_target_temperature()
+        if self.mode == "off" or target is None:
+            self.reset(reason="No target temperature set" if self.mode != "off" else "Thermostat is off")
+            return None
+        temp_c = self.get_temperature()
+        if temp_c is None:
+            self.reason = "No recent temperature reading, leaving the heating alone"
+            return None
+        if self.mode == "pid":
+            wants_heat = self.pid_wants_heat(temp_c, target, now)
+        else:
+            wants_heat = self.hysteresis_wants_heat(temp_c, target)
+        if wants_heat is None or bool(wants_heat) == bool(self.ch_state):
+            return None
+        return self.switch(wants_heat, now)
+
+    def hysteresis_wants_heat(self, temp_c, target):
+        """
+        @return: True / False, or None if we're in the dead band and should leave things as they are
+        """
+        if temp_c < target - self.hysteresis_c:
+            self.demand = 1.0
+            self.reason = "{:.1f}C is below {:.1f}C".format(temp_c, target - self.hysteresis_c)
+            return True
+        if temp_c > target + self.hysteresis_c:
+            self.demand = 0.0
+            self.reason = "{:.1f}C is above {:.1f}C".format(temp_c, target + self.hysteresis_c)
+            return False
+        self.reason = "{:.1f}C is within {:.1f}C of the {:.1f}C target".format(temp_c, self.hysteresis_c, target)
+        return None
+
+    def pid_wants_heat(self, temp_c, target, now):
+        """
+        Updates the PID demand, then time-proportions it: on for the first (demand x cycle) seconds of each
+        cycle. The latest demand is used, so if the room warms up mid-cycle the on period is cut short.
+        """
+        self.demand = self.calculate_pid_demand(temp_c, target, now)
+        if self.cycle_started_at is None or now - self.cycle_started_at >= self.cycle_seconds:
+            self.cycle_started_at = now
+        on_seconds = self.demand * self.cycle_seconds
+        if 0 < on_seconds < self.min_on_seconds:  # Too short to be worth firing up for
+            on_seconds = 0
+        elif on_seconds < self.cycle_seconds and self.cycle_seconds - on_seconds < self.min_off_seconds:  # Too short an off to bother with
+            on_seconds = self.cycle_seconds
+        self.reason = "Demand {:.0f}% at {:.1f}C for a {:.1f}C target".format(self.demand * 100, temp_c, target)
+        return now - self.cycle_started_at < on_seconds
+
+    def calculate_pid_demand(self, temp_c, target, now):
+        """
+        @return: <float> Heating demand 0-1
+        """
+        error = target - temp_c
+        dt = (now - self._last_update_at) if self._last_update_at is not None else 0.0
+        derivative = 0.0
+        if dt > 0 and self._last_temp_c is not None:
+            derivative = -(temp_c - self._last_temp_c) / dt  # On the measurement, so changing the target doesn't kick
+        self._last_temp_c = temp_c
+        self._last_update_at = now
+        proportional = self.pid_kp * error + self.pid_kd * derivative
+        integral = self._integral + error * dt
+        demand = proportional + self.pid_ki * integral
+        # Anti-windup: stop integrating while the demand is pinned at 0% or 100%, unless the error would unpin it
+        if 0.0 < demand < 1.0 or (demand >= 1.0 and error < 0) or (demand <= 0.0 and error > 0):
+            self._integral = integral
+        demand = proportional + self.pid_ki * self._integral
+        return min(max(demand, 0.0), 1.0)
+
+    def observe_ch_state(self, now):
+        """
+        Keeps track of when the central heating last changed, whoever changed it. The state we find it in
+        when we start has no known start time, so doesn't hold up our first switch.
+        """
+        ch_state = bool(self.heating_controller.ch)
+        if self.ch_state is None:
+            self.ch_state = ch_state
+        elif ch_state != self.ch_state:
+            self.ch_state = ch_state
+            self.ch_state_since = now
+
+    def get_seconds_until_allowed_to_switch(self, now):
+        """
+        @return: <float> How long the minimum on / off time has left to run
+        """
+        if self.ch_state_since is None:
+            return 0.0
+        minimum = self.min_on_seconds if self.ch_state else self.min_off_seconds
+        return max(minimum - (now - self.ch_state_since), 0.0)
+
+    def switch(self, wants_heat, now):
+        """
+        Switches the central heating, unless the minimum on / off time hasn't passed or a switch is already under way
+        """
+        wait_seconds = self.get_seconds_until_allowed_to_switch(now)
+        if wait_seconds > 0:
+            self.reason += ". Waiting {:.0f}s before switching {}".format(wait_seconds, "on" if wants_heat else "off")
+            return None
+        if self.heating_controller.command_coalescer.is_busy("ch"):
+            return None
+        logging.info("Thermostat: central heating {} ({})".format("on" if wants_heat else "off", self.reason))
+        THERMOSTAT_SWITCHES.inc()
+        self.calling_for_heat = bool(wants_heat)
+        d = self.heating_controller.set_ch_non_blocking("on" if wants_heat else "off")
+        d.addErrback(self._switch_failed, wants_heat)
+        return d
+
+    @staticmethod
+    def _switch_failed(failure, wants_heat):
+        logging.error("Thermostat could not switch the central heating {}: {}".format("on" if wants_heat else "off", failure.getErrorMessage()))
+        return None
+
+    def reset(self, reason=""):
+        """
+        Forgets the control state, e.g. when the target is cleared
+        """
+        self.calling_for_heat = None
+        self.demand = None
+        self.cycle_started_at = None
+        self._integral = 0.0
+        self._last_temp_c = None
+        self._last_update_at = None
+        self.reason = reason
+
+    def as_dict(self):
+        """
+        The thermostat's state, for the status API
+        """
+        return {
+            "mode": self.mode,
+            "active": int(self.is_active()),
+            "target_temperature": self.get_target_temperature(),
+            "demand": round(self.demand, 3) if self.demand is not None else None,
+            "calling_for_heat": self.calling_for_heat,
+            "reason": self.reason,
+        }
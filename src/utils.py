@@ -6,9 +6,14 @@
     Useful functions
 """
 import copy
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor, wait as concurrent_wait
 import datetime
+import io
 import random
-from decimal import Decimal, InvalidOperation
+import string
+import struct
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
 
 import six
 from dateutil.relativedelta import relativedelta
@@ -17,17 +22,44 @@ import pigpio
 import os
 import logging
 import subprocess
-from time import sleep
+from time import sleep, perf_counter, monotonic
 
 import pytz as pytz
 from pigpio_dht import DHT11, DHT22
+from twisted.internet import reactor, task, defer, threads
 from twisted.web.server import Request
 
 from src.config import NOT_SET, get_current_timezone, DEBUG
+from src.metrics import REGISTRY
+from src.registry import VersionedRegistry
 
 
 logging.basicConfig(format='[%(asctime)s RASPIhome] %(message)s', datefmt='%H:%M:%S', level=logging.INFO)
 
+PIGPIO_READ_SECONDS = REGISTRY.histogram("raspitherm_pigpio_read_seconds", "Time taken to read a pin from pigpiod")
+PIGPIO_ERRORS = REGISTRY.counter("raspitherm_pigpio_errors_total", "Pin reads and writes which failed or found the interface disconnected")
+DHT_READ_SECONDS = REGISTRY.histogram("raspitherm_dht_read_seconds", "Time taken by blocking temperature/humidity sensor reads", buckets=(0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0))
+DHT_TIMEOUTS = REGISTRY.counter("raspitherm_dht_timeouts_total", "Temperature/humidity sensor reads which timed out")
+DHT_IMPLAUSIBLE_READINGS = REGISTRY.counter("raspitherm_dht_implausible_readings_total", "Temperature/humidity readings ignored as nonsense")
+DHT_RESETS = REGISTRY.counter("raspitherm_dht_resets_total", "Temperature/humidity sensor power-cycles")
+DHT_READ_REQUESTS_COALESCED = REGISTRY.counter("raspitherm_dht_read_requests_coalesced_total", "Temperature/humidity read requests served by a read which was already scheduled")
+W1_READ_SECONDS = REGISTRY.histogram("raspitherm_w1_read_seconds", "Time taken to read the DS18B20 water temperature sensor", buckets=(0.001, 0.01, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5))
+W1_READ_ERRORS = REGISTRY.counter("raspitherm_w1_read_errors_total", "DS18B20 water temperature reads which failed")
+W1_BUS_SCANS = REGISTRY.counter("raspitherm_w1_bus_scans_total", "Times the w1 bus was listed looking for DS18B20 probes")
+W1_SAMPLE_SECONDS = REGISTRY.histogram("raspitherm_w1_sample_seconds", "Time taken to read all the DS18B20 probes in the background", buckets=(0.01, 0.1, 0.25, 0.5, 0.75, 1.0, 1.5, 2.5, 5.0, 10.0))
+W1_SAMPLE_OVERRUNS = REGISTRY.counter("raspitherm_w1_sample_overruns_total", "Background DS18B20 samples skipped because the previous one hadn't finished")
+W1_SAMPLE_AGE_SECONDS = REGISTRY.gauge("raspitherm_w1_sample_age_seconds", "How old the cached DS18B20 readings served to requests are")
+PULSES = REGISTRY.counter("raspitherm_pulses_total", "Toggle pin pulses, by how they were timed")
+PIN_EDGES = REGISTRY.counter("raspitherm_pin_edges_total", "Level changes reported by pigpio on watched input pins")
+PIN_RESYNC_CORRECTIONS = REGISTRY.counter("raspitherm_pin_resync_corrections_total", "Times a watched pin's remembered level was found to be wrong when re-read")
+PIGPIO_CONNECTED = REGISTRY.gauge("raspitherm_pigpio_connected", "1 if we are connected to pigpiod, otherwise 0")
+PIGPIO_DISCONNECTS = REGISTRY.counter("raspitherm_pigpio_disconnects_total", "Times the connection to pigpiod has been lost")
+PIGPIO_RECONNECT_ATTEMPTS = REGISTRY.counter("raspitherm_pigpio_reconnect_attempts_total", "Attempts to reconnect to pigpiod")
+PIGPIO_RECONNECTS = REGISTRY.counter("raspitherm_pigpio_reconnects_total", "Times we have successfully reconnected to pigpiod")
+
+# What pigpio raises when pigpiod goes away: IOErrors from the socket, or struct.errors when a reply comes back empty
+PIGPIO_CONNECTION_ERRORS = (AttributeError, IOError, pigpio.error, struct.error)
+
 
 def D(item="", *args, **kwargs):
     if DEBUG:
@@ -84,7 +116,6 @@ class SmartRequest(Request, object):
         
         @return: ["val1","val2"] LIST of arguments, or the default
         """
-        print(self.args)
         try:
             return self.args[name]
         except KeyError:
@@ -165,6 +196,92 @@ class SmartRequest(Request, object):
         """
         return self.get_param(name)
 
+    def write_and_finish(self, body):
+        """
+        Writes the body and closes off a deferred (NOT_DONE_YET) response. Fails safely if the
+        client has already hung up on us.
+
+        @param body: <bytes> The response body
+        @return: <bool> True if the response was delivered
+        """
+        if self.finished or self._disconnected:
+            return False
+        self.write(body)
+        self.finish()
+        return True
+
+
+class TemplateCache(object):
+    """
+    A str.format() style template, read from disk once and pre-split into its literal text and
+    replacement fields. Only re-read if the file's mtime changes.
+
+        Usage:
+            template = TemplateCache("/path/to/index.html")
+            html = template.render({"hw_status": "on", ...})
+    """
+    template_path = None
+    mtime = None
+    parts = ()  # Tuples of (literal_text, field_name, format_spec, conversion)
+
+    def __init__(self, template_path):
+        self.template_path = template_path
+        self._formatter = string.Formatter()
+        self._buffer = io.StringIO()  # Reused between renders
+        self.load()
+
+    def load(self):
+        """
+        Reads the template file and splits it up, ready for rendering
+        """
+        mtime = os.stat(self.template_path).st_mtime
+        with open(self.template_path, "r") as template_file:
+            template_str = template_file.read()  # Reads en bloc. More preferable to line by line concatenation
+        self.parts = tuple(self._formatter.parse(template_str))
+        self.mtime = mtime
+        return self.parts
+
+    def reload_if_changed(self):
+        """
+        Reloads the template if the file has been modified since we last read it.
+        Keeps the cached version if the file has gone walkies.
+        """
+        try:
+            mtime = os.stat(self.template_path).st_mtime
+        except OSError as e:
+            logging.warning("TemplateCache.reload_if_changed(): cannot stat {}: {}".format(self.template_path, e))
+            return False
+        if mtime != self.mtime:
+            logging.info("Template {} has changed, reloading.".format(self.template_path))
+            self.load()
+            return True
+        return False
+
+    def render(self, context):
+        """
+        Renders the template with the context dict given
+
+        @param context: <dict> Values for the replacement fields
+        @return: <str> The rendered template
+        """
+        self.reload_if_changed()
+        buffer = self._buffer
+        buffer.seek(0)
+        buffer.truncate()
+        for literal_text, field_name, format_spec, conversion in self.parts:
+            if literal_text:
+                buffer.write(literal_text)
+            if field_name is None:
+                continue
+            try:
+                value = context[field_name]
+            except KeyError:  # Dotted or indexed field names e.g. {th.temp_c}
+                value = self._formatter.get_field(field_name, (), context)[0]
+            if conversion:
+                value = self._formatter.convert_field(value, conversion)
+            buffer.write(format(value, format_spec))
+        return buffer.getvalue()
+
 
 class PiPinInterface(pigpio.pi, object):
     """
@@ -175,7 +292,7 @@ class PiPinInterface(pigpio.pi, object):
     """
     
     def __init__(self, params):
-        super(PiPinInterface, self).__init__(params['pi_host'], params['pig_port'])
+        super(PiPinInterface, self).__init__(params['pi_host'], params['pig_port'], show_errors=params.get('show_errors', True))
     
     def __unicode__(self):
         """
@@ -210,11 +327,237 @@ class PiPinInterface(pigpio.pi, object):
         return supplementary_interface
 
 
+class PigpioConnectionManager(object):
+    """
+    Keeps a device connected to pigpiod. pigpiod forgets everything when it restarts, and pigpio.pi
+    never reconnects by itself, so:
+        * A health check pings pigpiod every health_check_seconds. A failed ping, or a pin read/write
+          failing with a connection error, marks the connection as lost
+        * We then try to reconnect in the background, waiting reconnect_min_seconds, doubling after each
+          failed attempt up to reconnect_max_seconds (plus a little jitter)
+        * Once reconnected, the device's on_interface_reconnected() sets its pins up again
+
+    Connecting, pinging and stopping old interfaces all happen in threads, so the reactor is never held up.
+    """
+    HEALTH_CHECK_SECONDS = 5.0
+    RECONNECT_MIN_SECONDS = 1.0
+    RECONNECT_MAX_SECONDS = 60.0
+    RECONNECT_JITTER = 0.1  # Up to this fraction is added to each wait
+
+    state = "connected"  # connected / disconnected / reconnecting
+    since = None  # When we last connected or lost the connection (clock seconds)
+    last_error = None  # Why we last lost / failed to get the connection
+    n_disconnects = 0
+    n_reconnects = 0
+    retry_delay_seconds = None  # How long the next wait before reconnecting will be
+    _retry_call = None  # DelayedCall for the next reconnect attempt
+    _loop = None  # Health check LoopingCall
+    _checking = False  # A health check ping is under way
+    _stopped = False
+
+    def __init__(self, device, params, clock=None):
+        """
+        @param device: <BaseRaspiHomeDevice> Whose interface we look after
+        @param params: <dict> The pigpiod connection settings (pi_host, pig_port), plus optionally
+                       pigpio_health_check_seconds, pigpio_reconnect_min_seconds, pigpio_reconnect_max_seconds
+        @keyword clock: Twisted IReactorTime. Defaults to the global reactor
+        """
+        self.device = device
+        self.params = copy.copy(params)
+        self.params["show_errors"] = False  # pigpio's big banner is no use to us every few seconds
+        self.clock = clock or reactor
+        self.health_check_seconds = float(params.get("pigpio_health_check_seconds", self.HEALTH_CHECK_SECONDS))
+        self.reconnect_min_seconds = float(params.get("pigpio_reconnect_min_seconds", self.RECONNECT_MIN_SECONDS))
+        self.reconnect_max_seconds = float(params.get("pigpio_reconnect_max_seconds", self.RECONNECT_MAX_SECONDS))
+        self.retry_delay_seconds = self.reconnect_min_seconds
+        self.since = self.clock.seconds()
+        if not self.get_iface_connected():
+            self.state = "disconnected"
+            self.last_error = "Could not connect to pigpiod at {}:{}".format(self.params.get("pi_host"), self.params.get("pig_port"))
+        PIGPIO_CONNECTED.set_callback(lambda: int(self.is_connected()))
+
+    def __repr__(self):
+        return "<PigpioConnectionManager {}:{} {}>".format(self.params.get("pi_host"), self.params.get("pig_port"), self.state)
+
+    def get_iface_connected(self):
+        try:
+            return bool(self.device.iface.connected)
+        except AttributeError:
+            return False
+
+    def is_connected(self):
+        return self.state == "connected"
+
+    def start(self):
+        """
+        Starts the health checks, and reconnecting if we aren't connected to begin with
+
+        @return: <LoopingCall> the health check loop
+        """
+        self._stopped = False
+        self._loop = task.LoopingCall(self.check)
+        self._loop.clock = self.clock
+        self._loop.start(self.health_check_seconds, now=False)
+        if self.state == "disconnected":
+            self.schedule_reconnect()
+        return self._loop
+
+    def stop(self):
+        self._stopped = True
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+        if self._retry_call is not None and self._retry_call.active():
+            self._retry_call.cancel()
+        self._retry_call = None
+
+    def check(self):
+        """
+        Pings pigpiod in a thread. Called by the health check loop.
+        """
+        if self.state != "connected" or self._checking:
+            return None
+        self._checking = True
+        iface = self.device.iface
+        d = threads.deferToThread(self._ping, iface)
+        d.addCallbacks(self._ping_succeeded, self._ping_failed, errbackArgs=(iface,))
+        return d
+
+    @staticmethod
+    def _ping(iface):
+        """
+        BLOCKING: Runs in a thread
+        """
+        if not iface.connected:
+            raise IOError("Interface not connected")
+        return iface.get_current_tick()
+
+    def _ping_succeeded(self, _tick):
+        self._checking = False
+
+    def _ping_failed(self, failure, iface):
+        self._checking = False
+        if self.device.iface is iface:  # Might have been replaced while we were waiting
+            self.connection_lost(failure.getErrorMessage() or failure.type.__name__)
+
+    def connection_error(self, error):
+        """
+        Tells us a pin operation hit a connection error. Safe to call from any thread.
+        """
+        reactor.callFromThread(self.connection_lost, "{}: {}".format(error.__class__.__name__, error))
+
+    def connection_lost(self, reason=""):
+        """
+        Drops the dead interface and starts trying to reconnect
+        """
+        if self.state != "connected":
+            return
+        PIGPIO_DISCONNECTS.inc()
+        self.n_disconnects += 1
+        self.last_error = reason
+        logging.error("ERROR: Lost connection to pigpiod ({}). Reconnecting in the background.".format(reason))
+        self._set_state("disconnected")
+        old_iface = self.device.iface
+        if old_iface is not None:
+            old_iface.connected = False  # So reads and writes fail fast (or are emulated) until we're back
+        self.device.on_interface_lost()
+        if old_iface is not None:
+            threads.deferToThread(self._stop_interface, old_iface)
+        self.retry_delay_seconds = self.reconnect_min_seconds
+        self.schedule_reconnect()
+
+    def schedule_reconnect(self):
+        if self._stopped or (self._retry_call is not None and self._retry_call.active()):
+            return
+        delay = self.retry_delay_seconds * (1.0 + random.random() * self.RECONNECT_JITTER)
+        self._retry_call = self.clock.callLater(delay, self.reconnect)
+
+    def reconnect(self):
+        """
+        Tries to connect a new interface, in a thread
+        """
+        self._retry_call = None
+        if self._stopped or self.state == "connected":
+            return None
+        PIGPIO_RECONNECT_ATTEMPTS.inc()
+        self._set_state("reconnecting")
+        d = threads.deferToThread(PiPinInterface, self.params)
+        d.addCallbacks(self._reconnect_finished, self._reconnect_failed)
+        return d
+
+    def _reconnect_finished(self, iface):
+        if not iface.connected:
+            return self._reconnect_failed(None, "Could not connect to pigpiod at {}:{}".format(self.params.get("pi_host"), self.params.get("pig_port")))
+        if self._stopped:
+            threads.deferToThread(self._stop_interface, iface)
+            return None
+        self.device.iface = iface
+        self.retry_delay_seconds = self.reconnect_min_seconds
+        self.n_reconnects += 1
+        PIGPIO_RECONNECTS.inc()
+        self._set_state("connected")
+        logging.info("Reconnected to pigpiod at {}:{}".format(self.params.get("pi_host"), self.params.get("pig_port")))
+        self.device.on_interface_reconnected()
+        return iface
+
+    def _reconnect_failed(self, failure, reason=None):
+        self.last_error = reason or failure.getErrorMessage()
+        self._set_state("disconnected")
+        self.retry_delay_seconds = min(self.retry_delay_seconds * 2, self.reconnect_max_seconds)
+        self.schedule_reconnect()
+        return None
+
+    @staticmethod
+    def _stop_interface(iface):
+        """
+        BLOCKING: Runs in a thread
+        """
+        try:
+            iface.stop()
+        except PIGPIO_CONNECTION_ERRORS:
+            pass
+
+    def _set_state(self, state):
+        if (state == "connected") != self.is_connected():
+            self.since = self.clock.seconds()
+        self.state = state
+
+    def as_dict(self):
+        """
+        The connection's health, for the status API. Only things which change when the connection does,
+        so it doesn't churn the status snapshot's version.
+        """
+        return {
+            "connected": int(self.is_connected()),
+            "since": datetime.datetime.fromtimestamp(self.since).isoformat(timespec="seconds"),
+            "disconnects": self.n_disconnects,
+            "reconnects": self.n_reconnects,
+            "last_error": self.last_error,
+        }
+
+
 class TemperatureHumiditySensor(object):
     """
     Binds a temperature/humidity sensor
     Uses DHTXX class, which is an interface to pigpio.pi(). pigpio_interface keyword allows us to reuse objects.
+
+    Non-blocking reads are done by one long-lived worker thread. Asking for a read while one is already
+    scheduled just shares that read, and reads are never started closer together than lockout_secs.
+
+    If the sensor keeps timing out, and we have a sensor_power_pin, it is power-cycled by a state machine
+    driven by reactor timers, so no thread is held up while we wait:
+        idle -> powered_off (RESET_POWER_OFF_SECONDS) -> warming (RESET_WARM_UP_SECONDS) -> probing -> idle
+    Probing asks for a read: the first read to finish, good or bad, ends the reset. If no read has finished
+    within RESET_PROBE_SECONDS (it was skipped, or failed in a way that isn't a timeout), the reset ends
+    as a failure anyway, so we're never stuck probing.
     """
+    RESET_IDLE = "idle"
+    RESET_POWERED_OFF = "powered_off"
+    RESET_WARMING = "warming"
+    RESET_PROBING = "probing"
+    RESET_POWER_OFF_SECONDS = 20  # Enough time to let capacitors discharge
+    RESET_WARM_UP_SECONDS = 5  # Enough time to let the sensor initialise once powered back on
+    RESET_PROBE_SECONDS = 30  # Longest we wait for the probing read: the lockout plus a read with its retries
+
     iface_class = DHT11
     iface = None
     pigpio_interface = None
@@ -222,9 +565,17 @@ class TemperatureHumiditySensor(object):
     sensor_power_pin = None
     mode = 11
     lockout_secs = 10
-    async_read_thread = None
-    async_reset_thread = None
-    last_data = None
+    worker_thread = None  # Does the non-blocking reads
+    clock = None  # Twisted IReactorTime for the reset timers. Defaults to the global reactor
+    reset_state = RESET_IDLE  # Where we are in power-cycling the sensor
+    reset_call = None  # DelayedCall for the reset's next step
+    n_resets = 0
+    last_reset_result = None  # "recovered" or "still failing" once a reset has finished
+    last_data = None  # Latest good reading. Only ever replaced by a complete new dict, never changed in place, so other threads can read it safely
+    _read_condition = None  # Guards the read schedule, and wakes the worker
+    _next_read_at = None  # When the worker should next read the sensor (monotonic seconds). None if no read is wanted
+    _last_read_at = None  # When the worker last started a read (monotonic seconds)
+    _stopping = False
     last_query_time = None
     n_timeouts_since_last_successful_read = 0
     MAX_BELIEVABLE_CHANGE_IN_TEMPERATURE_PER_MINUTE = Decimal("6.5")  # Absolute change. i.e. +/-6.5 degrees per minute either way will count.
@@ -248,6 +599,7 @@ class TemperatureHumiditySensor(object):
         self.gpio_pin = gpio
         self.sensor_power_pin = sensor_power_pin or self.sensor_power_pin
         self.pigpio_interface = pigpio_interface
+        self._read_condition = threading.Condition()
 
     def get_mode_str(self):
         """
@@ -285,6 +637,14 @@ class TemperatureHumiditySensor(object):
         print("\tTemperature/Humidity {} sensor added on pin {}.".format(self.iface_class.__name__, gpio))
         return self.iface
 
+    def use_pigpio_interface(self, pigpio_interface):
+        """
+        Switches to a new Pigpio interface, e.g. after reconnecting to pigpiod. The DHT interface is rebuilt on the next read.
+        """
+        self.pigpio_interface = pigpio_interface
+        if self.iface != "EMULATED":
+            self.iface = None
+
     def check_data_just_read_is_realistic(self, data_just_read, read_datetime):
         """
         Calculate the delta-T and if it's clearly bonkers, suppress the read.
@@ -329,6 +689,8 @@ class TemperatureHumiditySensor(object):
             queried_ago_td = now - self.last_query_time
             if queried_ago_td.seconds < self.lockout_secs:
                 query_again = False
+        if self.reset_state in (self.RESET_POWERED_OFF, self.RESET_WARMING):  # Nothing to read until it's back up
+            query_again = False
         if iface is None:  # Necessary workaround to stop threads from spinning up another interface
             iface = self.get_interface()
         if query_again:
@@ -342,61 +704,130 @@ class TemperatureHumiditySensor(object):
             else:
                 # Otherwise actually attempt to read the sensor
                 try:
-                    latest_temp_humidity = iface.read(retries=3)  # Blocking!!
+                    with DHT_READ_SECONDS.time():
+                        latest_temp_humidity = iface.read(retries=3)  # Blocking!!
                 except TimeoutError:
+                    DHT_TIMEOUTS.inc()
                     logging.warning("{}.read(): Sensor timeout, pin {}! Reset power pin {}".format(self.__class__.__name__, self.gpio_pin, self.sensor_power_pin))
                     self.n_timeouts_since_last_successful_read += 1
-                    if self.n_timeouts_since_last_successful_read >= 16:
+                    if self.reset_state == self.RESET_PROBING:
+                        logging.warning("Last reset attempt appeared to be unsuccessful.")
+                        reactor.callFromThread(self._finish_reset, False)
+                    elif self.n_timeouts_since_last_successful_read >= 16:
                         logging.warning("Too many sensor timeouts. I give up!")
                         self.last_data = {}
-                        return self.last_data
+                        return {}
                     elif self.n_timeouts_since_last_successful_read >= 2 and self.sensor_power_pin:
                         logging.info("Temperature sensor has crashed... Resetting via pin %s!" % self.sensor_power_pin)
-                        self.reset_sensor(iface=iface)  # Blocking
-                        # After a reset, let's try to read it again...
-                        try:
-                            latest_temp_humidity = iface.read(retries=2)  # Blocking!!
-                        except TimeoutError:
-                            logging.warning("Last reset attempt appeared to be unsuccessful.")
-                            return self.last_data or {}
-                    else:
-                        return self.last_data or {}
+                        self.reset_sensor()  # Carries on in the background
+                    return self.last_data or {}
+            if self.reset_state == self.RESET_PROBING:
+                reactor.callFromThread(self._finish_reset, bool(latest_temp_humidity.get("valid")))
             if latest_temp_humidity.get("valid"):  # Only return a value if it is valid!
                 self.last_query_time = now  # We have successfully polled it here. We don't want to hammer the sensor, even if it spat out bollocks.
                 # Bail if it's clearly not a sensible temperature.
                 if not self.check_data_just_read_is_realistic(data_just_read=latest_temp_humidity, read_datetime=now):
                     logging.warning("Latest temperature (%s) is likely to be nonsense. Ignoring it.", latest_temp_humidity.get("temp_c", "?"))
+                    DHT_IMPLAUSIBLE_READINGS.inc()
                     self.n_timeouts_since_last_successful_read += 1  # Treat as a failing sensor.
                     return self.last_data or {}
                 self.n_timeouts_since_last_successful_read = 0
-                self.last_data = latest_temp_humidity or {}
-                self.last_data["query_timestamp"] = now
+                data = dict(latest_temp_humidity or {})
+                data["query_timestamp"] = now
+                self.last_data = data  # Publish the finished reading in one go
                 print(latest_temp_humidity)
-                return self.last_data
+                return data
         return self.last_data
 
-    def reset_sensor(self, iface=None):
+    def reset_sensor(self):
         """
-        Kills power to the sensor, reinstates power, thus resetting it.
+        Kills power to the sensor, reinstates power, thus resetting it. Returns straight away: the reset
+        carries on in the background, driven by reactor timers. Safe to call from any thread.
 
-        BLOCKING
-
-        :param iface: The interface class instance. Required when calling read() in threads. Otherwise fetches from self.
+        :return: True if a reset has been started (or already was under way), None if we can't reset
         """
         # Only perform a reset if there is a sensor power pin
         if not self.sensor_power_pin:
             print("\treset_sensor(): There is no reset pin configured. Ignoring reset request.")
             return None
+        reactor.callFromThread(self._start_reset)
+        return True
+
+    def get_clock(self):
+        if self.clock is None:
+            return reactor
+        return self.clock
 
-        print("\tPowering sensor off for 20 seconds...")
-        self.pigpio_interface.write(self.sensor_power_pin, pigpio.OFF)  # Off you go, twat.
-        sleep(20)  # Enough time to let capacitors discharge
-        print("\tPowering sensor back on...")
-        self.pigpio_interface.write(self.sensor_power_pin, pigpio.ON)  # Back on
-        print("\tPause for 5 seconds to let it initialise...")
-        sleep(5)  # Enough time to let the temperature sensor initialise
+    def _write_power_pin(self, value):
+        """
+        @return: <bool> True if the power pin was set
+        """
+        try:
+            self.pigpio_interface.write(self.sensor_power_pin, value)
+        except PIGPIO_CONNECTION_ERRORS as e:
+            logging.error("ERROR: Cannot switch temperature sensor power pin #%s: %s" % (self.sensor_power_pin, e))
+            return False
         return True
 
+    def _set_reset_state(self, state, next_step=None, delay=0):
+        self.reset_state = state
+        self.reset_call = None
+        if next_step is not None:
+            self.reset_call = self.get_clock().callLater(delay, next_step)
+
+    def _start_reset(self):
+        if self.reset_state != self.RESET_IDLE:
+            return  # Already under way
+        DHT_RESETS.inc()
+        self.n_resets += 1
+        print("\tPowering sensor off for {} seconds...".format(self.RESET_POWER_OFF_SECONDS))
+        if not self._write_power_pin(pigpio.OFF):  # Off you go, twat.
+            return
+        self._set_reset_state(self.RESET_POWERED_OFF, self._power_back_on, self.RESET_POWER_OFF_SECONDS)
+
+    def _power_back_on(self):
+        print("\tPowering sensor back on, pausing {} seconds to let it initialise...".format(self.RESET_WARM_UP_SECONDS))
+        if not self._write_power_pin(pigpio.ON):  # Back on
+            return self._finish_reset(False)
+        self._set_reset_state(self.RESET_WARMING, self._probe, self.RESET_WARM_UP_SECONDS)
+
+    def _probe(self):
+        self._set_reset_state(self.RESET_PROBING, self._probe_timed_out, self.RESET_PROBE_SECONDS)
+        self.read_non_blocking()
+
+    def _probe_timed_out(self):
+        logging.warning("Temperature sensor reset: no reading within {} seconds of powering back on.".format(self.RESET_PROBE_SECONDS))
+        self._finish_reset(False)
+
+    def _finish_reset(self, recovered):
+        if self.reset_state == self.RESET_IDLE:
+            return
+        if self.reset_call is not None and self.reset_call.active():  # The probe deadline
+            self.reset_call.cancel()
+        self.last_reset_result = "recovered" if recovered else "still failing"
+        logging.info("Temperature sensor reset finished: {}".format(self.last_reset_result))
+        self._set_reset_state(self.RESET_IDLE)
+
+    def cancel_reset(self):
+        """
+        Abandons any reset under way, making sure the sensor is left powered on
+        """
+        if self.reset_call is not None and self.reset_call.active():
+            self.reset_call.cancel()
+        if self.reset_state in (self.RESET_POWERED_OFF, self.RESET_WARMING):
+            self._write_power_pin(pigpio.ON)
+        self._set_reset_state(self.RESET_IDLE)
+
+    def get_status(self):
+        """
+        The sensor's health, for the status API
+        """
+        return {
+            "reset_state": self.reset_state,
+            "resets": self.n_resets,
+            "last_reset_result": self.last_reset_result,
+        }
+
     def _development_emulate_sensor_read(self):
         """
         Emulates reading the sensor for the purposes of development
@@ -426,22 +857,51 @@ class TemperatureHumiditySensor(object):
 
     def read_non_blocking(self, delay=0.0):
         """
-        Attempts to read the sensor, updates self.last_data without blocking.
-        :param delay: <float> how many seconds to pause before actually trying to read the sensor
-        """
-        async_thread_is_running = False
-        if self.async_read_thread and self.async_read_thread.is_alive():
-            async_thread_is_running = True
-        if not async_thread_is_running:
-            self.async_read_thread = threading.Thread(target=self.read, kwargs={"iface": self.iface, "delay": delay})
-            self.async_read_thread.start()
-            return True
-        else:
-            print("\tread_non_blocking(): A read is already taking place. Ignoring duplicate call.")
-            return None
+        Asks the worker thread to read the sensor, updating self.last_data, without blocking.
+        :param delay: <float> how many seconds to wait before actually trying to read the sensor
+        :return: True if a read has been scheduled, None if one was already scheduled (which will serve this request too)
+        """
+        with self._read_condition:
+            if self._stopping:
+                return None
+            if self._next_read_at is not None:
+                DHT_READ_REQUESTS_COALESCED.inc()
+                return None
+            read_at = monotonic() + delay
+            if self._last_read_at is not None:  # Don't hammer the sensor
+                read_at = max(read_at, self._last_read_at + self.lockout_secs)
+            self._next_read_at = read_at
+            if self.worker_thread is None or not self.worker_thread.is_alive():
+                self.worker_thread = threading.Thread(target=self._run_worker, name="{} worker".format(self), daemon=True)
+                self.worker_thread.start()
+            self._read_condition.notify()
+        return True
 
     read_async = read_non_blocking  # alias
 
+    def _run_worker(self):
+        """
+        The worker thread: waits for a read to be due, does it, repeat until teardown()
+        """
+        with self._read_condition:
+            while not self._stopping:
+                if self._next_read_at is None:
+                    self._read_condition.wait()
+                    continue
+                wait_seconds = self._next_read_at - monotonic()
+                if wait_seconds > 0:
+                    self._read_condition.wait(wait_seconds)
+                    continue
+                self._next_read_at = None
+                self._last_read_at = monotonic()
+                self._read_condition.release()  # Let requests queue up the next read while we're busy
+                try:
+                    self.read(iface=self.iface)
+                except Exception as e:  # Keep the worker alive whatever the sensor library throws at us
+                    logging.exception("{}: sensor read failed: {}".format(self, e))
+                finally:
+                    self._read_condition.acquire()
+
     def get_temp_c(self):
         data = self.read()
         return data.get("temp_c", None)
@@ -473,10 +933,269 @@ class TemperatureHumiditySensor(object):
         """
         Tear down any async threads here.
         """
-        if self.async_read_thread:
-            self.async_read_thread.join(timeout=3.0)
-        if self.async_reset_thread:
-            self.async_reset_thread.join(timeout=2.0)
+        with self._read_condition:
+            self._stopping = True
+            self._next_read_at = None
+            self._read_condition.notify()
+        self.cancel_reset()
+        if self.worker_thread:
+            self.worker_thread.join(timeout=3.0)
+
+
+class W1Bus(object):
+    """
+    The kernel's single-wire bus, holding every DS18B20-compatible probe plugged into it.
+
+    The bus directory is listed once, and the probes found are cached as {device_id: path}, so reads go
+    straight to the probe's files. A probe which isn't there (yet) triggers a rescan, but no more often
+    than every RESCAN_MIN_SECONDS, so a missing probe can't have us listing the bus on every read.
+
+    A DS18B20 takes up to 750ms to convert a reading, during which its read blocks. read_sensors() reads
+    several probes at once in a small pool of threads, so polling N probes takes about as long as the
+    slowest one rather than N x 750ms. A probe which hangs isn't asked again until its last read returns,
+    so it can't tie up the whole pool.
+    """
+    base_dir = "/sys/bus/w1/devices"
+    device_prefix = "28-"
+    RESCAN_MIN_SECONDS = 60  # Don't list the bus more often than this looking for probes we haven't found
+    MAX_READ_THREADS = 4  # How many probes we read at once
+    READ_TIMEOUT_SECONDS = 5  # Give up waiting on a batch of probe reads after this
+
+    _default = None  # The W1Bus shared by sensors which weren't given one
+
+    def __init__(self, base_dir=None, rescan_seconds=None, max_read_threads=None, clock=None):
+        """
+        @keyword base_dir: <str> Where the kernel exposes the w1 devices
+        @keyword rescan_seconds: <float> Overrides RESCAN_MIN_SECONDS
+        @keyword max_read_threads: <int> Overrides MAX_READ_THREADS
+        @keyword clock: <callable> Returns monotonic seconds. For tests
+        """
+        self.base_dir = base_dir or self.base_dir
+        if rescan_seconds is not None:
+            self.RESCAN_MIN_SECONDS = rescan_seconds
+        if max_read_threads:
+            self.MAX_READ_THREADS = max_read_threads
+        self.clock = clock or monotonic
+        self.device_paths = OrderedDict()  # {device_id: path}, in the order found
+        self.last_scan_at = None
+        self.n_scans = 0
+        self.executor = None
+        self.pending = {}  # {WaterTemperatureSensor: Future} of reads which haven't come back yet
+        self.lock = threading.Lock()  # Sensors are read from pool threads
+
+    @classmethod
+    def get_default(cls):
+        """
+        @return: <W1Bus> The bus shared by every sensor in this process
+        """
+        if cls._default is None:
+            cls._default = cls()
+        return cls._default
+
+    def scan(self, force=False):
+        """
+        Lists the bus for probes, unless we did so within RESCAN_MIN_SECONDS
+
+        @keyword force: <bool> Scan regardless of when we last did
+        @return: <OrderedDict> {device_id: path} of the probes we know about
+        """
+        with self.lock:
+            now = self.clock()
+            if not force and self.last_scan_at is not None and now - self.last_scan_at < self.RESCAN_MIN_SECONDS:
+                return self.device_paths
+            self.last_scan_at = now
+            self.n_scans += 1
+            W1_BUS_SCANS.inc()
+            if not os.path.isdir(self.base_dir):
+                logging.debug("W1Bus.scan(): no w1 devices directory %s", self.base_dir)
+                return self.device_paths
+            try:
+                device_ids = sorted(d for d in os.listdir(self.base_dir) if d.startswith(self.device_prefix))
+            except OSError as e:
+                logging.warning("W1Bus.scan(): unable to list w1 devices: %s", e)
+                return self.device_paths
+            device_paths = OrderedDict()
+            for device_id in device_ids:
+                candidate_path = os.path.join(self.base_dir, device_id)
+                if os.path.exists(os.path.join(candidate_path, "temperature")) or os.path.exists(os.path.join(candidate_path, "w1_slave")):
+                    device_paths[device_id] = candidate_path
+            for device_id in device_paths:
+                if device_id not in self.device_paths:
+                    logging.info("W1Bus: found probe %s", device_id)
+            self.device_paths = device_paths
+            return self.device_paths
+
+    def get_device_path(self, device_id=None):
+        """
+        @keyword device_id: <str> The probe wanted e.g. 28-0316a27979ff. None for the first probe on the bus
+        @return: <str> The probe's directory, or None if it isn't on the bus
+        """
+        device_paths = self.device_paths
+        if not device_paths or (device_id and device_id not in device_paths):
+            device_paths = self.scan()
+        if device_id:
+            return device_paths.get(device_id)
+        for path in device_paths.values():
+            return path
+        return None
+
+    def forget(self, device_id):
+        """
+        Drops a probe whose files have gone, so the next read looks for it again
+        """
+        with self.lock:
+            self.device_paths.pop(device_id, None)
+
+    def read_sensors(self, sensors, timeout=None):
+        """
+        Reads several WaterTemperatureSensors at once. Blocks, so call it from a thread.
+
+        @param sensors: <dict> {name: WaterTemperatureSensor}
+        @keyword timeout: <float> Seconds to wait for the batch. Defaults to READ_TIMEOUT_SECONDS
+        @return: <OrderedDict> {name: reading}. Sensors which didn't answer in time get their last reading
+        """
+        timeout = timeout or self.READ_TIMEOUT_SECONDS
+        if self.executor is None:
+            self.executor = ThreadPoolExecutor(max_workers=self.MAX_READ_THREADS, thread_name_prefix="w1")
+        futures = OrderedDict()
+        for name, sensor in sensors.items():
+            if sensor is None:
+                continue
+            future = self.pending.get(sensor)
+            if future is None:  # Otherwise we're still waiting on the last read
+                future = self.pending[sensor] = self.executor.submit(sensor.read)
+            futures[name] = future
+        concurrent_wait(list(futures.values()), timeout=timeout)
+        readings = OrderedDict()
+        for name, future in futures.items():
+            sensor = sensors[name]
+            if not future.done():
+                W1_READ_ERRORS.inc()
+                logging.warning("W1Bus.read_sensors(): %s did not answer within %ss", name, timeout)
+                readings[name] = sensor.read_last_result()
+                continue
+            self.pending.pop(sensor, None)
+            if future.exception():
+                W1_READ_ERRORS.inc()
+                logging.warning("W1Bus.read_sensors(): unable to read %s: %s", name, future.exception())
+                readings[name] = sensor.read_last_result()
+            else:
+                readings[name] = future.result()
+        return readings
+
+    def teardown(self):
+        if self.executor is not None:
+            self.executor.shutdown(wait=False)
+            self.executor = None
+        return True
+
+
+class W1Sampler(object):
+    """
+    Reads a device's DS18B20 probes on a background schedule. A probe's sysfs file can take most of a
+    second to read while it converts, so reads happen in a thread with a deadline, and the readings are
+    handed back on the reactor thread. Requests only ever see the last readings cached, never the probes.
+    """
+    SAMPLE_SECONDS = 10.0
+    DEADLINE_SECONDS = 5.0  # Probes which haven't answered by now keep their last reading
+
+    last_sample_at = None  # When the last sample came back (clock seconds)
+    last_error = None  # Why the last sample failed, if it did
+    n_overruns = 0
+    _in_flight = None  # Deferred for the sample under way
+    _loop = None  # Sampling LoopingCall
+
+    def __init__(self, bus, get_sensors, on_readings, sample_seconds=None, deadline_seconds=None, clock=None):
+        """
+        @param bus: <W1Bus> The bus the probes are read through
+        @param get_sensors: <callable> Returns {name: WaterTemperatureSensor} of the probes to read
+        @param on_readings: <callable> Given {name: reading} on the reactor thread after each sample
+        @keyword sample_seconds: <float> Overrides SAMPLE_SECONDS
+        @keyword deadline_seconds: <float> Overrides DEADLINE_SECONDS
+        @keyword clock: Twisted IReactorTime. Defaults to the global reactor
+        """
+        self.bus = bus
+        self.get_sensors = get_sensors
+        self.on_readings = on_readings
+        self.sample_seconds = float(sample_seconds or self.SAMPLE_SECONDS)
+        self.deadline_seconds = float(deadline_seconds or self.DEADLINE_SECONDS)
+        self.clock = clock or reactor
+
+    def __repr__(self):
+        return "<W1Sampler every {}s>".format(self.sample_seconds)
+
+    def start(self):
+        """
+        Starts sampling, straight away
+
+        @return: <LoopingCall> the sampling loop
+        """
+        W1_SAMPLE_AGE_SECONDS.set_callback(lambda: self.get_age_seconds() or 0.0)
+        self._loop = task.LoopingCall(self.sample)
+        self._loop.clock = self.clock
+        self._loop.start(self.sample_seconds, now=True)
+        return self._loop
+
+    def stop(self):
+        if self._loop is not None and self._loop.running:
+            self._loop.stop()
+
+    def sample(self):
+        """
+        Reads the probes in a thread. Called by the sampling loop.
+
+        @return: <Deferred> which fires once the readings have been handed over, or None if there was nothing to do
+        """
+        if self._in_flight is not None:
+            self.n_overruns += 1
+            W1_SAMPLE_OVERRUNS.inc()
+            return None
+        sensors = self.get_sensors()
+        if not sensors:
+            return None
+        started = perf_counter()
+        d = threads.deferToThread(self.bus.read_sensors, sensors, timeout=self.deadline_seconds)
+        d.addTimeout(self.deadline_seconds + 1.0, self.clock)  # read_sensors keeps to the deadline itself. This is in case it can't
+        d.addCallback(self._sampled, started)
+        d.addErrback(self._sample_failed)
+        d.addBoth(self._finished)
+        self._in_flight = d
+        return d
+
+    def _sampled(self, readings, started):
+        W1_SAMPLE_SECONDS.observe(perf_counter() - started)
+        self.last_sample_at = self.clock.seconds()
+        self.last_error = None
+        self.on_readings(readings)
+        return readings
+
+    def _sample_failed(self, failure):
+        self.last_error = "{}: {}".format(failure.type.__name__, failure.getErrorMessage())
+        logging.error("ERROR: W1Sampler could not read the DS18B20 probes: {}".format(self.last_error))
+        return None
+
+    def _finished(self, result):
+        self._in_flight = None
+        return result
+
+    def get_age_seconds(self):
+        """
+        @return: <float> How old the cached readings are, or None if we've never sampled
+        """
+        if self.last_sample_at is None:
+            return None
+        return max(self.clock.seconds() - self.last_sample_at, 0.0)
+
+    def as_dict(self):
+        """
+        The sampler's settings and health, for the status API. Not when it last sampled, which would
+        churn the status snapshot's version every sample: the listener sends get_age_seconds() as a header instead.
+        """
+        return {
+            "sample_seconds": self.sample_seconds,
+            "deadline_seconds": self.deadline_seconds,
+            "last_error": self.last_error,
+        }
 
 
 class WaterTemperatureSensor(object):
@@ -484,38 +1203,37 @@ class WaterTemperatureSensor(object):
     Represents a single-wire water temperature sensor (e.g. DS18B20).
     Uses the kernel w1 device interface, and holds on to the last believable value.
     """
-    base_dir = "/sys/bus/w1/devices"
-    device_prefix = "28-"
     MAX_BELIEVABLE_CHANGE_IN_TEMPERATURE_PER_MINUTE = Decimal("13.0")  # Very rapid changes get ignored. This sensor is much less noisy compared to DHT11 so we can be less restrictive.
 
-    def __init__(self, gpio_pin=0):
+    def __init__(self, gpio_pin=0, device_id=None, bus=None):
+        """
+        @keyword device_id: <str> The w1 device id of the probe we want e.g. 28-0316a27979ff. If not
+                            given, we use the first probe we find.
+        @keyword bus: <W1Bus> The bus the probe is on. Defaults to the one shared by all sensors
+        """
         self.gpio_pin = gpio_pin
+        self.device_id = device_id or None
+        self.bus = bus or W1Bus.get_default()
         self.device_path = None
+        self.data_file = None  # The file we read: "temperature" on newer kernels, else "w1_slave"
         self.last_data = {}
         self.last_query_time = None
         self.detect_sensor()
 
     def detect_sensor(self):
         """
-        Locates a DS18B20-compatible device exposed via the w1 kernel interface.
+        Locates a DS18B20-compatible device exposed via the w1 kernel interface. The bus caches what it
+        finds, and rate-limits looking again, so calling this on every read of a missing probe is cheap.
         """
-        if not os.path.isdir(self.base_dir):
-            logging.debug("WaterTemperatureSensor.detect_sensor(): no w1 devices directory %s", self.base_dir)
-            return None
-        try:
-            device_dirs = [d for d in os.listdir(self.base_dir) if d.startswith(self.device_prefix)]
-        except OSError as e:
-            logging.warning("WaterTemperatureSensor.detect_sensor(): unable to list w1 devices: %s", e)
+        device_path = self.bus.get_device_path(self.device_id)
+        if not device_path:
             return None
-        for device_dir in device_dirs:
-            candidate_path = os.path.join(self.base_dir, device_dir)
-            temperature_file = os.path.join(candidate_path, "temperature")
-            legacy_file = os.path.join(candidate_path, "w1_slave")
-            if os.path.exists(temperature_file) or os.path.exists(legacy_file):
-                self.device_path = candidate_path
-                return self.device_path
-        return None
+        temperature_file = os.path.join(device_path, "temperature")
+        self.data_file = temperature_file if os.path.exists(temperature_file) else os.path.join(device_path, "w1_slave")
+        self.device_path = device_path
+        return self.device_path
 
+    @W1_READ_SECONDS.timed
     def _read_raw_temperature(self):
         """
         Reads the raw temperature in degrees Celsius from the w1 device files.
@@ -524,15 +1242,13 @@ class WaterTemperatureSensor(object):
             self.detect_sensor()
         if not self.device_path:
             return None
-        temperature_file = os.path.join(self.device_path, "temperature")
-        legacy_file = os.path.join(self.device_path, "w1_slave")
         try:
-            if os.path.exists(temperature_file):
-                with open(temperature_file, "r") as fh:
+            if self.data_file.endswith("temperature"):
+                with open(self.data_file, "r") as fh:
                     raw_str = fh.read().strip()
                 temp_c = Decimal(raw_str) / Decimal("1000")
             else:
-                with open(legacy_file, "r") as fh:
+                with open(self.data_file, "r") as fh:
                     lines = fh.readlines()
                 if len(lines) < 2 or "YES" not in lines[0]:
                     return None
@@ -545,7 +1261,11 @@ class WaterTemperatureSensor(object):
                 except (InvalidOperation, AttributeError):
                     pass
         except (OSError, ValueError, InvalidOperation) as e:
+            W1_READ_ERRORS.inc()
             logging.warning("WaterTemperatureSensor._read_raw_temperature(): unable to read: %s", e)
+            if isinstance(e, OSError):  # Probe unplugged? Look for it again next time
+                self.bus.forget(os.path.basename(self.device_path))
+                self.device_path = None
             return None
         return temp_c
 
@@ -610,25 +1330,100 @@ class WaterTemperatureSensor(object):
         return True
 
 
+class StatusSnapshot(object):
+    """
+    A point-in-time record of a device's status. Refreshed in the background so requests can be
+    answered with a dict lookup instead of a trip to the hardware.
+    """
+    data = None
+    timestamp = None  # Seconds since the epoch when the snapshot was taken
+    version = 0  # Goes up by one every time the data changes
+    registry_version = None  # Version of the device's registry the data was built from
+
+    def __init__(self, data=None, timestamp=None, version=0, registry_version=None):
+        self.data = data or {}
+        self.timestamp = timestamp
+        self.version = version
+        self.registry_version = registry_version
+
+    def __repr__(self):
+        return "StatusSnapshot v{} @ {}: {}".format(self.version, self.timestamp, self.data)
+
+    def get_age_seconds(self, now):
+        """
+        How old this snapshot is
+
+        @param now: <float> The current time in seconds since the epoch
+        """
+        if self.timestamp is None:
+            return None
+        return max(now - self.timestamp, 0.0)
+
+    def is_older_than(self, max_age_seconds, now):
+        """
+        Returns True if this snapshot has expired, given the max age allowed
+        """
+        age_seconds = self.get_age_seconds(now)
+        if age_seconds is None:
+            return True
+        return age_seconds > max_age_seconds
+
+    def get(self, key, default=None):
+        return self.data.get(key, default)
+
+    def __getitem__(self, key):
+        return self.data[key]
+
+
+class PinLevelTimeout(Exception):
+    """
+    A watched pin didn't reach the level we were waiting for in time
+    """
+
+    def __init__(self, pin, level, timeout_ms):
+        self.pin = pin
+        self.level = level
+        self.timeout_ms = timeout_ms
+        super(PinLevelTimeout, self).__init__("Pin #{} did not go {} within {}ms".format(pin, "high" if level else "low", timeout_ms))
+
+
 class BaseRaspiHomeDevice(object):
     """
     A base class for building subclasses to control devices from a Raspberry pi
     """
     iface = None
     emulated_readable_pins = None
+    clock = None  # Twisted IReactorTime for non-blocking timers. Defaults to the global reactor
+    watched_pin_levels = None  # {pin: level} kept current by pigpio edge callbacks
+    pin_callbacks = None  # {pin: pigpio callback} for the watched pins
+    pin_level_waiters = None  # {pin: [(level, Deferred, timeout DelayedCall)]} waiting for a watched pin to change
+    pulse_script_ids = None  # {pin: pigpiod stored script id} for hardware-timed pulses
+    pigpio_params = None  # The settings iface was connected with (pi_host, pig_port etc.)
+    connection = None  # PigpioConnectionManager, if something is keeping iface connected for us
+    use_hardware_pulses = True  # Have pigpiod time our pulses where possible
+    PULSE_SCRIPT = "w {pin} 1 mils p0 w {pin} 0"  # pigpiod script: pin on, wait p0 ms, pin off
     
     def __init__(self, registry=None, emulated_readable_pins=None, *args, **kwargs):
         """
         Ensure we have a registry to store data
+
+        @keyword registry: <VersionedRegistry> to keep our data in. Pass the same one to devices which should
+                           share data. Any other mapping (e.g. a plain dict) is wrapped in one, as its backing store.
         """
         super(BaseRaspiHomeDevice, self).__init__(*args, **kwargs)
         if registry is None:
-            self.__class__.registry = {}
+            self.__class__.registry = VersionedRegistry()
             registry = self.__class__.registry
+        elif not isinstance(registry, VersionedRegistry):
+            registry = VersionedRegistry(store=registry)
         self.registry = registry
         if DEBUG and emulated_readable_pins is None:
             emulated_readable_pins = {}
         self.emulated_readable_pins = emulated_readable_pins
+        self.watched_pin_levels = {}
+        self.pin_callbacks = {}
+        self.pin_level_waiters = {}
+        self.pulse_script_ids = {}
     
     def write(self, pin, value=0):
         """
@@ -640,9 +1435,11 @@ class BaseRaspiHomeDevice(object):
         if self.iface.connected:
             try:
                 self.iface.write(pin, value)
-            except (AttributeError, IOError):
+            except PIGPIO_CONNECTION_ERRORS as e:
+                self.report_pigpio_error(e)
                 logging.error("ERROR: Cannot output to pins. Value of pin #%s would be %s" % (pin,value))
         else:
+            PIGPIO_ERRORS.inc()
             logging.error("ERROR: Interface not connected. Cannot output to pins. Value of pin #%s would be %s" % (pin, value))
             if DEBUG:  # Emulate for debug
                 self.emulated_readable_pins[pin] = value
@@ -657,13 +1454,16 @@ class BaseRaspiHomeDevice(object):
         value = 0 #Default to nowt
         if self.iface.connected:
             try:
-                value = self.iface.read(pin)
-            except (AttributeError, IOError, pigpio.error):
+                with PIGPIO_READ_SECONDS.time():
+                    value = self.iface.read(pin)
+            except PIGPIO_CONNECTION_ERRORS as e:
+                self.report_pigpio_error(e)
                 logging.error("ERROR: Cannot read value of pin #%s" % (pin,))
             else:
                 if DEBUG:  # If we have had a successful read, update the emulated data too
                     self.emulated_readable_pins[pin] = value
         else:
+            PIGPIO_ERRORS.inc()
             logging.error("ERROR: Interface not connected. Cannot read value of pin #%s." % (pin,))
             if DEBUG:  # Simulate the correct value if reading pin has failed.
                 try:
@@ -672,18 +1472,344 @@ class BaseRaspiHomeDevice(object):
                     pass
         return value
     
+    def read_pins(self, pins):
+        """
+        Reads several pins in one go. Pins 0-31 come from a single bank read, so it costs one
+        round trip to pigpiod however many pins you ask for. Fails safely like read().
+
+        @param pins: <iterable> of <int> The pins to read
+        @return: <dict> {pin: level}
+        """
+        pins = list(pins)
+        levels = {pin: 0 for pin in pins}  # Default to nowt
+        if not pins:
+            return levels
+        if self.iface.connected:
+            try:
+                with PIGPIO_READ_SECONDS.time():
+                    bank_1 = self.iface.read_bank_1() if any(pin < 32 for pin in pins) else 0
+                    bank_2 = self.iface.read_bank_2() if any(pin >= 32 for pin in pins) else 0
+            except PIGPIO_CONNECTION_ERRORS as e:
+                self.report_pigpio_error(e)
+                logging.error("ERROR: Cannot read values of pins %s" % (pins,))
+            else:
+                for pin in pins:
+                    if pin < 32:
+                        levels[pin] = (bank_1 >> pin) & 1
+                    else:
+                        levels[pin] = (bank_2 >> (pin - 32)) & 1
+                if DEBUG:  # If we have had a successful read, update the emulated data too
+                    self.emulated_readable_pins.update(levels)
+        else:
+            PIGPIO_ERRORS.inc()
+            logging.error("ERROR: Interface not connected. Cannot read values of pins %s." % (pins,))
+            if DEBUG:  # Simulate the correct values if reading pins has failed.
+                for pin in pins:
+                    try:
+                        levels[pin] = self.emulated_readable_pins[pin]
+                    except KeyError:
+                        pass
+        return levels
+
+    def report_pigpio_error(self, error):
+        """
+        Counts a failed pin operation. If it looks like pigpiod has gone away, tells the connection manager.
+        Safe to call from any thread.
+        """
+        PIGPIO_ERRORS.inc()
+        if self.connection is not None and isinstance(error, (IOError, struct.error)):
+            self.connection.connection_error(error)
+
+    def is_interface_lost(self):
+        """
+        @return: <bool> True if our connection manager knows pigpiod has gone, so any pin levels read now
+                 would be made up. (In DEBUG mode, the emulated pins are always there to read.)
+        """
+        return self.connection is not None and not self.connection.is_connected() and not DEBUG
+
+    def on_interface_lost(self):
+        """
+        Called on the reactor thread when the connection to pigpiod is lost. Everything pigpiod was doing
+        for us has gone with it, so forget the callbacks and scripts without trying to cancel them. The
+        watched pins' levels are kept as the last known state until we reconnect and re-read them.
+        """
+        self.pin_callbacks.clear()
+        self.pulse_script_ids.clear()
+        self._fail_pin_level_waiters()
+
+    def on_interface_reconnected(self):
+        """
+        Called on the reactor thread once iface has been replaced by a newly connected one. Override me to
+        set the pins up again.
+        """
+        pass
+
+    def watch_pin(self, pin, glitch_filter_us=0):
+        """
+        Registers a pigpio edge callback on an input pin, so its level is always known without
+        asking pigpiod. Changes are passed to on_watched_pin_changed() on the reactor thread.
+
+        @param pin: <int> The input pin to watch
+        @keyword glitch_filter_us: <int> Ignore level changes which don't stay put for this many
+                                   microseconds (0-300000). 0 turns the filter off.
+        @return: <bool> True if the pin is now being watched
+        """
+        if pin in self.pin_callbacks:
+            return True
+        if not self.iface.connected:
+            logging.error("ERROR: Interface not connected. Cannot watch pin #%s." % (pin,))
+            return False
+        try:
+            self.iface.set_glitch_filter(pin, glitch_filter_us)
+            self.pin_callbacks[pin] = self.iface.callback(pin, pigpio.EITHER_EDGE, self._on_pin_edge)
+        except PIGPIO_CONNECTION_ERRORS as e:
+            self.report_pigpio_error(e)
+            logging.error("ERROR: Cannot watch pin #%s: %s" % (pin, e))
+            return False
+        self.watched_pin_levels[pin] = self.read(pin)  # Read after registering, so we can't miss an edge
+        return True
+
+    def unwatch_pins(self):
+        """
+        Cancels all the edge callbacks
+        """
+        for pin, callback in list(self.pin_callbacks.items()):
+            try:
+                callback.cancel()
+            except PIGPIO_CONNECTION_ERRORS:
+                pass
+        self.pin_callbacks.clear()
+        self.watched_pin_levels.clear()
+        self._fail_pin_level_waiters()
+
+    def _fail_pin_level_waiters(self):
+        """
+        Gives up on anyone waiting for a watched pin to change
+        """
+        for pin, waiters in list(self.pin_level_waiters.items()):
+            for wanted_level, d, timeout_call in waiters:
+                if timeout_call.active():
+                    timeout_call.cancel()
+                d.errback(PinLevelTimeout(pin, wanted_level, 0))
+        self.pin_level_waiters.clear()
+
+    def _on_pin_edge(self, pin, level, tick):
+        """
+        pigpio edge callback. NB: runs in pigpio's notification thread, so hands over to the reactor.
+        """
+        if level == pigpio.TIMEOUT:  # Watchdog, not a level change
+            return
+        self.watched_pin_levels[pin] = level
+        PIN_EDGES.inc()
+        reactor.callFromThread(self._dispatch_pin_change, pin, level)
+
+    def _dispatch_pin_change(self, pin, level):
+        """
+        Reactor thread side of an edge: wakes anyone waiting for this level, then tells on_watched_pin_changed()
+        """
+        waiters = self.pin_level_waiters.get(pin)
+        if waiters:
+            still_waiting = []
+            for waiter in waiters:
+                wanted_level, d, timeout_call = waiter
+                if bool(wanted_level) == bool(level):
+                    if timeout_call.active():
+                        timeout_call.cancel()
+                    d.callback(level)
+                else:
+                    still_waiting.append(waiter)
+            self.pin_level_waiters[pin] = still_waiting
+        self.on_watched_pin_changed(pin, level)
+
+    def wait_for_pin_level(self, pin, level, timeout_ms=1000):
+        """
+        Waits, without blocking, for a watched pin to reach the given level.
+
+        @param pin: <int> A pin being watched by watch_pin()
+        @param level: The level to wait for (in the boolean sense)
+        @keyword timeout_ms: <int> How long to wait before giving up
+        @return: <Deferred> which fires with the level as soon as the pin reaches it (straight away if it
+                 already has), or fails with PinLevelTimeout
+        """
+        if pin not in self.pin_callbacks:
+            return defer.fail(ValueError("Pin #{} is not being watched, so we can't wait for its edges".format(pin)))
+        if bool(self.watched_pin_levels.get(pin)) == bool(level):
+            return defer.succeed(self.watched_pin_levels[pin])
+        d = defer.Deferred()
+        timeout_call = self.get_clock().callLater(timeout_ms/1000.0, self._pin_level_timed_out, pin, d, level, timeout_ms)
+        self.pin_level_waiters.setdefault(pin, []).append((level, d, timeout_call))
+        return d
+
+    def _pin_level_timed_out(self, pin, d, level, timeout_ms):
+        self.pin_level_waiters[pin] = [waiter for waiter in self.pin_level_waiters.get(pin, []) if waiter[1] is not d]
+        d.errback(PinLevelTimeout(pin, level, timeout_ms))
+
+    def wait_for_pin_level_blocking(self, pin, level, timeout_ms=1000, poll_ms=5):
+        """
+        Blocking version of wait_for_pin_level(). The edge callback thread keeps watched_pin_levels
+        current, so this just keeps an eye on it.
+
+        @return: <bool> True if the pin reached the level, False if we timed out
+        """
+        deadline = perf_counter() + timeout_ms/1000.0
+        while bool(self.watched_pin_levels.get(pin)) != bool(level):
+            if perf_counter() >= deadline:
+                return False
+            sleep(poll_ms/1000.0)
+        return True
+
+    def on_watched_pin_changed(self, pin, level):
+        """
+        Called on the reactor thread when a watched pin changes level. Override me.
+        """
+        pass
+
+    def read_watched(self, pin):
+        """
+        Returns a pin's level, from memory if the pin is watched, otherwise by asking pigpiod
+        """
+        try:
+            return self.watched_pin_levels[pin]
+        except KeyError:
+            return self.read(pin)
+
+    def read_watched_many(self, pins):
+        """
+        Returns several pins' levels: watched ones from memory, the rest with one bank read
+
+        @return: <dict> {pin: level}
+        """
+        levels = {}
+        unwatched_pins = []
+        for pin in pins:
+            try:
+                levels[pin] = self.watched_pin_levels[pin]
+            except KeyError:
+                unwatched_pins.append(pin)
+        if unwatched_pins:
+            levels.update(self.read_pins(unwatched_pins))
+        return levels
+
+    def resync_watched_pins(self):
+        """
+        Re-reads the watched pins from pigpiod, in case an edge went missing, correcting any that
+        have drifted.
+
+        @return: <list> of the pins whose remembered level was wrong
+        """
+        corrected_pins = []
+        if self.is_interface_lost():  # Keep what we last knew. We re-read them all when we reconnect
+            return corrected_pins
+        for pin, level in self.read_pins(list(self.pin_callbacks)).items():
+            if self.watched_pin_levels.get(pin) != level:
+                logging.warning("Watched pin #%s was remembered as %s but is actually %s" % (pin, self.watched_pin_levels.get(pin), level))
+                PIN_RESYNC_CORRECTIONS.inc()
+                self.watched_pin_levels[pin] = level
+                corrected_pins.append(pin)
+        return corrected_pins
+
+    def store_pulse_script(self, pin):
+        """
+        Stores a script in pigpiod which pulses the given pin, so pigpiod can time the pulse itself.
+        Do this up front for each pin you'll pulse: pigpiod needs a moment to initialise a new script.
+
+        @param pin: <int> The output pin the script will pulse
+        @return: <int> The script id, or None if it couldn't be stored
+        """
+        if pin in self.pulse_script_ids:
+            return self.pulse_script_ids[pin]
+        if not self.use_hardware_pulses or not self.iface.connected:
+            return None
+        try:
+            script_id = self.iface.store_script(self.PULSE_SCRIPT.format(pin=pin).encode("ascii"))
+        except PIGPIO_CONNECTION_ERRORS as e:
+            self.report_pigpio_error(e)
+            logging.error("ERROR: Cannot store pulse script for pin #%s, pulses will be timed in software: %s" % (pin, e))
+            return None
+        self.pulse_script_ids[pin] = script_id
+        return script_id
+
+    def delete_pulse_scripts(self):
+        """
+        Removes our stored pulse scripts from pigpiod
+        """
+        for pin, script_id in list(self.pulse_script_ids.items()):
+            try:
+                self.iface.delete_script(script_id)
+            except PIGPIO_CONNECTION_ERRORS:
+                pass
+        self.pulse_script_ids.clear()
+
+    def start_hardware_pulse(self, pin, duration_ms=100):
+        """
+        Starts a pulse timed by pigpiod. Returns straight away, with the pin still on.
+
+        @param pin: <int> The pin to pulse
+        @param duration_ms: <int> How long the pulse should be in ms
+        @return: <bool> True if pigpiod is pulsing the pin, False if you need to do it yourself
+        """
+        if not self.iface.connected:
+            return False
+        script_id = self.store_pulse_script(pin)
+        if script_id is None:
+            return False
+        try:
+            self.iface.run_script(script_id, [int(duration_ms)])
+        except PIGPIO_CONNECTION_ERRORS as e:
+            self.report_pigpio_error(e)
+            logging.error("ERROR: Cannot run pulse script for pin #%s, timing the pulse in software: %s" % (pin, e))
+            return False
+        PULSES.labels(timing="hardware").inc()
+        return True
+
     def pulse_on(self, pin, duration_ms=100):
         """
-        Pulses the given pin on for a short period.
+        Pulses the given pin on for a short period. The pulse is timed by pigpiod if we can, or by
+        write/sleep/write if not.
         NB: This is BLOCKING for the duration. Run in a thread if the duration is long.
         
         @param pin: <int> The pin to change
         @param duration_ms: <int> How long the pulse should be in ms
         """
+        if self.start_hardware_pulse(pin, duration_ms):
+            sleep(duration_ms/1000.0)  # Keep our promise that the pulse is over when we return
+            return duration_ms
+        PULSES.labels(timing="software").inc()
         self.write(pin, 1)
         sleep(duration_ms/1000.0)
         self.write(pin, 0)
         return duration_ms
+
+    def get_clock(self):
+        """
+        Returns the clock used to schedule non-blocking timers
+        """
+        if self.clock is None:
+            return reactor
+        return self.clock
+
+    def pulse_on_non_blocking(self, pin, duration_ms=100):
+        """
+        Pulses the given pin on for a short period. The pulse is timed by pigpiod if we can. If not,
+        the pin is switched back off by a reactor timer. Either way the reactor thread is free to
+        serve other requests in the meantime.
+
+        @param pin: <int> The pin to change
+        @param duration_ms: <int> How long the pulse should be in ms
+        @return: <Deferred> which fires with duration_ms once the pin is back off
+        """
+        if self.start_hardware_pulse(pin, duration_ms):
+            return task.deferLater(self.get_clock(), duration_ms/1000.0, lambda: duration_ms)
+        PULSES.labels(timing="software").inc()
+        self.write(pin, 1)
+        return task.deferLater(self.get_clock(), duration_ms/1000.0, self._end_pulse, pin, duration_ms)
+
+    def _end_pulse(self, pin, duration_ms):
+        """
+        Switches a pulsed pin back off
+        """
+        self.write(pin, 0)
+        return duration_ms
     
     def pulse_if_different(self, current=None, intended=None, output_pin=None, duration_ms=100):
         """
@@ -694,6 +1820,21 @@ class BaseRaspiHomeDevice(object):
             logging.error("ERROR - pulse_if_different(): All parameters must be provided and not None. current={} intended={} output_pin={}".format(current, intended, output_pin))
         if bool(current) ^ bool(intended):
             self.pulse_on(output_pin, duration_ms)
+
+    def pulse_if_different_non_blocking(self, current=None, intended=None, output_pin=None, duration_ms=100):
+        """
+        Non-blocking version of pulse_if_different()
+
+        @return: <Deferred> which fires with True once the pulse has finished, or False straight away
+                 if no pulse was needed
+        """
+        if current is None or intended is None or output_pin is None:
+            logging.error("ERROR - pulse_if_different_non_blocking(): All parameters must be provided and not None. current={} intended={} output_pin={}".format(current, intended, output_pin))
+        if bool(current) ^ bool(intended):
+            d = self.pulse_on_non_blocking(output_pin, duration_ms)
+            d.addCallback(lambda _duration_ms: True)
+            return d
+        return defer.succeed(False)
     
     def get_or_build_interface(self, config=None, interface=None, *args, **kwargs):
         """
@@ -746,7 +1887,9 @@ class BaseRaspiHomeDevice(object):
             iface_params["pig_port"] = pig_port
             self.iface = self.generate_new_interface(iface_params)
         else:
+            iface_params = dict(config, pi_host=iface_host, pig_port=iface_port)
             self.iface = interface
+        self.pigpio_params = iface_params
         return self.iface
     
     def generate_new_interface(self, params):
@@ -763,13 +1906,15 @@ class BaseRaspiHomeDevice(object):
 
     def get_data(self, key, default=NOT_SET):
         """
-        Pulls a certain piece of data from the registry, uses copy() to prevent changing data if pulling mutable types.
+        Pulls a certain piece of data from the registry. No copy needed: registry values are frozen.
         """
-        try:
-            item = self.registry[key]
-        except KeyError:
-            return copy.copy(default)
-        return copy.copy(item)
+        return self.registry.get(key, default)
+
+    def get_data_version(self):
+        """
+        Returns the registry's version number, which goes up every time anything in it changes
+        """
+        return self.registry.version
 
     def __getitem__(self, key):
         item = self.get_data(key)
@@ -779,9 +1924,9 @@ class BaseRaspiHomeDevice(object):
 
     def set_data(self, key, value):
         """
-        Sets an item in the registry. Will be frozen in time thanks to copy()
+        Sets an item in the registry. It's frozen on the way in, so later changes to value won't affect it
         """
-        self.registry[key] = copy.copy(value)
+        self.registry[key] = value
 
     def __setitem__(self, key, value):
         self.set_data(key, value)
@@ -0,0 +1,16 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Test setup
+
+        The modules in src/ import each other both as src.<module> and as plain <module>, so the tests
+        need both the repo root and src/ on the path. Tests run with debug off unless they say otherwise.
+"""
+import os
+import sys
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.realpath(__file__)))
+for path in (os.path.join(ROOT_DIR, "src"), ROOT_DIR):
+    if path not in sys.path:
+        sys.path.insert(0, path)
+os.environ.setdefault("RASPITHERM_DEBUG", "0")
@@ -0,0 +1,146 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - PersistentRegistry tests
+
+        Each test gets its own log file in a temporary directory, and a task.Clock for the batched syncs.
+"""
+import datetime
+import os
+import shutil
+import tempfile
+import threading
+import unittest
+from decimal import Decimal
+from unittest import mock
+
+from twisted.internet import task
+
+from src import registry as registry_module
+from src.registry import PersistentRegistry, VersionedRegistry
+
+
+class PersistentRegistryTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.tmp_dir, "registry.log")
+        self.clock = task.Clock()
+        self.registries = []
+
+    def tearDown(self):
+        for registry in self.registries:
+            registry.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def open_registry(self, **kwargs):
+        kwargs.setdefault("clock", self.clock)
+        registry = PersistentRegistry(self.path, **kwargs)
+        self.registries.append(registry)
+        return registry
+
+    def read_log_lines(self):
+        with open(self.path, "r", encoding="utf-8") as log_file:
+            return log_file.readlines()
+
+    def test_round_trip_across_reopen(self):
+        registry = self.open_registry()
+        registry["target_temperature"] = 20.5
+        registry["th"] = {"temp_c": Decimal("19.4"), "query_timestamp": datetime.datetime(2026, 1, 2, 3, 4, 5)}
+        registry["hw"] = True
+        registry["deleted"] = 1
+        del registry["deleted"]
+        registry.close()
+
+        reopened = self.open_registry()
+        self.assertEqual(dict(reopened), {
+            "target_temperature": 20.5,
+            "th": {"temp_c": Decimal("19.4"), "query_timestamp": datetime.datetime(2026, 1, 2, 3, 4, 5)},
+            "hw": True,
+        })
+
+    def test_batched_writes_are_synced_by_the_clock(self):
+        registry = self.open_registry(sync_interval_seconds=1.0)
+        registry["a"] = 1
+        registry["b"] = 2
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)  # One sync for the batch
+        self.clock.advance(1.0)
+        self.assertEqual(len(self.read_log_lines()), 2)
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_truncated_last_line_is_dropped(self):
+        with open(self.path, "w", encoding="utf-8") as log_file:
+            log_file.write('{"k":"a","v":1}\n{"k":"b","v":2}\n{"k":"a","v":')
+        registry = self.open_registry()
+        self.assertEqual(dict(registry), {"a": 1, "b": 2})
+        self.assertEqual(self.read_log_lines(), ['{"k":"a","v":1}\n', '{"k":"b","v":2}\n'])
+
+        registry["a"] = 3  # New lines must start cleanly after the torn one
+        registry.close()
+        self.assertEqual(dict(self.open_registry()), {"a": 3, "b": 2})
+
+    def test_corrupt_line_is_skipped(self):
+        with open(self.path, "w", encoding="utf-8") as log_file:
+            log_file.write('{"k":"a","v":1}\nnot json\n{"k":"b","v":2}\n')
+        self.assertEqual(dict(self.open_registry()), {"a": 1, "b": 2})
+
+    def test_compaction_keeps_latest_values(self):
+        with mock.patch.object(PersistentRegistry, "COMPACT_MIN_LINES", 10):
+            registry = self.open_registry(sync_interval_seconds=0)
+            for i in range(9):
+                registry["counter"] = i
+            registry["other"] = "x"  # The 10th line, which sets off the compaction
+            self.assertEqual(self.read_log_lines(), ['{"k":"counter","v":8}\n', '{"k":"other","v":"x"}\n'])
+            del registry["other"]
+            registry["kept"] = "y"
+        registry.close()
+        self.assertEqual(dict(self.open_registry()), {"counter": 8, "kept": "y"})
+        self.assertFalse(os.path.exists(self.path + ".tmp"))
+
+    def test_write_from_another_thread_schedules_sync_on_reactor(self):
+        registry = self.open_registry(sync_interval_seconds=1.0)
+        from_thread = []
+        with mock.patch.object(registry_module.reactor, "callFromThread", side_effect=from_thread.append):
+            writer = threading.Thread(target=registry.__setitem__, args=("th", {"temp_c": 19.0}))
+            writer.start()
+            writer.join()
+        self.assertEqual(self.clock.getDelayedCalls(), [])  # callLater wasn't touched off the reactor thread
+        self.assertEqual(len(from_thread), 1)
+
+        from_thread[0]()  # What the reactor would run
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        self.clock.advance(1.0)
+        self.assertEqual(self.read_log_lines(), ['{"k":"th","v":{"temp_c":19.0}}\n'])
+
+    def test_close_syncs_pending_writes(self):
+        registry = self.open_registry(sync_interval_seconds=60)
+        registry["a"] = 1
+        registry.close()
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+        self.assertEqual(self.read_log_lines(), ['{"k":"a","v":1}\n'])
+
+
+class VersionedRegistryTest(unittest.TestCase):
+
+    def test_versions_only_change_with_the_data(self):
+        registry = VersionedRegistry()
+        registry["a"] = [1, 2]
+        version = registry.version
+        registry["a"] = [1, 2]
+        self.assertEqual(registry.version, version)
+        registry["a"] = [1, 3]
+        self.assertEqual(registry.version, version + 1)
+
+    def test_values_are_frozen(self):
+        registry = VersionedRegistry()
+        registry["th"] = {"temp_c": 19.0}
+        with self.assertRaises(TypeError):
+            registry["th"]["temp_c"] = 20.0
+
+    def test_writes_go_through_to_the_store(self):
+        store = {"a": 1}
+        registry = VersionedRegistry(store=store)
+        self.assertEqual(registry["a"], 1)
+        registry["b"] = 2
+        del registry["a"]
+        self.assertEqual(store, {"b": 2})
@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Rollup tests
+
+        Uses files with only a handful of slots, so wrapping round the ring takes a few readings rather than a year.
+"""
+import os
+import shutil
+import tempfile
+import unittest
+from collections import OrderedDict
+from unittest import mock
+
+from twisted.internet import task
+
+from src.rollups import RollupFile, RollupStore
+
+
+T0 = 1800000000  # A unix time on a minute boundary
+SMALL_RESOLUTIONS = OrderedDict((
+    ("raw", (0, 5)),
+    ("1m", (60, 4)),
+))
+
+
+class RollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.tmp_dir = tempfile.mkdtemp()
+        self.to_close = []
+
+    def tearDown(self):
+        for rollup in self.to_close:
+            rollup.close()
+        shutil.rmtree(self.tmp_dir)
+
+    def open_file(self, name, fields=("temp_c",), step=0, n_slots=5):
+        rollup_file = RollupFile(os.path.join(self.tmp_dir, name), fields, step, n_slots)
+        self.to_close.append(rollup_file)
+        return rollup_file
+
+
+class RawRollupFileTest(RollupTestCase):
+
+    def test_wraps_past_n_slots(self):
+        raw = self.open_file("th.raw.rollup", n_slots=5)
+        for i in range(12):
+            raw.add(T0 + i, {"temp_c": i})
+            if i % 3 == 2:  # Some flushed, some still pending
+                raw.flush()
+        self.assertEqual(raw.n_written + len(raw.pending), 12)
+        self.assertEqual(raw.query(T0, T0 + 1000)["t"], [T0 + 7, T0 + 8, T0 + 9, T0 + 10, T0 + 11])  # Only the last 5 are kept
+        self.assertEqual(raw.query(T0 + 9, T0 + 1000)["temp_c"], [9, 10, 11])
+        self.assertEqual(raw.query(T0 + 8, T0 + 10)["t"], [T0 + 8, T0 + 9, T0 + 10])
+        self.assertEqual(raw.query(T0 + 200, T0 + 300)["t"], [])
+
+    def test_binary_search_over_every_wrapped_position(self):
+        raw = self.open_file("th.raw.rollup", n_slots=5)
+        for i in range(23):
+            raw.add(T0 + i * 10, {"temp_c": i})
+            raw.flush()
+            # The first reading kept, at each possible offset into the ring
+            oldest = max(i - 4, 0)
+            for since in range(T0 - 10, T0 + i * 10 + 10, 5):
+                expected = [T0 + n * 10 for n in range(oldest, i + 1) if T0 + n * 10 >= since]
+                self.assertEqual(raw.query(since, T0 + 10000)["t"], expected, "after {} readings, since T0{:+}".format(i + 1, since - T0))
+
+    def test_missing_values_are_none(self):
+        raw = self.open_file("th.raw.rollup", fields=("temp_c", "humidity"))
+        raw.add(T0, {"temp_c": 19.5, "humidity": None})
+        raw.add(T0 + 1, {"temp_c": "not a number"})
+        self.assertEqual(raw.query(T0, T0 + 1000), {"t": [T0, T0 + 1], "temp_c": [19.5, None], "humidity": [None, None]})
+
+
+class RollupRollupFileTest(RollupTestCase):
+
+    def test_buckets_count_sum_min_max(self):
+        minutes = self.open_file("th.1m.rollup", step=60, n_slots=4)
+        for seconds, temp_c in ((60, 18.0), (90, 20.0), (119, 22.0), (120, 19.0)):
+            minutes.add(T0 + seconds, {"temp_c": temp_c})
+        minutes.flush()
+        self.assertEqual(minutes.query(T0, T0 + 200), {
+            "t": [T0 + 60, T0 + 120],
+            "temp_c": [20.0, 19.0],
+            "temp_c_min": [18.0, 19.0],
+            "temp_c_max": [22.0, 19.0],
+        })
+
+    def test_stale_slot_is_reused_after_wrap_around(self):
+        minutes = self.open_file("th.1m.rollup", step=60, n_slots=4)
+        minutes.add(T0 + 10, {"temp_c": 10.0})
+        minutes.add(T0 + 20, {"temp_c": 12.0})
+        minutes.flush()
+        minutes.add(T0 + 250, {"temp_c": 20.0})  # 4 buckets on, so in the first bucket's slot
+        self.assertEqual(minutes.query(T0, T0 + 60)["t"], [])  # The first bucket has gone
+        out = minutes.query(T0, T0 + 300)
+        self.assertEqual(out["t"], [T0 + 240])
+        self.assertEqual((out["temp_c"], out["temp_c_min"], out["temp_c_max"]), ([20.0], [20.0], [20.0]))  # Nothing carried over
+        minutes.flush()
+        self.assertEqual(minutes.query(T0, T0 + 300)["temp_c"], [20.0])
+
+
+class RollupStoreTest(RollupTestCase):
+
+    def setUp(self):
+        super(RollupStoreTest, self).setUp()
+        self.clock = task.Clock()
+        patcher = mock.patch.object(RollupStore, "RESOLUTIONS", SMALL_RESOLUTIONS)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def open_store(self):
+        store = RollupStore(os.path.join(self.tmp_dir, "rollups"), flush_interval_seconds=60, clock=self.clock)
+        self.to_close.append(store)
+        return store
+
+    def test_round_trip_across_reopen(self):
+        store = self.open_store()
+        for seconds, temp_c in ((100, 19.0), (110, 21.0), (130, 20.0)):
+            store.add("th", ("temp_c", "humidity"), T0 + seconds, {"temp_c": temp_c, "humidity": 50})
+        store.close()
+
+        reopened = self.open_store()
+        self.assertEqual(reopened.query("th", "raw", since=T0, until=T0 + 1000)["temp_c"], [19.0, 21.0, 20.0])
+        minutes = reopened.query("th", "1m", since=T0, until=T0 + 200)
+        self.assertEqual(minutes["t"], [T0 + 60, T0 + 120])
+        self.assertEqual(minutes["temp_c"], [20.0, 20.0])
+        self.assertEqual(minutes["humidity"], [50.0, 50.0])
+        self.assertIsNone(reopened.query("hw_temp", "raw"))
+
+        reopened.add("th", ("temp_c", "humidity"), T0 + 140, {"temp_c": 22.0})  # Carries on where it left off
+        self.assertEqual(reopened.query("th", "raw", since=T0, until=T0 + 1000)["t"], [T0 + 100, T0 + 110, T0 + 130, T0 + 140])
+
+    def test_readings_are_flushed_in_batches(self):
+        store = self.open_store()
+        store.add("th", ("temp_c",), T0, {"temp_c": 19.0})
+        store.add("th", ("temp_c",), T0 + 10, {"temp_c": 20.0})
+        self.assertEqual(len(self.clock.getDelayedCalls()), 1)
+        raw = store.files[("th", "raw")]
+        self.assertEqual((raw.n_written, len(raw.pending)), (0, 2))
+        self.clock.advance(60)
+        self.assertEqual((raw.n_written, len(raw.pending)), (2, 0))
+        self.assertEqual(self.clock.getDelayedCalls(), [])
+
+    def test_fields_change_moves_old_file_aside(self):
+        store = self.open_store()
+        store.add("heating", ("hw", "ch"), T0, {"hw": 1, "ch": 0})
+        store.flush()
+        store.add("heating", ("hw", "ch", "upstairs"), T0 + 10, {"hw": 1, "ch": 1, "upstairs": 1})  # A zone was added
+        store.flush()
+        raw_path = store.get_path("heating", "raw")
+        self.assertTrue(os.path.exists(raw_path + ".old"))
+        self.assertEqual(RollupFile.read_field_names(raw_path + ".old"), ("hw", "ch"))
+        self.assertEqual(RollupFile.read_field_names(raw_path), ("hw", "ch", "upstairs"))
+        self.assertEqual(store.query("heating", "raw", since=T0, until=T0 + 1000), {"t": [T0 + 10], "hw": [1.0], "ch": [1.0], "upstairs": [1.0]})
+
+    def test_refuses_non_finite_times(self):
+        store = self.open_store()
+        with self.assertRaises(ValueError):
+            store.query("th", "raw", since=float("nan"))
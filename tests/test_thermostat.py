@@ -0,0 +1,175 @@
+# -*- coding: utf-8 -*-
+
+"""
+    Raspitherm - Thermostat tests
+
+        Drives the Thermostat with a task.Clock and a stub HeatingController, so the minimum on / off times
+        and the time-proportioning cycle can be stepped through without waiting.
+"""
+import datetime
+import unittest
+
+from twisted.internet import defer, task
+
+from src.thermostat import Thermostat
+
+
+class StubCoalescer(object):
+    busy = False
+
+    def is_busy(self, circuit_name):
+        return self.busy
+
+
+class StubHeatingController(object):
+    """
+    Just enough of a HeatingController for the Thermostat: a room temperature, a CH state and a target
+    """
+    def __init__(self, clock, target_temperature=20.0):
+        self.clock = clock
+        self.data = {"target_temperature": target_temperature}
+        self.th = None
+        self.ch = False
+        self.switches = []  # (clock seconds, "on" / "off") of each switch asked for
+        self.command_coalescer = StubCoalescer()
+
+    def get_clock(self):
+        return self.clock
+
+    def get_data(self, key, default=None):
+        return self.data.get(key, default)
+
+    def set_temperature(self, temp_c, age_seconds=0):
+        self.th = {
+            "temp_c": str(temp_c),
+            "query_timestamp": datetime.datetime.now() - datetime.timedelta(seconds=age_seconds),
+        }
+
+    def set_ch_non_blocking(self, value):
+        self.switches.append((self.clock.seconds(), value))
+        self.ch = value == "on"
+        return defer.succeed(self.ch)
+
+
+class ThermostatTestCase(unittest.TestCase):
+    config = {}
+    poll_seconds = 10  # How often the sensor poll runs the control loop
+
+    def setUp(self):
+        self.clock = task.Clock()
+        self.controller = StubHeatingController(self.clock)
+        self.thermostat = Thermostat(self.controller, config=self.config)
+
+    def step(self, temp_c, seconds=0):
+        """
+        Sets the room temperature, then runs the control loop now (if seconds is 0) or at each sensor
+        poll over the next few seconds
+        """
+        self.controller.set_temperature(temp_c)
+        if not seconds:
+            return self.thermostat.update()
+        for _ in range(int(seconds // self.poll_seconds)):
+            self.clock.advance(self.poll_seconds)
+            self.thermostat.update()
+
+
+class HysteresisTest(ThermostatTestCase):
+    config = {
+        "thermostat_mode": "hysteresis",
+        "thermostat_hysteresis_c": 0.5,
+        "thermostat_min_on_seconds": 300,
+        "thermostat_min_off_seconds": 300,
+    }
+
+    def test_dead_band_leaves_heating_alone(self):
+        self.step(19.6)
+        self.step(20.4, seconds=600)
+        self.assertEqual(self.controller.switches, [])
+        self.assertIn("within", self.thermostat.reason)
+
+    def test_switches_either_side_of_dead_band(self):
+        self.step(19.4)
+        self.assertEqual(self.controller.switches, [(0, "on")])
+        self.step(20.4, seconds=600)  # Warming up, but still in the dead band
+        self.assertEqual(len(self.controller.switches), 1)
+        self.step(20.6, seconds=60)
+        self.assertEqual(self.controller.switches[-1], (610, "off"))
+
+    def test_first_switch_after_startup_is_not_held_up(self):
+        self.controller.ch = True
+        self.step(21.0)
+        self.assertEqual(self.controller.switches, [(0, "off")])
+
+    def test_min_on_time_blocks_switching_off(self):
+        self.step(19.0)
+        self.step(21.0, seconds=100)  # The min on time runs from the next poll, which sees the switch
+        self.assertEqual(self.controller.switches, [(0, "on")])
+        self.assertIn("Waiting 210s before switching off", self.thermostat.reason)
+        self.step(21.0, seconds=200)
+        self.assertEqual(len(self.controller.switches), 1)
+        self.step(21.0, seconds=10)
+        self.assertEqual(self.controller.switches[-1], (310, "off"))
+
+    def test_min_off_time_blocks_switching_on(self):
+        self.controller.ch = True
+        self.step(21.0)
+        self.step(19.0, seconds=300)
+        self.assertEqual(self.controller.switches, [(0, "off")])
+        self.step(19.0, seconds=10)
+        self.assertEqual(self.controller.switches[-1], (310, "on"))
+
+    def test_old_reading_is_ignored(self):
+        self.controller.set_temperature(15.0, age_seconds=self.thermostat.max_reading_age_seconds + 60)
+        self.assertIsNone(self.thermostat.update())
+        self.assertEqual(self.controller.switches, [])
+        self.assertIn("No recent temperature reading", self.thermostat.reason)
+
+    def test_no_target_does_nothing(self):
+        self.controller.data.pop("target_temperature")
+        self.step(10.0)
+        self.assertEqual(self.controller.switches, [])
+        self.assertFalse(self.thermostat.is_active())
+
+    def test_busy_switch_is_not_doubled_up(self):
+        self.controller.command_coalescer.busy = True
+        self.step(19.0)
+        self.assertEqual(self.controller.switches, [])
+
+
+class TimeProportioningTest(ThermostatTestCase):
+    config = {
+        "thermostat_mode": "pid",
+        "thermostat_pid_kp": 0.5,
+        "thermostat_pid_ki": 0.0,
+        "thermostat_pid_kd": 0.0,
+        "thermostat_cycle_seconds": 900,
+        "thermostat_min_on_seconds": 60,
+        "thermostat_min_off_seconds": 60,
+    }
+
+    def test_half_demand_is_on_for_half_the_cycle(self):
+        self.step(19.0)  # 1C below target at kp 0.5: 50% demand
+        self.assertEqual(self.thermostat.demand, 0.5)
+        self.assertEqual(self.controller.switches, [(0, "on")])
+        self.step(19.0, seconds=440)
+        self.assertEqual(len(self.controller.switches), 1)
+        self.step(19.0, seconds=10)
+        self.assertEqual(self.controller.switches[-1], (450, "off"))
+        self.step(19.0, seconds=440)
+        self.assertEqual(len(self.controller.switches), 2)
+        self.step(19.0, seconds=10)  # Next cycle
+        self.assertEqual(self.controller.switches[-1], (900, "on"))
+
+    def test_on_period_too_short_to_bother_with(self):
+        self.step(19.9)  # 5% demand: 45s, under the 60s min on time
+        self.assertEqual(self.controller.switches, [])
+
+    def test_off_period_too_short_to_bother_with(self):
+        self.step(18.1)  # 95% demand: a 45s off, under the 60s min off time
+        self.step(18.1, seconds=880)
+        self.assertEqual(self.controller.switches, [(0, "on")])
+
+    def test_warming_up_mid_cycle_cuts_on_period_short(self):
+        self.step(19.0)
+        self.step(19.6, seconds=300)  # Now 20% demand: on for 180s
+        self.assertEqual(self.controller.switches, [(0, "on"), (180, "off")])